@@ -0,0 +1,433 @@
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import argparse
+import platform
+import tempfile
+import threading
+import http.client
+from datetime import datetime, timezone
+import config
+from storage.engine import create_store, load_settings, get_store
+
+# Named dataset sizes, in users. There is one company for every USERS_PER_COMPANY users
+SIZES = {'1k': 1000, '100k': 100000, '1M': 1000000}
+USERS_PER_COMPANY = 10
+
+AREAS = ['Technology', 'Health', 'Education', 'Retail', 'Finance', 'Logistics']
+
+
+def parse_size(value):
+    """Accept a named size (1k, 100k, 1M) or a number of users."""
+    if value in SIZES:
+        return SIZES[value]
+    if value.isdigit() and int(value) > 0:
+        return int(value)
+    raise argparse.ArgumentTypeError(f'size must be one of {", ".join(SIZES)} or a number of users')
+
+
+def synthetic_company(company_id):
+    return {'company_id': company_id,
+            'cnpj': f'{company_id:014d}',
+            'name': f'Company {company_id}',
+            'area_of_activity': AREAS[company_id % len(AREAS)]}
+
+
+def synthetic_user(user_id, companies):
+    return {'id_user': user_id,
+            'name': f'User {user_id}',
+            'email': f'user{user_id}@example.com',
+            'password': f'password{user_id}',
+            'company_id': (user_id - 1) % companies + 1}
+
+
+def generate(settings, users, batch_size=1000):
+    """Fill an empty store with `users` users spread over users / USERS_PER_COMPANY companies.
+
+    The sizes are saved in bench.json in the data directory, for later runs on the same data.
+    """
+    companies = max(1, users // USERS_PER_COMPANY)
+    # Generated data can be thrown away, don't pay for an fsync per record
+    store = create_store(dict(settings, FSYNC_WRITES=False))
+    store.load()
+    for entity, count, build in (('companies', companies, synthetic_company),
+                                 ('users', users, lambda user_id: synthetic_user(user_id, companies))):
+        for start in range(1, count + 1, batch_size):
+            store.bulk_put(entity, [build(record_id) for record_id in range(start, min(start + batch_size, count + 1))])
+    store.close()
+    with open(os.path.join(settings['DATA_DIR'], 'bench.json'), 'w', encoding='utf-8') as f:
+        json.dump({'users': users, 'companies': companies}, f)
+    return companies
+
+
+class Scenario:
+    """One endpoint under test. `build(i)` returns the path and JSON body of the i-th request."""
+
+    def __init__(self, name, method, build, heavy=False, max_requests=None):
+        self.name = name
+        self.method = method
+        self.build = build
+        # Full listings read the whole store, they run fewer requests
+        self.heavy = heavy
+        # Deletes can't run more often than there are records to delete
+        self.max_requests = max_requests
+
+
+def scenarios(users, companies, change_seq=0):
+    """Every route of the API, reads first: writes change the data and deletes remove it.
+
+    Deletes take records from the end of the ID range (a quarter for single
+    deletes, the next quarter for batches), other requests from the start, so
+    they never get in each other's way. The change feed is read from a little
+    before `change_seq`, the last write in the change log when the run starts.
+    """
+    since = max(0, change_seq - 1000)
+
+    def user_id(i):
+        return i % (users // 2) + 1
+
+    def company_id(i):
+        return i % max(1, companies // 2) + 1
+
+    def new_user(i):
+        return {'name': f'Bench {i}', 'email': f'bench{i}@example.com', 'password': 'secret',
+                'company_id': company_id(i)}
+
+    def new_company(i):
+        # CNPJs above every generated one, unique per request
+        return {'cnpj': f'{90000000000000 + i:014d}', 'name': f'Bench {i}', 'area_of_activity': 'Benchmark'}
+
+    return [
+        Scenario('list_users', 'GET', lambda i: ('/users', None), heavy=True),
+        Scenario('list_users_stream', 'GET', lambda i: ('/users?stream=ndjson', None), heavy=True),
+        Scenario('list_users_page', 'GET', lambda i: (f'/users?limit=100&cursor={user_id(i * 100) - 1}', None)),
+        Scenario('get_user', 'GET', lambda i: (f'/users/{user_id(i)}', None)),
+        Scenario('list_companies', 'GET', lambda i: ('/companies', None), heavy=True),
+        Scenario('list_companies_page', 'GET', lambda i: ('/companies?limit=100', None)),
+        Scenario('find_company_by_cnpj', 'GET', lambda i: (f'/companies?cnpj={company_id(i):014d}', None)),
+        Scenario('get_company', 'GET', lambda i: (f'/companies/{company_id(i)}', None)),
+        Scenario('list_company_users', 'GET', lambda i: (f'/companies/{company_id(i)}/users', None)),
+        Scenario('find_user_by_email', 'GET', lambda i: (f'/users?email=user{user_id(i)}@example.com', None)),
+        Scenario('find_users_by_email_prefix', 'GET', lambda i: (f'/users?email=user{user_id(i)}0*&fields=id_user', None)),
+        Scenario('list_changes', 'GET', lambda i: (f'/changes?since={since}&limit=100', None)),
+        Scenario('list_users_since', 'GET', lambda i: (f'/users?since={since}&limit=100', None)),
+        # Hashes the password, and the first time a user is verified replaces its plaintext one
+        Scenario('verify_user_password', 'POST',
+                 lambda i: (f'/users/{user_id(i)}/verify-password', {'password': f'password{user_id(i)}'})),
+        Scenario('create_company', 'POST', lambda i: ('/companies', new_company(i))),
+        Scenario('create_user', 'POST', lambda i: ('/users', new_user(i))),
+        Scenario('update_full_user', 'PUT', lambda i: (f'/users/{user_id(i)}', new_user(i))),
+        Scenario('update_any_field_user', 'PATCH', lambda i: (f'/users/{user_id(i)}', {'name': f'Patched {i}'})),
+        Scenario('update_full_company', 'PUT', lambda i: (f'/companies/{company_id(i)}', new_company(-i - 1))),
+        Scenario('update_any_field_company', 'PATCH',
+                 lambda i: (f'/companies/{company_id(i)}', {'area_of_activity': f'Patched {i}'})),
+        Scenario('create_users_batch', 'POST', lambda i: ('/users:batch', [new_user(i * 100 + n) for n in range(100)])),
+        Scenario('create_companies_batch', 'POST',
+                 lambda i: ('/companies:batch', [new_company(10000000 + i * 100 + n) for n in range(100)])),
+        Scenario('update_users_batch', 'PATCH',
+                 lambda i: ('/users:batch', [{'id_user': user_id(i * 100 + n), 'name': f'Batch {i}'}
+                                             for n in range(100)])),
+        Scenario('update_companies_batch', 'PATCH',
+                 lambda i: ('/companies:batch', [{'company_id': company_id(i * 100 + n),
+                                                  'area_of_activity': f'Batch {i}'} for n in range(100)])),
+        Scenario('stats', 'GET', lambda i: ('/stats', None)),
+        Scenario('metrics', 'GET', lambda i: ('/metrics', None)),
+        Scenario('delete_user', 'DELETE', lambda i: (f'/users/{users - i}', None), max_requests=users // 4),
+        Scenario('delete_users_batch', 'DELETE',
+                 lambda i: ('/users:batch', [users - users // 4 - i * 100 - n for n in range(100)]),
+                 max_requests=users // 4 // 100),
+        # Removes the company and, through the company_id index, its users
+        Scenario('delete_company', 'DELETE', lambda i: (f'/companies/{companies - i}', None),
+                 max_requests=companies // 4),
+        Scenario('delete_companies_batch', 'DELETE',
+                 lambda i: ('/companies:batch', [companies - companies // 4 - i * 10 - n for n in range(10)]),
+                 max_requests=companies // 4 // 10),
+    ]
+
+
+def reset_peak_rss():
+    """Reset the peak RSS of this process, so each endpoint gets its own (Linux only, ignored elsewhere)."""
+    try:
+        with open('/proc/self/clear_refs', 'w', encoding='utf-8') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+
+def peak_rss_mb():
+    """Return the peak resident memory of this process, in MB."""
+    try:
+        with open('/proc/self/status', 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    return round(int(line.split()[1]) / 1024, 1)
+    except OSError:
+        pass
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Bytes on macOS, KB on Linux
+    return round(peak / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+
+def percentile(latencies, fraction):
+    """Nearest-rank percentile of a sorted list."""
+    if not latencies:
+        return None
+    return latencies[min(len(latencies) - 1, int(fraction * len(latencies)))]
+
+
+def summarize(scenario, latencies, errors, elapsed, received, rss):
+    latencies = sorted(latencies)
+    # Errors (503s from a full route class, ...) answer faster than real work: their latencies would be misleading
+    timed = latencies if not errors else []
+    return {'name': scenario.name,
+            'method': scenario.method,
+            'path': scenario.build(0)[0],
+            'requests': len(latencies),
+            'errors': errors,
+            'p50_ms': round(percentile(timed, 0.50) * 1000, 3) if timed else None,
+            'p99_ms': round(percentile(timed, 0.99) * 1000, 3) if timed else None,
+            'mean_ms': round(sum(timed) / len(timed) * 1000, 3) if timed else None,
+            'throughput_rps': round(len(latencies) / elapsed, 1) if elapsed > 0 else None,
+            'mean_response_bytes': round(received / len(latencies)) if latencies else None,
+            'peak_rss_mb': rss}
+
+
+def run_client(app, scenario, count, headers):
+    """Send `count` requests one after another through Flask's test client (no network, no threads)."""
+    client = app.test_client()
+    latencies = []
+    errors = 0
+    received = 0
+    started = time.perf_counter()
+    for i in range(count):
+        path, body = scenario.build(i)
+        begin = time.perf_counter()
+        response = client.open(path, method=scenario.method, json=body, headers=headers)
+        # Streamed responses are only produced when read
+        received += len(response.get_data())
+        latencies.append(time.perf_counter() - begin)
+        if response.status_code >= 400:
+            errors += 1
+    return latencies, errors, time.perf_counter() - started, received
+
+
+def run_http(host, port, scenario, count, threads, headers):
+    """Send `count` requests from `threads` threads, each with its own keep-alive connection."""
+    latencies = []
+    errors = [0]
+    received = [0]
+    lock = threading.Lock()
+    next_request = iter(range(count))
+
+    def worker():
+        connection = http.client.HTTPConnection(host, port, timeout=300)
+        local_latencies = []
+        local_errors = 0
+        local_received = 0
+        while True:
+            with lock:
+                i = next(next_request, None)
+            if i is None:
+                break
+            path, body = scenario.build(i)
+            request_headers = dict(headers)
+            payload = None
+            if body is not None:
+                payload = json.dumps(body).encode('utf-8')
+                request_headers['Content-Type'] = 'application/json'
+            begin = time.perf_counter()
+            try:
+                connection.request(scenario.method, path, body=payload, headers=request_headers)
+                response = connection.getresponse()
+                local_received += len(response.read())
+                status = response.status
+            except (OSError, http.client.HTTPException):
+                # Reconnect, the server may have closed the connection
+                connection.close()
+                connection = http.client.HTTPConnection(host, port, timeout=300)
+                status = 599
+            local_latencies.append(time.perf_counter() - begin)
+            if status >= 400:
+                local_errors += 1
+        connection.close()
+        with lock:
+            latencies.extend(local_latencies)
+            errors[0] += local_errors
+            received[0] += local_received
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    started = time.perf_counter()
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies, errors[0], time.perf_counter() - started, received[0]
+
+
+def run(args):
+    """Generate a dataset (unless --data-dir is given), drive every route and write the results as JSON."""
+    from main import create_app
+    temp_dir = None
+    data_dir = args.data_dir
+    if data_dir is None:
+        temp_dir = data_dir = tempfile.mkdtemp(prefix='api-bench-')
+    overrides = {'DATA_DIR': data_dir, 'STORAGE_BACKEND': args.backend, 'RECORD_CODEC': args.codec,
+                 'FILE_LAYOUT': args.layout, 'SQLITE_PATH': None, 'PROFILE_SLOW_MS': 0}
+    if not args.admission:
+        # The routes are measured, not the admission limits: a full route class would answer 503s
+        overrides.update({f'ADMISSION_{route_class}_LIMIT': 0 for route_class in ('READ', 'LIST', 'WRITE', 'BULK', 'STREAM')})
+        overrides['RATE_LIMIT_PER_SECOND'] = 0
+        # Room in the password queue for a full batch from every thread
+        overrides['PASSWORD_QUEUE_MAX'] = max(config.PASSWORD_QUEUE_MAX, args.threads * config.PASSWORD_BATCH_MAX)
+    settings = load_settings(overrides)
+    try:
+        if temp_dir is not None:
+            started = time.perf_counter()
+            generate(settings, args.size)
+            print(f'Generated {args.size} users in {time.perf_counter() - started:.1f}s', file=sys.stderr)
+        with open(os.path.join(data_dir, 'bench.json'), 'r', encoding='utf-8') as f:
+            sizes = json.load(f)
+        users, companies = sizes['users'], sizes['companies']
+        started = time.perf_counter()
+        app = create_app(settings)
+        startup = time.perf_counter() - started
+        change_seq = get_store().change_bounds()[1]
+        server = None
+        if args.mode == 'http' and args.url is None:
+            from werkzeug.serving import make_server
+            # One access log line per request would be most of the work
+            logging.getLogger('werkzeug').setLevel(logging.ERROR)
+            server = make_server('127.0.0.1', 0, app, threaded=True)
+            threading.Thread(target=server.serve_forever, daemon=True).start()
+            host, port = '127.0.0.1', server.server_port
+        elif args.mode == 'http':
+            host, port = args.url.split('://')[-1].rstrip('/').split(':')
+            port = int(port)
+        selected = set(args.only.split(',')) if args.only else None
+        # Response sizes are measured as sent, compressed when the encoding is accepted
+        headers = {'Accept-Encoding': args.accept_encoding} if args.accept_encoding else {}
+        results = []
+        for scenario in scenarios(users, companies, change_seq):
+            if selected is not None and scenario.name not in selected:
+                continue
+            count = args.heavy_requests if scenario.heavy else args.requests
+            if scenario.max_requests is not None:
+                count = min(count, scenario.max_requests)
+            reset_peak_rss()
+            if args.mode == 'client':
+                latencies, errors, elapsed, received = run_client(app, scenario, count, headers)
+            else:
+                latencies, errors, elapsed, received = run_http(host, port, scenario, count, args.threads, headers)
+            # Only meaningful when the server runs in this process
+            rss = peak_rss_mb() if args.url is None else None
+            result = summarize(scenario, latencies, errors, elapsed, received, rss)
+            results.append(result)
+            print(f"{result['name']:<26} p50 {str(result['p50_ms']):>10} ms  p99 {str(result['p99_ms']):>10} ms  "
+                  f"{str(result['throughput_rps']):>9} req/s  {result['errors']} errors", file=sys.stderr)
+        if server is not None:
+            server.shutdown()
+    finally:
+        if temp_dir is not None and not args.keep:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+    report = {'meta': {'timestamp': datetime.now(timezone.utc).isoformat(),
+                       'size': users,
+                       'companies': companies,
+                       'backend': args.backend,
+                       'codec': args.codec,
+                       'layout': args.layout,
+                       'mode': args.mode,
+                       'threads': args.threads if args.mode == 'http' else 1,
+                       'admission': args.admission,
+                       'accept_encoding': args.accept_encoding,
+                       'requests': args.requests,
+                       'heavy_requests': args.heavy_requests,
+                       'startup_s': round(startup, 3),
+                       'python': platform.python_version(),
+                       'platform': platform.platform(),
+                       'cpus': os.cpu_count()},
+              'results': results}
+    output = json.dumps(report, indent=4)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+
+def compare(args):
+    """Compare two result files and exit with status 1 if an endpoint got slower than the tolerance."""
+    with open(args.baseline, 'r', encoding='utf-8') as f:
+        baseline = {result['name']: result for result in json.load(f)['results']}
+    with open(args.current, 'r', encoding='utf-8') as f:
+        current = json.load(f)['results']
+    regressions = 0
+    for result in current:
+        before = baseline.get(result['name'])
+        if before is None or not before[args.metric] or result[args.metric] is None:
+            continue
+        ratio = result[args.metric] / before[args.metric]
+        regressed = ratio > 1 + args.tolerance
+        regressions += regressed
+        print(f"{result['name']:<26} {before[args.metric]:>10} -> {result[args.metric]:>10} ms  "
+              f"x{ratio:.2f}{'  REGRESSION' if regressed else ''}")
+    if regressions:
+        raise SystemExit(1)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks of the API routes on synthetic datasets.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser('run', help='Generate a dataset, load-test every route and report as JSON')
+    run_parser.add_argument('--size', type=parse_size, default=SIZES['1k'], help='1k, 100k, 1M or a number of users')
+    run_parser.add_argument('--backend', default=config.STORAGE_BACKEND, choices=['files', 'sqlite', 'log'])
+    run_parser.add_argument('--codec', default=config.RECORD_CODEC, choices=['json', 'orjson', 'msgpack'])
+    run_parser.add_argument('--layout', default=config.FILE_LAYOUT, choices=['flat', 'sharded'],
+                            help="Directory layout of the 'files' backend")
+    run_parser.add_argument('--mode', default='client', choices=['client', 'http'],
+                            help="'client': Flask's test client, 'http': real HTTP requests from --threads threads")
+    run_parser.add_argument('--threads', type=int, default=8)
+    run_parser.add_argument('--admission', action='store_true',
+                            help='Keep the configured admission limits and rate limit (off by default)')
+    run_parser.add_argument('--accept-encoding', help="Accept-Encoding header of the requests, e.g. 'gzip, br'")
+    run_parser.add_argument('--url', help='In http mode, test this running server instead of starting one')
+    run_parser.add_argument('--requests', type=int, default=200, help='Requests per endpoint')
+    run_parser.add_argument('--heavy-requests', type=int, default=5, help='Requests per full listing endpoint')
+    run_parser.add_argument('--only', help='Comma-separated scenario names')
+    run_parser.add_argument('--data-dir', help='Use this generated dataset instead of a new temporary one '
+                                               '(it is modified by the write scenarios)')
+    run_parser.add_argument('--keep', action='store_true', help='Keep the temporary dataset')
+    run_parser.add_argument('--output', help='Write the JSON results to this file instead of stdout')
+    run_parser.set_defaults(func=run)
+
+    generate_parser = subparsers.add_parser('generate', help='Only generate a synthetic dataset')
+    generate_parser.add_argument('--size', type=parse_size, default=SIZES['1k'])
+    generate_parser.add_argument('--backend', default=config.STORAGE_BACKEND, choices=['files', 'sqlite', 'log'])
+    generate_parser.add_argument('--codec', default=config.RECORD_CODEC, choices=['json', 'orjson', 'msgpack'])
+    generate_parser.add_argument('--layout', default=config.FILE_LAYOUT, choices=['flat', 'sharded'])
+    generate_parser.add_argument('--data-dir', required=True)
+    generate_parser.set_defaults(func=lambda args: print(
+        generate(load_settings({'DATA_DIR': args.data_dir, 'STORAGE_BACKEND': args.backend,
+                                'RECORD_CODEC': args.codec, 'FILE_LAYOUT': args.layout, 'SQLITE_PATH': None}),
+                 args.size), 'companies'))
+
+    compare_parser = subparsers.add_parser('compare', help='Compare two result files, exit 1 on a regression')
+    compare_parser.add_argument('baseline')
+    compare_parser.add_argument('current')
+    compare_parser.add_argument('--metric', default='p99_ms', choices=['p50_ms', 'p99_ms', 'mean_ms'])
+    compare_parser.add_argument('--tolerance', type=float, default=0.2, help='Allowed slowdown, 0.2 = 20%%')
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,111 @@
+import os
+
+# Root of the project, the directory above src/
+PROJECT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Directory holding the data files, one subdirectory per entity
+DATA_DIR = os.environ.get('DATA_DIR', os.path.join(PROJECT_DIR, 'data'))
+
+# Storage backend used by the routes: 'files' (one JSON file per record), 'sqlite'
+# or 'log' (records appended to segment files, see storage/log.py)
+STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND', 'files')
+
+# Database file used by the 'sqlite' backend (default: DATA_DIR/api.sqlite3)
+SQLITE_PATH = os.environ.get('SQLITE_PATH')
+
+# Codec used to write records: 'json' (compact), 'orjson' or 'msgpack' (when installed)
+RECORD_CODEC = os.environ.get('RECORD_CODEC', 'json')
+
+# fsync every record written by the 'files' backend before it replaces the old version
+FSYNC_WRITES = os.environ.get('FSYNC_WRITES', '1') == '1'
+
+# Layout of the record files of the 'files' backend: 'flat' (<entity>/<id>.json) or 'sharded'
+# (<entity>/ab/cd/<id>.json, for millions of records). `manage.py reshard` moves an existing tree
+FILE_LAYOUT = os.environ.get('FILE_LAYOUT', 'flat')
+
+# Size at which the 'log' backend starts a new segment file, in bytes
+LOG_SEGMENT_BYTES = int(os.environ.get('LOG_SEGMENT_BYTES', 64 * 1024 * 1024))
+
+# The 'log' backend rewrites its closed segments once this fraction of them is overwritten or deleted
+# records, checking every LOG_COMPACT_INTERVAL seconds (0 disables the background compaction)
+LOG_COMPACT_RATIO = float(os.environ.get('LOG_COMPACT_RATIO', 0.5))
+LOG_COMPACT_INTERVAL = int(os.environ.get('LOG_COMPACT_INTERVAL', 60))
+
+# Also lock records with fcntl file locks, needed when several processes share DATA_DIR
+FILE_LOCKS = os.environ.get('FILE_LOCKS', '0') == '1'
+
+# Largest number of items accepted by the batch endpoints
+BATCH_MAX_SIZE = int(os.environ.get('BATCH_MAX_SIZE', 10000))
+
+# Limits of the record cache of the 'files' backend
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 10000))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 64 * 1024 * 1024))
+
+# How the record cache and the indexes of the 'files' backend notice the writes of other processes: 'stat'
+# checks the record file on each read, which also notices edits made outside the API. 'inotify' or 'poll'
+# watch the change log instead (one syscall per request, cached records are served from memory) but only
+# see writes made through the API or manage.py, 'auto' picks inotify when available
+CACHE_COHERENCE = os.environ.get('CACHE_COHERENCE', 'stat')
+
+# Threads reading record files in parallel (list endpoints, cache warm-up), 1 to read on the request thread
+IO_THREADS = int(os.environ.get('IO_THREADS', 16))
+
+# Smallest JSON response compressed with gzip or brotli, in bytes
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+
+# Total size of the cached list response bodies (serialized and compressed), in bytes
+SNAPSHOT_CACHE_BYTES = int(os.environ.get('SNAPSHOT_CACHE_BYTES', 64 * 1024 * 1024))
+
+# Records of each entity read into the cache at startup (the most recent ones), 0 to disable
+CACHE_WARM_RECORDS = int(os.environ.get('CACHE_WARM_RECORDS', 0))
+
+# Writes kept in the change log read by `?since=` and /changes/stream, older ones are discarded
+CHANGELOG_MAX_ENTRIES = int(os.environ.get('CHANGELOG_MAX_ENTRIES', 100000))
+
+# How often a /changes/stream connection looks for new writes, and how long it stays open before
+# the client reconnects (with Last-Event-ID), in seconds
+CHANGES_POLL_SECONDS = float(os.environ.get('CHANGES_POLL_SECONDS', 0.5))
+CHANGES_STREAM_SECONDS = int(os.environ.get('CHANGES_STREAM_SECONDS', 300))
+
+# Processes hashing and verifying passwords (per server process), 0 to hash on the request thread. By default
+# the cores are split between the WEB_CONCURRENCY server processes, so all the pools together use each core once
+PASSWORD_HASH_WORKERS = int(os.environ.get('PASSWORD_HASH_WORKERS',
+                                           max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', 1)))))
+
+# Passwords allowed to wait or be hashed or checked at once (per server process), the next operations get a 503
+PASSWORD_QUEUE_MAX = int(os.environ.get('PASSWORD_QUEUE_MAX', 256))
+
+# Passwords one batch request may set, larger batches get a 413. Keep it below PASSWORD_QUEUE_MAX, each
+# password of a batch takes a place in the queue (about 30 ms of a core each with the default work factor)
+PASSWORD_BATCH_MAX = int(os.environ.get('PASSWORD_BATCH_MAX', 100))
+
+# scrypt work factor (a power of 2): doubling it doubles the time and memory of each hash
+PASSWORD_SCRYPT_N = int(os.environ.get('PASSWORD_SCRYPT_N', 2 ** 14))
+
+# Requests of each route class (see routes/admission.py) running at once in a server process, 0 for no limit.
+# Cheap reads of one record are not limited by default: the slow classes can't take every thread from them.
+# With the queue below, a client sending 8 requests at once to one class is slowed down, never refused
+ADMISSION_READ_LIMIT = int(os.environ.get('ADMISSION_READ_LIMIT', 0))
+ADMISSION_LIST_LIMIT = int(os.environ.get('ADMISSION_LIST_LIMIT', 8))
+ADMISSION_WRITE_LIMIT = int(os.environ.get('ADMISSION_WRITE_LIMIT', 8))
+ADMISSION_BULK_LIMIT = int(os.environ.get('ADMISSION_BULK_LIMIT', 4))
+ADMISSION_STREAM_LIMIT = int(os.environ.get('ADMISSION_STREAM_LIMIT', 4))
+
+# Requests of a full route class allowed to wait for a place, for at most ADMISSION_QUEUE_TIMEOUT seconds.
+# The next ones, and those waiting longer, get a 503 with Retry-After
+ADMISSION_QUEUE_MAX = int(os.environ.get('ADMISSION_QUEUE_MAX', 8))
+ADMISSION_QUEUE_TIMEOUT = float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10.0))
+
+# Requests per second allowed to each client (IP address) on average, in bursts of up to RATE_LIMIT_BURST,
+# per server process. 0 disables the rate limit
+RATE_LIMIT_PER_SECOND = float(os.environ.get('RATE_LIMIT_PER_SECOND', 0))
+RATE_LIMIT_BURST = int(os.environ.get('RATE_LIMIT_BURST', 20))
+
+# Requests slower than this many milliseconds are profiled with cProfile, 0 to disable
+PROFILE_SLOW_MS = int(os.environ.get('PROFILE_SLOW_MS', 0))
+
+# Fraction of the requests run under the profiler when PROFILE_SLOW_MS is set (profiling slows them down)
+PROFILE_SAMPLE_RATE = float(os.environ.get('PROFILE_SAMPLE_RATE', 1.0))
+
+# Directory receiving one .prof file (pstats format) per slow profiled request
+PROFILE_DIR = os.environ.get('PROFILE_DIR', os.path.join(PROJECT_DIR, 'profiles'))
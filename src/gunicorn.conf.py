@@ -0,0 +1,32 @@
+import os
+import multiprocessing
+
+# Production serving: gunicorn -c gunicorn.conf.py (run from src/)
+
+# Application and address
+wsgi_app = 'wsgi:app'
+bind = os.environ.get('BIND', '0.0.0.0:5000')
+
+# One worker process per core, each with threads for requests waiting on disk. Keep the threads above the
+# admission limits and queues of the slow route classes (see config.py), so reads always find a free one
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count()))
+threads = int(os.environ.get('WEB_THREADS', 64))
+
+# config.py splits the cores between the workers' password pools using the worker count
+os.environ.setdefault('WEB_CONCURRENCY', str(workers))
+
+# Build the app (load indexes, sequences and the warm cache) once in the master, workers inherit it on fork
+preload_app = True
+
+# Graceful recycling: a worker is replaced after serving this many requests (jitter keeps them
+# from restarting together) and gets graceful_timeout seconds to finish the requests in progress
+max_requests = int(os.environ.get('MAX_REQUESTS', 10000))
+max_requests_jitter = int(os.environ.get('MAX_REQUESTS_JITTER', 1000))
+graceful_timeout = int(os.environ.get('GRACEFUL_TIMEOUT', 30))
+timeout = int(os.environ.get('TIMEOUT', 60))
+
+
+def post_fork(server, worker):
+    from storage.engine import get_store
+    # Give the worker its own locks, ID blocks and database connections
+    get_store().after_fork()
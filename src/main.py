@@ -1,58 +1,45 @@
 from flask import Flask
-from routes.companies import create_company, get_companies, get_company, delete_company, update_full_company, update_any_field_company
-from routes.users import create_user, get_users, get_user, delete_user, update_full_user, update_any_field_user
+from routes.companies import companies_bp
+from routes.users import users_bp
+from routes.stats import stats_bp
+from routes.changes import changes_bp
+from routes.metrics import metrics_bp, instrument
+from routes.compression import enable_compression
+from routes.admission import enable_admission
+from storage.engine import create_store, set_store
+from passwords import PasswordHasher
+import config
 
 # pylint: disable=C0301, C0114, W0718, C0114, C0116
 
-app = Flask(__name__)
 
-@app.route('/companies', methods=['POST'])
-def create_company():
-    return create_company()
+def create_app(settings=None):
+    """Build the application. `settings` overrides the values of config.py (DATA_DIR, STORAGE_BACKEND...)."""
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config.update(settings or {})
+    # Open the storage backend (sequences, indexes, connections) once, before serving requests.
+    # Under a pre-fork server this runs in the master and every worker inherits the loaded state
+    store = create_store(app.config)
+    store.load()
+    if app.config['CACHE_WARM_RECORDS'] > 0:
+        store.warm_cache(app.config['CACHE_WARM_RECORDS'])
+    set_store(store)
+    # Password hashing pool, its processes start with the first password hashed
+    app.extensions['passwords'] = PasswordHasher(app.config['PASSWORD_HASH_WORKERS'], app.config['PASSWORD_QUEUE_MAX'],
+                                                 app.config['PASSWORD_SCRYPT_N'])
+    app.register_blueprint(companies_bp)
+    app.register_blueprint(users_bp)
+    app.register_blueprint(stats_bp)
+    app.register_blueprint(changes_bp)
+    app.register_blueprint(metrics_bp)
+    instrument(app)
+    # After instrument(): the time waited for a place counts in the request latency, and refused requests are counted
+    enable_admission(app)
+    enable_compression(app)
+    return app
 
-@app.route('/users', methods=['POST'])
-def create_user():
-    return create_user()
-
-@app.route('/users', methods=['GET'])
-def get_users():
-    return get_users()
-
-@app.route('/users/<int:user_id>', methods=['GET'])
-def get_user(user_id):
-    return get_user(user_id)
-
-@app.route('/companies', methods=['GET'])
-def get_companies():
-    return get_companies()
-
-@app.route('/companies/<int:company_id>', methods=['GET'])
-def get_company(company_id):
-    return get_company(company_id)
-
-@app.route('/users/<int:user_id>', methods=['DELETE'])
-def delete_user(user_id):
-    return delete_user(user_id)
-
-@app.route('/companies/<int:company_id>', methods=['DELETE'])
-def delete_company(company_id):
-    return delete_company(company_id)
-
-@app.route('/users/<int:user_id>', methods=['PUT'])
-def update_full_user(user_id):
-    return update_full_user(user_id)
-
-@app.route('/users/<int:user_id>', methods=['PATCH'])
-def update_any_field_user(user_id):
-    return update_any_field_user(user_id)
-
-@app.route('/companies/<int:company_id>', methods=['PUT'])
-def update_full_company(company_id):
-    return update_full_company(company_id)
-
-@app.route('/companies/<int:company_id>', methods=['PATCH'])
-def update_any_field_company(company_id):
-    return update_any_field_company(company_id)
 
 if __name__ == '__main__':
-    app.run(debug=True, threaded=True)
+    # Development server, see gunicorn.conf.py to serve with one process per core
+    create_app().run(debug=True, threaded=True)
@@ -0,0 +1,147 @@
+import argparse
+import config
+from storage.engine import create_store, load_settings
+from passwords import PasswordHasher, is_hashed
+
+
+def put_all(store, entity, batch):
+    """Save a batch of records, stopping at the first one refused (a duplicate unique value)."""
+    for error in store.bulk_put(entity, batch):
+        if error is not None:
+            raise error
+
+
+def copy_records(source, target, entity, batch_size):
+    """Write every record of `source` into `target` in batches and return how many were copied."""
+    batch = []
+    count = 0
+    for record in source.scan(entity):
+        batch.append(record)
+        if len(batch) >= batch_size:
+            put_all(target, entity, batch)
+            count += len(batch)
+            batch = []
+    if batch:
+        put_all(target, entity, batch)
+        count += len(batch)
+    return count
+
+
+def migrate(args):
+    """Copy every record from one storage backend into another, keeping the IDs."""
+    if args.source == args.target:
+        raise SystemExit('--from and --to must be different backends')
+    paths = {'DATA_DIR': args.data_dir, 'SQLITE_PATH': args.sqlite_path}
+    source = create_store(load_settings(dict(paths, STORAGE_BACKEND=args.source)))
+    target = create_store(load_settings(dict(paths, STORAGE_BACKEND=args.target)))
+    source.load()
+    target.load()
+    # Companies first, users reference them
+    for entity in ('companies', 'users'):
+        count = copy_records(source, target, entity, args.batch_size)
+        print(f'{entity}: {count} records copied')
+    source.close()
+    target.close()
+
+
+def rewrite(args):
+    """Re-encode every record of a store with the given codec."""
+    store = create_store(load_settings({'STORAGE_BACKEND': args.backend, 'RECORD_CODEC': args.codec,
+                                        'DATA_DIR': args.data_dir, 'SQLITE_PATH': args.sqlite_path}))
+    store.load()
+    for entity in ('companies', 'users'):
+        count = copy_records(store, store, entity, args.batch_size)
+        print(f'{entity}: {count} records rewritten as {store.codec.name}')
+    store.close()
+
+
+def hash_passwords(args):
+    """Replace the passwords still stored in plaintext by their hash."""
+    store = create_store(load_settings({'STORAGE_BACKEND': args.backend, 'DATA_DIR': args.data_dir,
+                                        'SQLITE_PATH': args.sqlite_path}))
+    store.load()
+    hasher = PasswordHasher(args.workers, args.batch_size, config.PASSWORD_SCRYPT_N)
+    count = 0
+    # Every record is read before any is written back, scan() must not see its own writes
+    plaintext = [record for record in store.scan('users') if not is_hashed(record.get('password'))]
+    for start in range(0, len(plaintext), args.batch_size):
+        batch = plaintext[start:start + args.batch_size]
+        for record, hashed in zip(batch, hasher.hash_many(record['password'] for record in batch)):
+            record['password'] = hashed
+        store.bulk_put('users', batch)
+        count += len(batch)
+    print(f'users: {count} passwords hashed')
+    hasher.close()
+    store.close()
+
+
+def reshard(args):
+    """Move the record files of the 'files' backend to another directory layout, while the API keeps running."""
+    store = create_store(load_settings({'STORAGE_BACKEND': 'files', 'DATA_DIR': args.data_dir,
+                                        'FILE_LAYOUT': args.layout}))
+    store.load()
+    for entity in ('companies', 'users'):
+        count = store.reshard(entity)
+        print(f'{entity}: {count} files moved to the {args.layout} layout')
+    store.close()
+
+
+def compact(args):
+    """Rewrite the closed segments of the 'log' backend without their overwritten and deleted records."""
+    store = create_store(load_settings({'STORAGE_BACKEND': 'log', 'DATA_DIR': args.data_dir,
+                                        'LOG_COMPACT_INTERVAL': 0}))
+    store.load()
+    before = store.stats()['log']
+    store.write_hints()
+    if store.compact():
+        after = store.stats()['log']
+        print(f"{before['segments']} segments, {before['bytes']} bytes -> {after['segments']} segments, {after['bytes']} bytes")
+    else:
+        print('Nothing to compact (no closed segment, or another process is compacting)')
+    store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Maintenance commands for the API data store.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    migrate_parser = subparsers.add_parser('migrate', help='Import the data of one storage backend into another')
+    migrate_parser.add_argument('--from', dest='source', default='files', choices=['files', 'sqlite', 'log'])
+    migrate_parser.add_argument('--to', dest='target', default='sqlite', choices=['files', 'sqlite', 'log'])
+    migrate_parser.add_argument('--data-dir', default=config.DATA_DIR)
+    migrate_parser.add_argument('--sqlite-path', default=config.SQLITE_PATH)
+    migrate_parser.add_argument('--batch-size', type=int, default=1000)
+    migrate_parser.set_defaults(func=migrate)
+
+    rewrite_parser = subparsers.add_parser('rewrite', help='Re-encode every record with another codec')
+    rewrite_parser.add_argument('--backend', default=config.STORAGE_BACKEND, choices=['files', 'sqlite', 'log'])
+    rewrite_parser.add_argument('--codec', default=config.RECORD_CODEC, choices=['json', 'orjson', 'msgpack'])
+    rewrite_parser.add_argument('--data-dir', default=config.DATA_DIR)
+    rewrite_parser.add_argument('--sqlite-path', default=config.SQLITE_PATH)
+    rewrite_parser.add_argument('--batch-size', type=int, default=1000)
+    rewrite_parser.set_defaults(func=rewrite)
+
+    hash_parser = subparsers.add_parser('hash-passwords', help='Hash the passwords stored in plaintext')
+    hash_parser.add_argument('--backend', default=config.STORAGE_BACKEND, choices=['files', 'sqlite', 'log'])
+    hash_parser.add_argument('--data-dir', default=config.DATA_DIR)
+    hash_parser.add_argument('--sqlite-path', default=config.SQLITE_PATH)
+    hash_parser.add_argument('--workers', type=int, default=config.PASSWORD_HASH_WORKERS)
+    hash_parser.add_argument('--batch-size', type=int, default=1000)
+    hash_parser.set_defaults(func=hash_passwords)
+
+    reshard_parser = subparsers.add_parser('reshard',
+                                           help="Move the record files of the 'files' backend to another layout")
+    reshard_parser.add_argument('--layout', default='sharded', choices=['flat', 'sharded'])
+    reshard_parser.add_argument('--data-dir', default=config.DATA_DIR)
+    reshard_parser.set_defaults(func=reshard)
+
+    compact_parser = subparsers.add_parser('compact', help="Compact the segments of the 'log' backend now")
+    compact_parser.add_argument('--data-dir', default=config.DATA_DIR)
+    compact_parser.set_defaults(func=compact)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,179 @@
+import threading
+import contextvars
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _labels(names, values):
+    if not names:
+        return ''
+    pairs = []
+    for name, value in zip(names, values):
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        pairs.append(f'{name}="{value}"')
+    return '{' + ','.join(pairs) + '}'
+
+
+class Counter:
+    """Monotonic counter, one value per combination of label values."""
+
+    kind = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, *label_values, amount=1):
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labels, label_values)} {value}'
+
+
+class Histogram:
+    """Distribution of observed values (latencies), in cumulative buckets as Prometheus expects."""
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        # label values -> [count per bucket..., count above the last bucket, sum]
+        self._values = {}
+
+    def observe(self, value, *label_values):
+        with self._lock:
+            counts = self._values.get(label_values)
+            if counts is None:
+                counts = self._values[label_values] = [0] * (len(self.buckets) + 1) + [0.0]
+            for position, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[position] += 1
+                    break
+            else:
+                counts[len(self.buckets)] += 1
+            counts[-1] += value
+
+    def samples(self):
+        with self._lock:
+            values = {label_values: list(counts) for label_values, counts in self._values.items()}
+        names = self.labels + ('le',)
+        for label_values, counts in sorted(values.items()):
+            total = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                total += count
+                yield f'{self.name}_bucket{_labels(names, label_values + (bound,))} {total}'
+            yield f'{self.name}_sum{_labels(self.labels, label_values)} {counts[-1]}'
+            yield f'{self.name}_count{_labels(self.labels, label_values)} {total}'
+
+
+class Gauge:
+    """Value that can go up and down, set when the metrics are collected."""
+
+    kind = 'gauge'
+
+    def __init__(self, name, description, labels=()):
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def set(self, value, *label_values):
+        with self._lock:
+            self._values[label_values] = value
+
+    def samples(self):
+        with self._lock:
+            values = dict(self._values)
+        for label_values, value in sorted(values.items()):
+            yield f'{self.name}{_labels(self.labels, label_values)} {value}'
+
+
+# Metrics of the HTTP requests, labeled by method and route (the URL rule, e.g. /users/<int:user_id>)
+REQUESTS = Counter('http_requests_total', 'Requests served, by status code', ('method', 'route', 'status'))
+LATENCY = Histogram('http_request_duration_seconds', 'Time to build the response', ('method', 'route'))
+
+# Storage I/O done while serving each route
+FILES_OPENED = Counter('storage_files_opened_total', 'Record files opened', ('method', 'route'))
+LISTDIRS = Counter('storage_listdir_total', 'Data directories listed', ('method', 'route'))
+BYTES_READ = Counter('storage_bytes_read_total', 'Record bytes read', ('method', 'route'))
+BYTES_WRITTEN = Counter('storage_bytes_written_total', 'Record bytes written', ('method', 'route'))
+
+# Password hashing pool (see passwords.py), labeled by operation: hash, hash_batch or verify
+PASSWORD_HASH_LATENCY = Histogram('password_hash_duration_seconds', 'Time to hash or verify passwords, queue wait included',
+                                  ('operation',))
+PASSWORD_QUEUE_DEPTH = Gauge('password_hash_queue_depth', 'Password operations waiting or running in the pool')
+PASSWORD_REJECTED = Counter('password_hash_rejected_total', 'Password operations refused because the queue was full',
+                            ('operation',))
+
+# Admission control (see routes/admission.py), labeled by route class: read, list, write, bulk or stream
+ADMISSION_ACTIVE = Gauge('admission_active_requests', 'Requests running, by route class', ('route_class',))
+ADMISSION_QUEUED = Gauge('admission_queued_requests', 'Requests waiting for a place in their route class',
+                         ('route_class',))
+ADMISSION_WAIT = Histogram('admission_wait_seconds', 'Time queued requests waited for a place', ('route_class',))
+ADMISSION_REJECTED = Counter('admission_rejected_total',
+                             'Requests refused: queue_full or timeout (503), rate_limited (429)',
+                             ('route_class', 'reason'))
+
+METRICS = [REQUESTS, LATENCY, FILES_OPENED, LISTDIRS, BYTES_READ, BYTES_WRITTEN,
+           PASSWORD_HASH_LATENCY, PASSWORD_QUEUE_DEPTH, PASSWORD_REJECTED,
+           ADMISSION_ACTIVE, ADMISSION_QUEUED, ADMISSION_WAIT, ADMISSION_REJECTED]
+
+
+class IoCounts:
+    """Storage I/O done by one request, including the reads it hands to the I/O pool."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.files_opened = 0
+        self.listdirs = 0
+        self.bytes_read = 0
+        self.bytes_written = 0
+
+    def add(self, files_opened, listdirs, bytes_read, bytes_written):
+        with self._lock:
+            self.files_opened += files_opened
+            self.listdirs += listdirs
+            self.bytes_read += bytes_read
+            self.bytes_written += bytes_written
+
+
+# I/O counts of the request being served. A context variable, so the I/O pool threads can inherit it
+_request_io = contextvars.ContextVar('request_io', default=None)
+
+
+def start_request_io():
+    """Start counting the storage I/O of the current request and return its IoCounts."""
+    counts = IoCounts()
+    _request_io.set(counts)
+    return counts
+
+
+def count_io(files_opened=0, listdirs=0, bytes_read=0, bytes_written=0):
+    """Called by the storage backends for every file opened, directory listed and record read or written."""
+    counts = _request_io.get()
+    # I/O outside a request (startup, manage.py) is not counted
+    if counts is not None:
+        counts.add(files_opened, listdirs, bytes_read, bytes_written)
+
+
+def render(extra=()):
+    """Return every metric, plus `extra` ones, in the Prometheus text format."""
+    lines = []
+    for metric in list(METRICS) + list(extra):
+        lines.append(f'# HELP {metric.name} {metric.description}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,149 @@
+import os
+import hmac
+import time
+import base64
+import hashlib
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import metrics
+
+# Prefix of the stored hashes. Anything else is a password saved in plaintext before hashing existed
+SCHEME = 'scrypt'
+
+
+class PasswordQueueFull(RuntimeError):
+    """Raised when too many password operations are already waiting for the pool."""
+
+
+def _b64(data):
+    return base64.b64encode(data).decode('ascii')
+
+
+def _scrypt(password, salt, n, r, p):
+    # Memory used by scrypt is about 128 * r * n bytes, the default limit (32MB) is too low for large n
+    return hashlib.scrypt(password.encode('utf-8'), salt=salt, n=n, r=r, p=p, dklen=32,
+                          maxmem=128 * r * (n + p + 2) + 1024 * 1024)
+
+
+def hash_password(password, n, r, p):
+    """Return the stored form of a password: scrypt$n$r$p$salt$hash."""
+    salt = os.urandom(16)
+    return f'{SCHEME}${n}${r}${p}${_b64(salt)}${_b64(_scrypt(password, salt, n, r, p))}'
+
+
+def hash_passwords(passwords, n, r, p):
+    """hash_password() of several passwords, run as one task of the pool."""
+    return [hash_password(password, n, r, p) for password in passwords]
+
+
+def is_hashed(stored):
+    return isinstance(stored, str) and stored.startswith(f'{SCHEME}$')
+
+
+def verify_password(password, stored):
+    """Tell whether `password` matches the stored hash (or the plaintext of an old record)."""
+    if not isinstance(stored, str):
+        return False
+    if not is_hashed(stored):
+        return hmac.compare_digest(password.encode('utf-8'), stored.encode('utf-8'))
+    try:
+        _, n, r, p, salt, expected = stored.split('$')
+        digest = _scrypt(password, base64.b64decode(salt), int(n), int(r), int(p))
+    except ValueError:
+        return False
+    return hmac.compare_digest(digest, base64.b64decode(expected))
+
+
+class PasswordHasher:
+    """Hashes and checks passwords on a pool of processes, so the slow hashing never holds the GIL
+    of the request threads and uses every core.
+
+    At most `queue_max` passwords wait or are hashed or checked at once (a
+    batch counts each of its passwords), the next operations raise
+    PasswordQueueFull instead of piling up. With `workers` set to 0 the hashing
+    runs on the request thread.
+    """
+
+    def __init__(self, workers, queue_max, n=2 ** 14, r=8, p=1):
+        self.workers = workers
+        self.queue_max = queue_max
+        self.n = n
+        self.r = r
+        self.p = p
+        self._lock = threading.Lock()
+        self._pending = 0
+        self._executor = None
+        self._pid = None
+        metrics.PASSWORD_QUEUE_DEPTH.set(0)
+
+    def _get_executor(self):
+        """Return the pool of this process, started on first use (so after a pre-fork server forks)."""
+        if self.workers < 1:
+            return None
+        if self._executor is None or self._pid != os.getpid():
+            # A worker process inherits no usable pool from its parent, start its own.
+            # forkserver starts the hashing processes from a clean one, not from this threaded process
+            methods = multiprocessing.get_all_start_methods()
+            context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+            self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+            self._pid = os.getpid()
+        return self._executor
+
+    def _run(self, operation, tasks, places=1):
+        """Run (function, args) tasks on the pool and return their results. They take `places` in the queue."""
+        with self._lock:
+            if self._pending + places > self.queue_max:
+                metrics.PASSWORD_REJECTED.inc(operation)
+                raise PasswordQueueFull('Too many password operations in progress')
+            self._pending += places
+            metrics.PASSWORD_QUEUE_DEPTH.set(self._pending)
+            executor = self._get_executor()
+        start = time.perf_counter()
+        try:
+            if executor is None:
+                return [function(*args) for function, args in tasks]
+            futures = [executor.submit(function, *args) for function, args in tasks]
+            return [future.result() for future in futures]
+        except BrokenProcessPool:
+            # A hashing process died (killed, out of memory), the next operation starts a new pool
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            raise
+        finally:
+            # Time waited in the queue included, it is what the request sees
+            metrics.PASSWORD_HASH_LATENCY.observe(time.perf_counter() - start, operation)
+            with self._lock:
+                self._pending -= places
+                metrics.PASSWORD_QUEUE_DEPTH.set(self._pending)
+
+    def hash(self, password):
+        return self._run('hash', [(hash_password, (password, self.n, self.r, self.p))])[0]
+
+    def hash_many(self, passwords):
+        """Hash a batch of passwords, split in one task per pool process."""
+        passwords = list(passwords)
+        if not passwords:
+            return []
+        size = -(-len(passwords) // max(min(self.workers, self.queue_max), 1))
+        tasks = [(hash_passwords, (passwords[start:start + size], self.n, self.r, self.p))
+                 for start in range(0, len(passwords), size)]
+        # Each password takes a place: the queue bounds the hashing work waiting, not the requests
+        return [hashed for chunk in self._run('hash_batch', tasks, len(passwords)) for hashed in chunk]
+
+    def verify(self, password, stored):
+        if not is_hashed(stored):
+            # Plaintext of an old record, nothing slow to compute
+            return verify_password(password, stored)
+        return self._run('verify', [(verify_password, (password, stored))])[0]
+
+    def needs_rehash(self, stored):
+        """Tell whether a stored password is in plaintext or hashed with another work factor."""
+        return not is_hashed(stored) or stored.split('$')[1:4] != [str(self.n), str(self.r), str(self.p)]
+
+    def close(self):
+        if self._executor is not None and self._pid == os.getpid():
+            self._executor.shutdown()
+        self._executor = None
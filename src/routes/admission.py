@@ -0,0 +1,172 @@
+import math
+import time
+import threading
+from collections import OrderedDict
+from flask import request, jsonify, g, current_app
+import metrics
+
+# Route class of each endpoint, the others are 'read'. Each class has its own concurrency limit,
+# so slow requests (full listings, batches, cascading deletes) never take every thread from the cheap reads
+ROUTE_CLASSES = {
+    'users.get_users': 'list',
+    'companies.get_companies': 'list',
+    'companies.get_company_users': 'list',
+    'changes.get_changes': 'list',
+    'users.create_user': 'write',
+    'users.update_full_user': 'write',
+    'users.update_any_field_user': 'write',
+    'users.delete_user': 'write',
+    'users.verify_user_password': 'write',
+    'companies.create_company': 'write',
+    'companies.update_full_company': 'write',
+    'companies.update_any_field_company': 'write',
+    'users.create_users_batch': 'bulk',
+    'users.update_users_batch': 'bulk',
+    'users.delete_users_batch': 'bulk',
+    'companies.create_companies_batch': 'bulk',
+    'companies.update_companies_batch': 'bulk',
+    'companies.delete_companies_batch': 'bulk',
+    # Deletes every user of the company too
+    'companies.delete_company': 'bulk',
+    'changes.stream_changes': 'stream',
+}
+
+# Clients whose token bucket is remembered, the least recently seen ones are forgotten (their bucket refills)
+MAX_RATE_CLIENTS = 10000
+
+
+class ConcurrencyLimit:
+    """At most `limit` requests of a route class at once, `queue_max` more waiting up to `timeout` seconds.
+
+    Waiting requests are served in arrival order. A `limit` of 0 lets every
+    request through.
+    """
+
+    def __init__(self, name, limit, queue_max, timeout):
+        self.name = name
+        self.limit = limit
+        self.queue_max = queue_max
+        self.timeout = timeout
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+        metrics.ADMISSION_ACTIVE.set(0, name)
+        metrics.ADMISSION_QUEUED.set(0, name)
+
+    def acquire(self):
+        """Take a place, waiting for one if needed. Return None, or why the request is refused."""
+        with self._condition:
+            if self.limit < 1 or (self.active < self.limit and not self.waiting):
+                self._started()
+                return None
+            if self.waiting >= self.queue_max:
+                return 'queue_full'
+            self.waiting += 1
+            metrics.ADMISSION_QUEUED.set(self.waiting, self.name)
+            start = time.monotonic()
+            deadline = start + self.timeout
+            try:
+                while self.active >= self.limit:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return 'timeout'
+                    self._condition.wait(remaining)
+                self._started()
+                return None
+            finally:
+                self.waiting -= 1
+                metrics.ADMISSION_QUEUED.set(self.waiting, self.name)
+                metrics.ADMISSION_WAIT.observe(time.monotonic() - start, self.name)
+
+    def _started(self):
+        self.active += 1
+        metrics.ADMISSION_ACTIVE.set(self.active, self.name)
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            metrics.ADMISSION_ACTIVE.set(self.active, self.name)
+            # The longest waiting request takes the place
+            self._condition.notify()
+
+    def stats(self):
+        with self._condition:
+            return {'active': self.active, 'waiting': self.waiting, 'limit': self.limit}
+
+
+class RateLimiter:
+    """Token bucket per client: `rate` requests per second on average, bursts of up to `burst`."""
+
+    def __init__(self, rate, burst, max_clients=MAX_RATE_CLIENTS):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_clients = max_clients
+        self._lock = threading.Lock()
+        # client -> (tokens, time of the last refill), least recently seen first
+        self._buckets = OrderedDict()
+
+    def take(self, client):
+        """Spend a token of `client`. Return 0, or the seconds until it gets one when its bucket is empty."""
+        now = time.monotonic()
+        with self._lock:
+            tokens, last = self._buckets.pop(client, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - last) * self.rate)
+            if tokens >= 1:
+                tokens -= 1
+                wait = 0
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[client] = (tokens, now)
+            if len(self._buckets) > self.max_clients:
+                self._buckets.popitem(last=False)
+            return wait
+
+
+def _rejected(route_class, reason, status, retry_after, message):
+    metrics.ADMISSION_REJECTED.inc(route_class, reason)
+    response = jsonify({'message': message, 'error': 'RateLimited' if status == 429 else 'Overloaded'})
+    response.headers['Retry-After'] = str(max(1, math.ceil(retry_after)))
+    return response, status
+
+
+def _admit():
+    """Refuse the request when its client is over its rate or its route class is full (before_request hook)."""
+    admission = current_app.extensions['admission']
+    route_class = ROUTE_CLASSES.get(request.endpoint, 'read')
+    rate_limiter = admission['rate_limiter']
+    if rate_limiter is not None:
+        wait = rate_limiter.take(request.remote_addr)
+        if wait > 0:
+            return _rejected(route_class, 'rate_limited', 429, wait, 'Too many requests from this client, slow down')
+    limit = admission['limits'][route_class]
+    reason = limit.acquire()
+    if reason is not None:
+        # The server is busy: retry soon rather than piling up and slowing everyone down
+        return _rejected(route_class, reason, 503, 1, 'Server overloaded, try again later')
+    g.admission = limit
+    return None
+
+
+def _release(exception):
+    # Runs once the response is sent, after the last event of a stream
+    limit = g.pop('admission', None)
+    if limit is not None:
+        limit.release()
+
+
+def enable_admission(app):
+    """Limit the requests running at once per route class, and optionally the request rate of each client."""
+    config = app.config
+    limits = {'read': config['ADMISSION_READ_LIMIT'],
+              'list': config['ADMISSION_LIST_LIMIT'],
+              'write': config['ADMISSION_WRITE_LIMIT'],
+              'bulk': config['ADMISSION_BULK_LIMIT'],
+              'stream': config['ADMISSION_STREAM_LIMIT']}
+    rate = config['RATE_LIMIT_PER_SECOND']
+    app.extensions['admission'] = {
+        'limits': {name: ConcurrencyLimit(name, limit, config['ADMISSION_QUEUE_MAX'], config['ADMISSION_QUEUE_TIMEOUT'])
+                   for name, limit in limits.items()},
+        'rate_limiter': RateLimiter(rate, config['RATE_LIMIT_BURST']) if rate > 0 else None,
+    }
+    app.before_request(_admit)
+    app.teardown_request(_release)
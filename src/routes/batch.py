@@ -0,0 +1,44 @@
+from flask import request, jsonify, current_app
+
+
+class BatchError(ValueError):
+    """Raised when the body of a batch request is not a usable list."""
+
+
+def read_batch():
+    """Return the list of items sent to a batch endpoint."""
+    items = request.get_json()
+    if not isinstance(items, list) or not items:
+        raise BatchError('Expected a non-empty JSON list')
+    max_size = current_app.config['BATCH_MAX_SIZE']
+    if len(items) > max_size:
+        raise BatchError(f'A batch can have at most {max_size} items')
+    return items
+
+
+def valid_id(value):
+    """Return True if `value` is a record ID: an integer, and not true/false (bool is an int in Python)."""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def item_error(position, message, error):
+    """Result of an item that was rejected."""
+    return {'index': position, 'status': 400, 'message': message, 'error': error}
+
+
+def item_success(position, **fields):
+    """Result of an item that was applied."""
+    return dict({'index': position, 'status': 200}, **fields)
+
+
+def batch_response(results):
+    """One result per item, in the order they were sent."""
+    failed = sum(1 for result in results if result['status'] != 200)
+    return jsonify({'results': results,
+                    'succeeded': len(results) - failed,
+                    'failed': failed}), 200
+
+
+def batch_error_response(e):
+    return jsonify({'message': str(e),
+                    'error': 'Invalid batch'}), 400
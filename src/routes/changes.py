@@ -0,0 +1,175 @@
+import json
+import time
+from flask import Blueprint, Response, request, jsonify, current_app, stream_with_context
+from storage.base import ID_FIELDS
+from storage.engine import get_store
+from routes.query import QueryError, record_view
+from routes.pagination import MAX_PAGE_SIZE
+
+# An SSE comment is sent after this many idle seconds, so proxies don't close the connection
+HEARTBEAT_SECONDS = 15
+
+
+def _sequence_number(value, name):
+    if value is None or not value.isdigit():
+        raise QueryError(f'{name} must be a sequence number (a non-negative integer)')
+    return int(value)
+
+
+def _entity(value):
+    if value is not None and value not in ID_FIELDS:
+        raise QueryError(f"entity must be one of {', '.join(ID_FIELDS)}")
+    return value
+
+
+def _change_entries(changes, views):
+    """Turn change log entries into what clients get: the write plus the current version of the record."""
+    store = get_store()
+    records = {}
+    # One get_many() per entity for the records still there
+    for entity in ID_FIELDS:
+        ids = [record_id for _, changed, op, record_id in changes if changed == entity and op != 'delete']
+        if ids:
+            records[entity] = {record[ID_FIELDS[entity]]: record for record in store.get_many(entity, ids)}
+    entries = []
+    for seq, entity, op, record_id in changes:
+        entry = {'seq': seq, 'entity': entity, 'op': op, ID_FIELDS[entity]: record_id}
+        if op != 'delete':
+            record = records[entity].get(record_id)
+            # None when the record was deleted since, a later 'delete' entry follows
+            entry['record'] = views[entity](record) if record is not None else None
+        entries.append(entry)
+    return entries
+
+
+def truncated_response(first):
+    return jsonify({'message': f'Changes before {first} were discarded, list the whole collection again',
+                    'error': 'Change log truncated'}), 410
+
+
+def change_response(entity=None):
+    """Return the writes made to `entity` (or to every entity) after `?since=<seq>`, oldest first.
+
+    Clients mirroring the store list it once, remember the X-Change-Seq
+    header of the list and then only ask for the changes since, sending
+    back the `last_seq` of each response. `limit` bounds the number of
+    changes returned, `has_more` tells to ask again right away.
+    """
+    since = _sequence_number(request.args.get('since'), 'since')
+    limit = request.args.get('limit', str(MAX_PAGE_SIZE))
+    if not limit.isdigit() or not 1 <= int(limit) <= MAX_PAGE_SIZE:
+        raise QueryError(f'limit must be an integer between 1 and {MAX_PAGE_SIZE}')
+    limit = int(limit)
+    store = get_store()
+    first, last = store.change_bounds()
+    if since < first - 1:
+        return truncated_response(first)
+    changes = store.changes(since, limit, entity)
+    has_more = len(changes) == limit
+    # Writes to other entities are skipped too: without more changes the client resumes after the last one
+    last_seq = changes[-1][0] if has_more else max([since, last] + [change[0] for change in changes])
+    views = {name: record_view(name) for name in ID_FIELDS}
+    return jsonify({'changes': _change_entries(changes, views),
+                    'last_seq': last_seq,
+                    'has_more': has_more}), 200
+
+
+def _event(name, event_id, data):
+    lines = f'event: {name}\n'
+    if event_id is not None:
+        lines += f'id: {event_id}\n'
+    return lines + f'data: {json.dumps(data, ensure_ascii=False)}\n\n'
+
+
+def _events(store, entity, since, views, poll_seconds, stream_seconds):
+    """Yield the server-sent events of the writes after `since`, checking the change log every `poll_seconds`."""
+    now = time.monotonic()
+    deadline = now + stream_seconds
+    heartbeat = now + HEARTBEAT_SECONDS
+    # EventSource reconnects after this many milliseconds, resuming from the last event ID
+    yield 'retry: 1000\n\n'
+    while time.monotonic() < deadline:
+        first, _ = store.change_bounds()
+        if since < first - 1:
+            yield _event('reset', None, {'message': f'Changes before {first} were discarded, '
+                                                    'list the whole collection again', 'first_seq': first})
+            return
+        changes = store.changes(since, MAX_PAGE_SIZE, entity)
+        for entry in _change_entries(changes, views):
+            yield _event(entry['entity'], entry['seq'], entry)
+        if changes:
+            since = changes[-1][0]
+            heartbeat = time.monotonic() + HEARTBEAT_SECONDS
+            if len(changes) == MAX_PAGE_SIZE:
+                continue
+        elif time.monotonic() >= heartbeat:
+            yield ': keep-alive\n\n'
+            heartbeat = time.monotonic() + HEARTBEAT_SECONDS
+        time.sleep(poll_seconds)
+
+
+def stream_changes():
+    """Send every write to the store as a server-sent event (`event: users`, `id: <seq>`), as it happens.
+
+    `?entity=users` keeps the writes of one entity. The stream starts after
+    `?since=<seq>`, the Last-Event-ID header of a reconnecting client, or
+    else at the current end of the change log.
+    """
+    try:
+        entity = _entity(request.args.get('entity'))
+        since = request.headers.get('Last-Event-ID', request.args.get('since'))
+        store = get_store()
+        since = _sequence_number(since, 'since') if since is not None else store.change_bounds()[1]
+        views = {name: record_view(name) for name in ID_FIELDS}
+        events = _events(store, entity, since, views,
+                         current_app.config['CHANGES_POLL_SECONDS'], current_app.config['CHANGES_STREAM_SECONDS'])
+        response = Response(stream_with_context(events), mimetype='text/event-stream')
+        response.headers['Cache-Control'] = 'no-cache'
+        # Stops nginx from buffering the events
+        response.headers['X-Accel-Buffering'] = 'no'
+        return response, 200
+    except QueryError as e:
+        return jsonify({'message': str(e),
+                        'error': 'Invalid query parameters'}), 400
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found',
+                        'error': 'FileNotFoundError'}), 500
+    except PermissionError:
+        return jsonify({'message': 'Permission denied to access files',
+                        'error': 'PermissionError'}), 500
+    except OSError:
+        return jsonify({'message': 'Error manipulating system files',
+                        'error': 'OSError'}), 500
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+def get_changes():
+    """Return the writes to every entity after `?since=<seq>` (see change_response), `?entity=` keeps one."""
+    try:
+        return change_response(_entity(request.args.get('entity')))
+    except QueryError as e:
+        return jsonify({'message': str(e),
+                        'error': 'Invalid query parameters'}), 400
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found',
+                        'error': 'FileNotFoundError'}), 500
+    except json.JSONDecodeError:
+        return jsonify({'message': 'Error processing JSON file',
+                        'error': 'json.JSONDecodeError'}), 500
+    except PermissionError:
+        return jsonify({'message': 'Permission denied to access files',
+                        'error': 'PermissionError'}), 500
+    except OSError:
+        return jsonify({'message': 'Error manipulating system files',
+                        'error': 'OSError'}), 500
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+# Routes of the change feed, registered by create_app()
+changes_bp = Blueprint('changes', __name__)
+changes_bp.add_url_rule('/changes', view_func=get_changes, methods=['GET'])
+changes_bp.add_url_rule('/changes/stream', view_func=stream_changes, methods=['GET'])
@@ -1,6 +1,28 @@
-import os
 import json
-from flask import request, jsonify
+from flask import Blueprint, request, jsonify
+from storage.base import DuplicateValueError
+from storage.engine import get_store
+from routes.pagination import list_response
+from routes.changes import change_response
+from routes.query import QueryError, record_view
+from routes.etags import record_response, precondition_failed, precondition_failed_response, with_etag
+from routes.batch import read_batch, valid_id, item_error, item_success, batch_response, batch_error_response, BatchError
+
+
+def _validate_new_company(data):
+    """Return the (message, error) pair rejecting the data of a new company, or None if it is valid."""
+    # Validate required fields are present in the request data
+    required_fields = ['cnpj', 'name', 'area_of_activity']
+    if not isinstance(data, dict) or not all(field in data for field in required_fields):
+        return 'Incomplete data', 'Missing required fields'
+    return _validate_cnpj(data['cnpj'])
+
+
+def _validate_cnpj(cnpj):
+    """Return the (message, error) pair rejecting a CNPJ, or None if it is a 14-character string."""
+    if not isinstance(cnpj, str) or len(cnpj) != 14:
+        return 'CNPJ must be 14 characters long', 'Invalid CNPJ length'
+    return None
 
 
 def create_company():
@@ -8,52 +30,18 @@ def create_company():
     try:
         # Get request data
         data = request.get_json()
-        # Validate required fields are present in the request data
-        required_fields = ['cnpj', 'name', 'area_of_activity']
-        if not all(field in data for field in required_fields):
-            return jsonify({'message': 'Incomplete data',
-                            'error': 'Missing required fields'}), 400
-        # Verify CNPJ length
-        if len(data['cnpj']) != 14:
-            return jsonify({'message': 'CNPJ must be 14 characters long',
-                            'error': 'Invalid CNPJ length'}), 400
-        # Accessing data directory
-        data_dir = os.path.join(os.getcwd(), 'data', 'companies')
-        # Check if directory is empty, if so initialize next_id as 1
-        if not os.listdir(data_dir):
-            next_id = 1
-        else:
-            # Check if CNPJ already exists
-            for filename in os.listdir(data_dir):
-                if filename.endswith('.json'):
-                    file_path = os.path.join(data_dir, filename)
-                    with open(file_path, 'r', encoding='utf-8') as f:
-                        existing_data = json.load(f)
-                        if existing_data.get('cnpj') == data['cnpj']:
-                            return jsonify({'message': 'CNPJ already exists',
-                                            'error': 'CNPJ already exists'}), 400
-
-            # List containing all existing ids
-            existing_ids = []
-            # Loop through all files in directory with their names ['1.json', '2.json', etc...]
-            for filename in os.listdir(data_dir):
-                # Check if file ends with .json
-                if not filename.endswith('.json'):
-                    continue
-                # Convert filename to integer
-                file_id = int(filename.replace('.json', ''))
-                # Add found id to list of existing ids
-                existing_ids.append(file_id)
-            # If list of existing ids is not empty, find highest id and increment by 1 and if list of existing ids is empty, first id will be 1
-            next_id = max(existing_ids) + 1 if existing_ids else 1
-        # Add the generated ID to the request data
-        data['company_id'] = next_id
-        # Save user data to JSON file
-        filename = os.path.join(os.getcwd(), 'data', 'companies', f'{next_id}.json')
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        # Validate the request data
+        invalid = _validate_new_company(data)
+        if invalid:
+            return jsonify({'message': invalid[0],
+                            'error': invalid[1]}), 400
+        # Save company data, the store generates the ID and rejects a CNPJ that already exists
+        next_id = get_store().create('companies', data)
         return jsonify({'message': 'Company created successfully!',
                         'company_id': next_id}), 200
+    except DuplicateValueError:
+        return jsonify({'message': 'CNPJ already exists',
+                        'error': 'CNPJ already exists'}), 400
     except FileNotFoundError:
         return jsonify({'message': 'File not found',
                         'error': 'FileNotFoundError'}), 500
@@ -72,18 +60,16 @@ def create_company():
 
 
 def get_companies():
-    """Return a list of all companies from the data directory."""
+    """Return the companies, filtered, sorted and one page at a time if asked (see list_response),
+    or with `?since=<seq>` the writes made to companies since then (see change_response)."""
     try:
-        companies = []
-        data_dir = os.path.join(os.getcwd(), 'data', 'companies')
-        # Read all JSON files in the data directory
-        for filename in os.listdir(data_dir):
-            if filename.endswith('.json'):
-                file_path = os.path.join(data_dir, filename)
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    company_data = json.load(f)
-                    companies.append(company_data)
-        return jsonify(companies), 200
+        if 'since' in request.args:
+            return change_response('companies')
+        # Filters on indexed fields (cnpj) are served from the index
+        return list_response('companies')
+    except QueryError as e:
+        return jsonify({'message': str(e),
+                        'error': 'Invalid query parameters'}), 400
     except FileNotFoundError:
         return jsonify({'message': 'Companies not found',
                         'error': 'FileNotFoundError'}), 500
@@ -104,12 +90,9 @@ def get_companies():
 def get_company(company_id):
     """Return the company data for a given ID."""
     try:
-        data_dir = os.path.join(os.getcwd(), 'data', 'companies')
-        filename = os.path.join(data_dir, f'{company_id}.json')
-        if os.path.exists(filename):
-            with open(filename, 'r', encoding='utf-8') as f:
-                company_data = json.load(f)
-            return jsonify(company_data), 200
+        company_data = get_store().get('companies', company_id)
+        if company_data is not None:
+            return record_response(company_data, record_view('companies'))
         return jsonify({'message': f'Company with ID {company_id} not found',
                         'error': 'Company not found'}), 400
     except FileNotFoundError:
@@ -129,24 +112,51 @@ def get_company(company_id):
                         'error': str(e)}), 500
 
 
-def delete_company(company_id):
+def get_company_users(company_id):
+    """Return the users of a given company ID."""
     try:
-        data_dir = os.path.join(os.getcwd(), 'data', 'companies')
-        filename = os.path.join(data_dir, f'{company_id}.json')
-        if not os.path.exists(filename):
+        store = get_store()
+        if not store.exists('companies', company_id):
             return jsonify({'message': f'Company with ID {company_id} not found',
                             'error': 'Company not found'}), 400
-        os.remove(filename)
-        # Remove all users associated with this company
-        users_dir = os.path.join(os.getcwd(), 'data', 'users')
-        for user_file in os.listdir(users_dir):
-            if user_file.endswith('.json'):
-                user_path = os.path.join(users_dir, user_file)
-                with open(user_path, 'r', encoding='utf-8') as f:
-                    user_data = json.load(f)
-                    if user_data['company_id'] == company_id:
-                        os.remove(user_path)
-        return jsonify({'message': f'Empresa e usuários associados com ID {company_id} deletados com sucesso'}), 200
+        # Only the users of this company are read, found through the index
+        return list_response('users', [('company_id', company_id, False)])
+    except QueryError as e:
+        return jsonify({'message': str(e),
+                        'error': 'Invalid query parameters'}), 400
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found',
+                        'error': 'FileNotFoundError'}), 500
+    except json.JSONDecodeError:
+        return jsonify({'message': 'Error processing JSON file',
+                        'error': 'json.JSONDecodeError'}), 500
+    except PermissionError:
+        return jsonify({'message': 'Permission denied to access files',
+                        'error': 'PermissionError'}), 500
+    except OSError:
+        return jsonify({'message': 'Error manipulating system files',
+                        'error': 'OSError'}), 500
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+def delete_company(company_id):
+    try:
+        store = get_store()
+        # Hold the company lock while its users are removed
+        with store.lock('companies', company_id):
+            company_data = store.get('companies', company_id)
+            if company_data is None:
+                return jsonify({'message': f'Company with ID {company_id} not found',
+                                'error': 'Company not found'}), 400
+            # Reject the write if the client's copy of the record is out of date
+            if precondition_failed(company_data):
+                return precondition_failed_response()
+            store.delete('companies', company_id)
+            # Remove all users associated with this company, the index tells which ones
+            store.delete_where('users', 'company_id', company_id)
+            return jsonify({'message': f'Empresa e usuários associados com ID {company_id} deletados com sucesso'}), 200
     except FileNotFoundError:
         return jsonify({'message': 'File not found',
                         'error': 'FileNotFoundError'}), 500
@@ -167,29 +177,33 @@ def delete_company(company_id):
 def update_full_company(company_id):
     """Update all company data for a given ID."""
     try:
-        data_dir = os.path.join(os.getcwd(), 'data', 'companies')
-        filename = os.path.join(data_dir, f'{company_id}.json')
-        # Check if company exists
-        if not os.path.exists(filename):
-            return jsonify({'message': f'Company with ID {company_id} not found',
-                            'error': 'Company not found'}), 400
-        # Get request data
-        data = request.get_json()
-        # Validate required fields are present in the request data
-        required_fields = ['name', 'cnpj', 'area_of_activity']
-        if not all(field in data for field in required_fields):
-            return jsonify({'message': 'Incomplete data',
-                            'error': 'Missing required fields'}), 400
-        # Verify CNPJ length
-        if len(data['cnpj']) != 14:
-            return jsonify({'message': 'CNPJ must be 14 characters long',
-                            'error': 'Invalid CNPJ length'}), 400
-        # Preserve the company_id
-        data['company_id'] = company_id
-        # Write updated data
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-        return jsonify({'message': f'Company with ID {company_id} updated successfully'}), 200
+        store = get_store()
+        # Hold the record lock so concurrent writes to this company can't interleave
+        with store.lock('companies', company_id):
+            # Read current company data
+            company_data = store.get('companies', company_id)
+            # Check if company exists
+            if company_data is None:
+                return jsonify({'message': f'Company with ID {company_id} not found',
+                                'error': 'Company not found'}), 400
+            # Reject the write if the client's copy of the record is out of date
+            if precondition_failed(company_data):
+                return precondition_failed_response()
+            # Get request data
+            data = request.get_json()
+            # Validate the request data, the same rules as for a new company
+            invalid = _validate_new_company(data)
+            if invalid:
+                return jsonify({'message': invalid[0],
+                                'error': invalid[1]}), 400
+            # Preserve the company_id
+            data['company_id'] = company_id
+            # Write updated data, the store rejects a CNPJ that belongs to another company
+            store.put('companies', company_id, data)
+            return with_etag(jsonify({'message': f'Company with ID {company_id} updated successfully'}), data), 200
+    except DuplicateValueError:
+        return jsonify({'message': 'CNPJ already exists',
+                        'error': 'CNPJ already exists'}), 400
     except FileNotFoundError:
         return jsonify({'message': 'File not found',
                         'error': 'FileNotFoundError'}), 500
@@ -210,34 +224,80 @@ def update_full_company(company_id):
 def update_any_field_company(company_id):
     """Update any company data field for a given company ID."""
     try:
-        data_dir = os.path.join(os.getcwd(), 'data', 'companies')
-        filename = os.path.join(data_dir, f'{company_id}.json')
-        # Check if company exists
-        if not os.path.exists(filename):
-            return jsonify({'message': f'Company with ID {company_id} not found',
-                            'error': 'Company not found'}), 400
-        # Get request data
-        data = request.get_json()
-        if "cnpj" in data:
-            # Verify CNPJ length
-            if len(data['cnpj']) != 14:
-                return jsonify({'message': 'CNPJ must be 14 characters long',
-                                'error': 'Invalid CNPJ length'}), 400
-        # Validate that at least one field is present to update
-        if not data:
-            return jsonify({'message': 'No data provided for update',
-                            'error': 'Missing update data'}), 400
-        # Read current company data
-        with open(filename, 'r', encoding='utf-8') as f:
-            company_data = json.load(f)
-        # Update the provided fields
-        for field in data:
-            if field in company_data:
-                company_data[field] = data[field]
-        # Write updated data back
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(company_data, f, indent=4, ensure_ascii=False)
-        return jsonify({'message': f'Company with ID {company_id} updated successfully'}), 200
+        store = get_store()
+        # Hold the record lock so concurrent writes to this company can't interleave
+        with store.lock('companies', company_id):
+            # Read current company data
+            company_data = store.get('companies', company_id)
+            # Check if company exists
+            if company_data is None:
+                return jsonify({'message': f'Company with ID {company_id} not found',
+                                'error': 'Company not found'}), 400
+            # Reject the write if the client's copy of the record is out of date
+            if precondition_failed(company_data):
+                return precondition_failed_response()
+            # Get request data
+            data = request.get_json()
+            # Validate that at least one field is present to update
+            if not data or not isinstance(data, dict):
+                return jsonify({'message': 'No data provided for update',
+                                'error': 'Missing update data'}), 400
+            if "cnpj" in data:
+                # Verify CNPJ type and length
+                invalid = _validate_cnpj(data['cnpj'])
+                if invalid:
+                    return jsonify({'message': invalid[0],
+                                    'error': invalid[1]}), 400
+            # Update the provided fields
+            for field in data:
+                if field in company_data:
+                    company_data[field] = data[field]
+            # Write updated data back, the store rejects a CNPJ that belongs to another company
+            store.put('companies', company_id, company_data)
+            return with_etag(jsonify({'message': f'Company with ID {company_id} updated successfully'}), company_data), 200
+    except DuplicateValueError:
+        return jsonify({'message': 'CNPJ already exists',
+                        'error': 'CNPJ already exists'}), 400
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found',
+                        'error': 'FileNotFoundError'}), 500
+    except json.JSONDecodeError:
+        return jsonify({'message': 'Error processing JSON file',
+                        'error': 'json.JSONDecodeError'}), 500
+    except PermissionError:
+        return jsonify({'message': 'Permission denied to access files',
+                        'error': 'PermissionError'}), 500
+    except OSError:
+        return jsonify({'message': 'Error manipulating system files',
+                        'error': 'OSError'}), 500
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+def create_companies_batch():
+    """Create many companies in one request and return one result per company."""
+    try:
+        items = read_batch()
+        results = [None] * len(items)
+        valid = []
+        # Validate the whole batch first
+        for position, item in enumerate(items):
+            invalid = _validate_new_company(item)
+            if invalid:
+                results[position] = item_error(position, *invalid)
+                continue
+            valid.append((position, item))
+        # Save the valid companies at once, the store reserves a block of IDs and rejects repeated CNPJs
+        created = get_store().create_many('companies', [item for _, item in valid])
+        for (position, _), company_id in zip(valid, created):
+            if isinstance(company_id, DuplicateValueError):
+                results[position] = item_error(position, 'CNPJ already exists', 'CNPJ already exists')
+            else:
+                results[position] = item_success(position, company_id=company_id)
+        return batch_response(results)
+    except BatchError as e:
+        return batch_error_response(e)
     except FileNotFoundError:
         return jsonify({'message': 'File not found',
                         'error': 'FileNotFoundError'}), 500
@@ -253,3 +313,123 @@ def update_any_field_company(company_id):
     except Exception as e:
         return jsonify({'message': 'Internal server error',
                         'error': str(e)}), 500
+
+
+def update_companies_batch():
+    """Update fields of many companies in one request. Each item carries the company_id and the fields to change."""
+    try:
+        items = read_batch()
+        store = get_store()
+        results = [None] * len(items)
+        changes = []
+        # Validate the whole batch first
+        for position, item in enumerate(items):
+            if not isinstance(item, dict) or not valid_id(item.get('company_id')):
+                results[position] = item_error(position, 'Each item needs an integer company_id', 'Missing company_id')
+                continue
+            data = {field: value for field, value in item.items() if field != 'company_id'}
+            # Validate that at least one field is present to update
+            if not data:
+                results[position] = item_error(position, 'No data provided for update', 'Missing update data')
+                continue
+            # Verify CNPJ type and length
+            invalid = _validate_cnpj(data['cnpj']) if 'cnpj' in data else None
+            if invalid:
+                results[position] = item_error(position, *invalid)
+                continue
+            changes.append((position, item['company_id'], data))
+        # Hold the locks of every company of the batch, so none changes between its read and the write
+        with store.lock_many('companies', [company_id for _, company_id, _ in changes]):
+            records = {}
+            updated = []
+            for position, company_id, data in changes:
+                company_data = records.get(company_id) or store.get('companies', company_id)
+                if company_data is None:
+                    results[position] = item_error(position, f'Company with ID {company_id} not found',
+                                                   'Company not found')
+                    continue
+                # Update the provided fields
+                for field in data:
+                    if field in company_data:
+                        company_data[field] = data[field]
+                records[company_id] = company_data
+                updated.append((position, company_id))
+            # One write for the whole batch, the store rejects a CNPJ that belongs to another company
+            errors = dict(zip(records, store.bulk_put('companies', list(records.values()))))
+        for position, company_id in updated:
+            if errors[company_id] is not None:
+                results[position] = item_error(position, 'CNPJ already exists', 'CNPJ already exists')
+            else:
+                results[position] = item_success(position, company_id=company_id)
+        return batch_response(results)
+    except BatchError as e:
+        return batch_error_response(e)
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found',
+                        'error': 'FileNotFoundError'}), 500
+    except json.JSONDecodeError:
+        return jsonify({'message': 'Error processing JSON file',
+                        'error': 'json.JSONDecodeError'}), 500
+    except PermissionError:
+        return jsonify({'message': 'Permission denied to access files',
+                        'error': 'PermissionError'}), 500
+    except OSError:
+        return jsonify({'message': 'Error manipulating system files',
+                        'error': 'OSError'}), 500
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+def delete_companies_batch():
+    """Delete many companies, and their users, in one request. The body is the list of company IDs."""
+    try:
+        items = read_batch()
+        store = get_store()
+        company_ids = [item for item in items if valid_id(item)]
+        # Hold the company locks while their users are removed, like delete_company
+        with store.lock_many('companies', company_ids):
+            deleted = set(store.delete_many('companies', company_ids))
+            # Remove the users of the deleted companies, the index tells which ones
+            for company_id in deleted:
+                store.delete_where('users', 'company_id', company_id)
+        results = []
+        for position, company_id in enumerate(items):
+            if not valid_id(company_id):
+                results.append(item_error(position, 'Company IDs must be integers', 'Invalid company ID'))
+            elif company_id in deleted:
+                results.append(item_success(position, company_id=company_id))
+            else:
+                results.append(item_error(position, f'Company with ID {company_id} not found', 'Company not found'))
+        return batch_response(results)
+    except BatchError as e:
+        return batch_error_response(e)
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found',
+                        'error': 'FileNotFoundError'}), 500
+    except json.JSONDecodeError:
+        return jsonify({'message': 'Error processing JSON file',
+                        'error': 'json.JSONDecodeError'}), 500
+    except PermissionError:
+        return jsonify({'message': 'Permission denied to access files',
+                        'error': 'PermissionError'}), 500
+    except OSError:
+        return jsonify({'message': 'Error manipulating system files',
+                        'error': 'OSError'}), 500
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+# Routes of the companies endpoints, registered by create_app()
+companies_bp = Blueprint('companies', __name__)
+companies_bp.add_url_rule('/companies', view_func=create_company, methods=['POST'])
+companies_bp.add_url_rule('/companies', view_func=get_companies, methods=['GET'])
+companies_bp.add_url_rule('/companies/<int:company_id>', view_func=get_company, methods=['GET'])
+companies_bp.add_url_rule('/companies/<int:company_id>/users', view_func=get_company_users, methods=['GET'])
+companies_bp.add_url_rule('/companies/<int:company_id>', view_func=delete_company, methods=['DELETE'])
+companies_bp.add_url_rule('/companies/<int:company_id>', view_func=update_full_company, methods=['PUT'])
+companies_bp.add_url_rule('/companies/<int:company_id>', view_func=update_any_field_company, methods=['PATCH'])
+companies_bp.add_url_rule('/companies:batch', view_func=create_companies_batch, methods=['POST'])
+companies_bp.add_url_rule('/companies:batch', view_func=update_companies_batch, methods=['PATCH'])
+companies_bp.add_url_rule('/companies:batch', view_func=delete_companies_batch, methods=['DELETE'])
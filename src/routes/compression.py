@@ -0,0 +1,175 @@
+import gzip
+import zlib
+import threading
+from collections import OrderedDict
+from flask import Response, request, current_app
+
+# brotli is optional (pip install brotli), gzip is always available
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses that get compressed (text/plain is /metrics)
+COMPRESSIBLE_TYPES = ('application/json', 'application/x-ndjson', 'text/plain')
+
+# Content codings, each compressed response with a strong ETag gets its own (see etags.etag_variants)
+ENCODINGS = ('br', 'gzip')
+
+# Speed/size trade-off: gzip's default level, and a brotli quality fast enough for dynamic responses
+GZIP_LEVEL = 6
+BROTLI_QUALITY = 5
+
+
+def negotiate():
+    """Return the best encoding the client accepts: 'br', 'gzip' or None."""
+    accepted = request.accept_encodings
+    if brotli is not None and accepted['br'] > 0:
+        return 'br'
+    if accepted['gzip'] > 0:
+        return 'gzip'
+    return None
+
+
+def compress(data, encoding):
+    if encoding == 'br':
+        return brotli.compress(data, quality=BROTLI_QUALITY)
+    # mtime=0 gives the same bytes for the same body
+    return gzip.compress(data, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+def _compress_stream(chunks, encoding):
+    """Compress a streamed body as it is produced."""
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+        for chunk in chunks:
+            yield compressor.process(chunk)
+        yield compressor.finish()
+        return
+    compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        yield compressor.compress(chunk)
+    yield compressor.flush()
+
+
+def compress_response(response):
+    """Compress JSON responses for clients that accept it (after_request hook)."""
+    if response.mimetype not in COMPRESSIBLE_TYPES:
+        return response
+    response.vary.add('Accept-Encoding')
+    if 'Content-Encoding' in response.headers or response.status_code < 200 or response.status_code in (204, 304):
+        return response
+    encoding = negotiate()
+    if encoding is None:
+        return response
+    if response.is_streamed:
+        response.response = _compress_stream(response.iter_encoded(), encoding)
+        response.headers.pop('Content-Length', None)
+    else:
+        data = response.get_data()
+        if len(data) < current_app.config['COMPRESS_MIN_BYTES']:
+            return response
+        response.set_data(compress(data, encoding))
+    response.headers['Content-Encoding'] = encoding
+    etag, weak = response.get_etag()
+    if etag is not None and not weak:
+        # A strong ETag names the bytes sent: the compressed ones get their own, If-Match accepts both
+        response.set_etag(f'{etag}-{encoding}')
+    return response
+
+
+class Snapshot:
+    """Serialized body of a list response, plus its compressed versions, made on first use."""
+
+    def __init__(self, body, status, mimetype, headers):
+        self.body = body
+        self.status = status
+        self.mimetype = mimetype
+        self.headers = headers
+        # Size counted by the cache when it was last added
+        self.size_cached = 0
+        self._encoded = {}
+        self._lock = threading.Lock()
+
+    @property
+    def size(self):
+        return len(self.body) + sum(len(data) for data in self._encoded.values())
+
+    def encoded(self, encoding):
+        """Return the body in `encoding` and whether it was just compressed."""
+        with self._lock:
+            data = self._encoded.get(encoding)
+            if data is not None:
+                return data, False
+        data = compress(self.body, encoding)
+        with self._lock:
+            self._encoded[encoding] = data
+        return data, True
+
+
+def snapshot_response(snapshot, key):
+    """Build a response from a cached snapshot, compressed for the client when worth it."""
+    encoding = negotiate()
+    if encoding is None or len(snapshot.body) < current_app.config['COMPRESS_MIN_BYTES']:
+        response = Response(snapshot.body, snapshot.status, mimetype=snapshot.mimetype)
+    else:
+        data, compressed = snapshot.encoded(encoding)
+        if compressed:
+            # The snapshot grew, let the cache count it
+            current_app.extensions['snapshots'].put(key, snapshot)
+        response = Response(data, snapshot.status, mimetype=snapshot.mimetype)
+        response.headers['Content-Encoding'] = encoding
+    response.headers.update(snapshot.headers)
+    response.vary.add('Accept-Encoding')
+    return response
+
+
+def enable_compression(app):
+    """Compress the JSON responses of the app and cache the list response snapshots."""
+    app.extensions['snapshots'] = SnapshotCache(app.config['SNAPSHOT_CACHE_BYTES'])
+    app.after_request(compress_response)
+
+
+class SnapshotCache:
+    """Bounded LRU of list response snapshots, keyed by path and collection ETag (store revision + query)."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        with self._lock:
+            snapshot = self._entries.get(key)
+            if snapshot is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return snapshot
+
+    def put(self, key, snapshot):
+        """Add a snapshot, or count the growth of one already cached (a new compressed version)."""
+        if snapshot.size > self.max_bytes:
+            return
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._bytes -= previous.size_cached
+            snapshot.size_cached = snapshot.size
+            self._entries[key] = snapshot
+            self._bytes += snapshot.size_cached
+            while self._bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self._bytes -= evicted.size_cached
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'max_bytes': self.max_bytes}
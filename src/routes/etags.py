@@ -0,0 +1,91 @@
+import json
+import hashlib
+from flask import request, jsonify, make_response, current_app
+from storage.engine import get_store
+from routes.compression import ENCODINGS, Snapshot, snapshot_response
+
+
+def record_etag(record):
+    """Return the version of a record: a hash of its content, the same in every process and for every codec."""
+    payload = json.dumps(record, sort_keys=True, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return hashlib.blake2b(payload, digest_size=16).hexdigest()
+
+
+def etag_variants(etag):
+    """Return the ETags a record version is sent with: as is, and one per content coding."""
+    return [etag] + [f'{etag}-{encoding}' for encoding in ENCODINGS]
+
+
+def collection_etag():
+    """Return the version of a list response: the store revision plus the query string (filters, page...)."""
+    query = hashlib.blake2b(request.query_string, digest_size=8).hexdigest()
+    return f'{get_store().revision()}-{query}'
+
+
+def precondition_failed(record):
+    """Return True if the request has an If-Match header that doesn't match the current record."""
+    if not request.if_match:
+        return False
+    return not any(request.if_match.contains(etag) for etag in etag_variants(record_etag(record)))
+
+
+def precondition_failed_response():
+    return jsonify({'message': 'The record was modified by another request, fetch it again',
+                    'error': 'Precondition failed'}), 412
+
+
+def not_modified_response(etag, weak=False):
+    response = make_response('', 304)
+    response.set_etag(etag, weak=weak)
+    return response
+
+
+def record_response(record, view=None):
+    """Return a record with its ETag, or 304 Not Modified if the client already has this version.
+
+    `view` turns the record into what the client sees, the ETag is always the one of the stored record.
+    """
+    etag = record_etag(record)
+    for variant in etag_variants(etag):
+        # The 304 carries the ETag the client has, compressed or not
+        if request.if_none_match.contains_weak(variant):
+            return not_modified_response(variant)
+    response = jsonify(view(record) if view is not None else record)
+    response.set_etag(etag)
+    return response, 200
+
+
+def with_etag(response, record):
+    """Add the new version of a record to the response of a write."""
+    response = make_response(response)
+    response.set_etag(record_etag(record))
+    return response
+
+
+def cached_collection(build):
+    """Return the response of `build()` with a weak ETag, or 304 if the store hasn't changed since the client's copy.
+
+    The serialized (and compressed) body is kept in the snapshot cache under
+    the same ETag, so until the next write the list is neither read,
+    serialized nor compressed again.
+    """
+    etag = collection_etag()
+    if request.if_none_match.contains_weak(etag):
+        return not_modified_response(etag, weak=True)
+    snapshots = current_app.extensions.get('snapshots')
+    key = (request.path, etag)
+    snapshot = snapshots.get(key) if snapshots is not None else None
+    if snapshot is None:
+        response, status = build()
+        response = make_response(response)
+        # Streamed lists are never held in memory
+        if snapshots is None or response.is_streamed or status != 200:
+            response.set_etag(etag, weak=True)
+            return response, status
+        headers = {name: response.headers[name] for name in ('Link', 'X-Next-Cursor', 'X-Change-Seq')
+                   if name in response.headers}
+        snapshot = Snapshot(response.get_data(), status, response.mimetype, headers)
+        snapshots.put(key, snapshot)
+    response = snapshot_response(snapshot, key)
+    response.set_etag(etag, weak=True)
+    return response, snapshot.status
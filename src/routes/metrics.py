@@ -0,0 +1,87 @@
+import os
+import re
+import time
+import random
+import cProfile
+from flask import Blueprint, Response, request, jsonify, g, current_app
+from storage.engine import get_store
+import metrics
+
+
+def _route():
+    """Label of the current request: its URL rule, so /users/1 and /users/2 are counted together."""
+    return request.url_rule.rule if request.url_rule is not None else 'unmatched'
+
+
+def _start_request():
+    g.request_start = time.perf_counter()
+    g.request_io = metrics.start_request_io()
+    g.profile = None
+    if current_app.config['PROFILE_SLOW_MS'] > 0 and random.random() < current_app.config['PROFILE_SAMPLE_RATE']:
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+            g.profile = profile
+        except ValueError:
+            # Another profiler is already running in this process
+            pass
+
+
+def _finish_request(response):
+    elapsed = time.perf_counter() - g.request_start
+    method, route = request.method, _route()
+    metrics.LATENCY.observe(elapsed, method, route)
+    metrics.REQUESTS.inc(method, route, response.status_code)
+    io = g.request_io
+    metrics.FILES_OPENED.inc(method, route, amount=io.files_opened)
+    metrics.LISTDIRS.inc(method, route, amount=io.listdirs)
+    metrics.BYTES_READ.inc(method, route, amount=io.bytes_read)
+    metrics.BYTES_WRITTEN.inc(method, route, amount=io.bytes_written)
+    if g.profile is not None:
+        g.profile.disable()
+        if elapsed * 1000 >= current_app.config['PROFILE_SLOW_MS']:
+            _dump_profile(g.profile, method, route, elapsed)
+    return response
+
+
+def _dump_profile(profile, method, route, elapsed):
+    """Save the profile of a slow request, readable with `python -m pstats <file>` or snakeviz."""
+    profile_dir = current_app.config['PROFILE_DIR']
+    os.makedirs(profile_dir, exist_ok=True)
+    name = re.sub(r'[^A-Za-z0-9]+', '_', route).strip('_') or 'root'
+    filename = f'{int(time.time() * 1000)}-{os.getpid()}-{method}-{name}-{int(elapsed * 1000)}ms.prof'
+    try:
+        profile.dump_stats(os.path.join(profile_dir, filename))
+    except OSError as e:
+        current_app.logger.warning('Could not save profile %s: %s', filename, e)
+
+
+def instrument(app):
+    """Measure every request of the app: latency, status code and storage I/O, plus the slow request profiler."""
+    app.before_request(_start_request)
+    app.after_request(_finish_request)
+
+
+def _store_metrics():
+    """Turn the backend counters (record cache...) into gauges, collected at each scrape."""
+    gauges = []
+    for group, values in get_store().stats().items():
+        for key, value in values.items():
+            gauge = metrics.Gauge(f'storage_{group}_{key}', f'{group} {key.replace("_", " ")} of the storage backend')
+            gauge.set(value)
+            gauges.append(gauge)
+    return gauges
+
+
+def get_metrics():
+    """Return the metrics of this process in the Prometheus text format."""
+    try:
+        return Response(metrics.render(_store_metrics()), mimetype='text/plain; version=0.0.4'), 200
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+# Route of the metrics endpoint, registered by create_app()
+metrics_bp = Blueprint('metrics', __name__)
+metrics_bp.add_url_rule('/metrics', view_func=get_metrics, methods=['GET'])
@@ -0,0 +1,106 @@
+import json
+from urllib.parse import urlencode
+from flask import request, jsonify, Response, stream_with_context
+from storage.engine import get_store
+from storage.base import ID_FIELDS
+from routes.etags import cached_collection
+from routes.query import QueryError, parse_filters, parse_sort, record_view, find_records, sort_records
+
+# Largest page a client can ask for
+MAX_PAGE_SIZE = 1000
+
+
+class PaginationError(QueryError):
+    """Raised when the pagination query parameters are invalid."""
+
+
+def _positive_int(name):
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit() or int(value) < 1:
+        raise PaginationError(f'{name} must be a positive integer')
+    return int(value)
+
+
+def _stream(records, mode):
+    """Emit records one at a time, as a JSON array or as NDJSON (one record per line)."""
+    if mode == 'ndjson':
+        for record in records:
+            yield json.dumps(record, ensure_ascii=False) + '\n'
+        return
+    yield '['
+    first = True
+    for record in records:
+        yield ('' if first else ',') + json.dumps(record, ensure_ascii=False)
+        first = False
+    yield ']'
+
+
+def list_response(entity, filters=()):
+    """Build the response of a list endpoint, with a weak ETag (see _list_response)."""
+    return cached_collection(lambda: _list_response(entity, list(filters)))
+
+
+def _list_response(entity, filters):
+    """Build the response of a list endpoint.
+
+    Without query parameters every record is returned, as before. With
+    `limit` (and `cursor`, the last ID of the previous page) one page is
+    returned, ordered by ID, and the next page is announced in the `Link`
+    and `X-Next-Cursor` headers. With `stream=json` or `stream=ndjson` the
+    records are read and sent one at a time. Filters, `sort` and `fields`
+    are described in routes.query; `filters` are added by the route itself.
+
+    The `X-Change-Seq` header is the last write in the change log before
+    the records were read: `?since=` that number gets every write the
+    response may have missed.
+    """
+    # Read first: a write made while the records are read is then in the changes since this number
+    change_seq = str(get_store().change_bounds()[1])
+    limit = _positive_int('limit')
+    cursor = request.args.get('cursor')
+    if cursor is not None:
+        if not cursor.isdigit():
+            raise PaginationError('cursor must be a record ID')
+        cursor = int(cursor)
+    stream = request.args.get('stream')
+    if stream not in (None, 'json', 'ndjson'):
+        raise PaginationError("stream must be 'json' or 'ndjson'")
+    if limit is not None and limit > MAX_PAGE_SIZE:
+        raise PaginationError(f'limit must be at most {MAX_PAGE_SIZE}')
+    filters += parse_filters(entity)
+    sort = parse_sort(entity)
+    if sort and cursor is not None:
+        raise PaginationError('cursor follows ID order and cannot be combined with sort')
+    view = record_view(entity)
+    if stream is not None:
+        records = _records(entity, filters, sort, cursor, limit)
+        mimetype = 'application/x-ndjson' if stream == 'ndjson' else 'application/json'
+        response = Response(stream_with_context(_stream(map(view, records), stream)), mimetype=mimetype)
+        response.headers['X-Change-Seq'] = change_seq
+        return response, 200
+    if limit is None and cursor is None:
+        response = jsonify([view(record) for record in _records(entity, filters, sort, None, None)])
+        response.headers['X-Change-Seq'] = change_seq
+        return response, 200
+    limit = limit or MAX_PAGE_SIZE
+    # One extra record tells whether there is a next page
+    records = list(_records(entity, filters, sort, cursor, limit + 1))
+    response = jsonify([view(record) for record in records[:limit]])
+    response.headers['X-Change-Seq'] = change_seq
+    # A sorted list has no cursor, only its first page is returned
+    if len(records) > limit and not sort:
+        next_cursor = records[limit - 1][ID_FIELDS[entity]]
+        next_url = f"{request.base_url}?{urlencode(dict(request.args.items(), limit=limit, cursor=next_cursor))}"
+        response.headers['Link'] = f'<{next_url}>; rel="next"'
+        response.headers['X-Next-Cursor'] = str(next_cursor)
+    return response, 200
+
+
+def _records(entity, filters, sort, after_id, limit):
+    """Return the matching records, ordered by ID or by the sort keys (which needs them all in memory)."""
+    if not sort:
+        return find_records(entity, filters, after_id=after_id, limit=limit)
+    records = sort_records(find_records(entity, filters), sort)
+    return records[:limit] if limit is not None else records
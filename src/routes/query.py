@@ -0,0 +1,130 @@
+from bisect import bisect_right
+from itertools import islice
+from flask import request
+from storage.base import INDEXED_FIELDS
+from storage.engine import get_store
+
+# Fields the list endpoints can filter on, with the type of their values
+FILTER_FIELDS = {
+    'users': {'company_id': int, 'email': str, 'name': str},
+    'companies': {'cnpj': str, 'name': str, 'area_of_activity': str},
+}
+
+# Candidates of an indexed filter read at once
+QUERY_CHUNK = 1000
+
+# Fields never sent to clients
+HIDDEN_FIELDS = {
+    'users': ('password',),
+}
+
+
+class QueryError(ValueError):
+    """Raised when the query parameters of a list endpoint are invalid."""
+
+
+def parse_filters(entity):
+    """Return the filters of the request as (field, value, prefix) tuples.
+
+    `?name=Ana` keeps the records whose name is exactly "Ana", `?name=An*`
+    the ones whose name starts with "An".
+    """
+    filters = []
+    for field, kind in FILTER_FIELDS[entity].items():
+        value = request.args.get(field)
+        if value is None:
+            continue
+        prefix = value.endswith('*')
+        if prefix:
+            if kind is not str:
+                raise QueryError(f'{field} can only be filtered by exact value')
+            value = value[:-1]
+        if kind is int:
+            if not value.isdigit():
+                raise QueryError(f'{field} must be an integer')
+            value = int(value)
+        filters.append((field, value, prefix))
+    return filters
+
+
+def parse_sort(entity):
+    """Return the sort keys of `?sort=name,-company_id` as (field, descending) tuples."""
+    sort = request.args.get('sort')
+    if not sort:
+        return []
+    keys = []
+    for field in sort.split(','):
+        descending = field.startswith('-')
+        field = field.lstrip('-')
+        if not field or field in HIDDEN_FIELDS.get(entity, ()):
+            raise QueryError(f'Cannot sort by {field!r}')
+        keys.append((field, descending))
+    return keys
+
+
+def record_view(entity):
+    """Return the function turning a stored record into the one sent to the client (`?fields=` and hidden fields)."""
+    hidden = HIDDEN_FIELDS.get(entity, ())
+    fields = request.args.get('fields')
+    if fields:
+        wanted = [field for field in fields.split(',') if field and field not in hidden]
+        return lambda record: {field: record[field] for field in wanted if field in record}
+    if not hidden:
+        return lambda record: record
+    return lambda record: {field: value for field, value in record.items() if field not in hidden}
+
+
+def _matches(record, field, value, prefix):
+    if prefix:
+        return isinstance(record.get(field), str) and record[field].startswith(value)
+    return record.get(field) == value
+
+
+def find_records(entity, filters, after_id=None, limit=None):
+    """Yield the records matching every filter, ordered by ID, starting after `after_id` and stopping after `limit`.
+
+    The first filter on an indexed field gives the IDs of the candidates from
+    the index: only the ones after `after_id` are read, a chunk at a time until
+    `limit` records matched, so a page never reads the whole match set. The
+    other filters are checked on each candidate. Without one, every record is read.
+    """
+    store = get_store()
+    if not filters:
+        yield from store.scan(entity, after_id=after_id, limit=limit)
+        return
+    indexed = [condition for condition in filters if condition[0] in INDEXED_FIELDS.get(entity, ())]
+    if not indexed:
+        records = (record for record in store.scan(entity, after_id=after_id)
+                   if all(_matches(record, *condition) for condition in filters))
+        yield from islice(records, limit)
+        return
+    field, value, prefix = indexed[0]
+    ids = store.query_prefix_ids(entity, field, value) if prefix else store.query_ids(entity, field, value)
+    position = bisect_right(ids, after_id) if after_id is not None else 0
+    count = 0
+    while position < len(ids) and (limit is None or count < limit):
+        chunk = ids[position:position + (QUERY_CHUNK if limit is None else min(limit - count, QUERY_CHUNK))]
+        position += len(chunk)
+        # Every filter is checked again: a record may have changed since the index was read
+        for record in store.get_many(entity, chunk):
+            if all(_matches(record, *condition) for condition in filters):
+                count += 1
+                yield record
+
+
+def _sort_value(value):
+    # Numbers first, then everything else as text, missing values last: any mix of types can be sorted
+    if isinstance(value, (int, float)) and not isinstance(value, bool):
+        return (0, value, '')
+    if value is None:
+        return (2, 0, '')
+    return (1, 0, str(value))
+
+
+def sort_records(records, keys):
+    """Return the records sorted by the (field, descending) keys of parse_sort()."""
+    records = list(records)
+    # Stable sorts, least significant key first
+    for field, descending in reversed(keys):
+        records.sort(key=lambda record: _sort_value(record.get(field)), reverse=descending)
+    return records
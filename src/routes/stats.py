@@ -0,0 +1,21 @@
+from flask import Blueprint, jsonify, current_app
+from storage.engine import get_store
+
+
+def get_stats():
+    """Return the storage backend counters (record cache hits, misses, evictions...), the list snapshot cache's
+    and the requests running and waiting in each route class of this process."""
+    try:
+        stats = get_store().stats()
+        stats['snapshots'] = current_app.extensions['snapshots'].stats()
+        limits = current_app.extensions['admission']['limits']
+        stats['admission'] = {name: limit.stats() for name, limit in limits.items()}
+        return jsonify(stats), 200
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+# Route of the stats endpoint, registered by create_app()
+stats_bp = Blueprint('stats', __name__)
+stats_bp.add_url_rule('/stats', view_func=get_stats, methods=['GET'])
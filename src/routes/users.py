@@ -1,7 +1,59 @@
-import os
 import json
 import re
-from flask import request, jsonify
+from flask import Blueprint, request, jsonify, current_app
+from storage.engine import get_store
+from routes.pagination import list_response
+from routes.changes import change_response
+from routes.query import QueryError, record_view
+from routes.etags import record_response, precondition_failed, precondition_failed_response, with_etag
+from routes.batch import read_batch, valid_id, item_error, item_success, batch_response, batch_error_response, BatchError
+from passwords import PasswordQueueFull
+
+
+def _validate_new_user(data):
+    """Return the (message, error) pair rejecting the data of a new user, or None if it is valid."""
+    # Validate required fields are present in the request data
+    required_fields = ['name', 'company_id', 'email', 'password']
+    if not isinstance(data, dict) or not all(field in data for field in required_fields):
+        return 'Incomplete data', 'Missing required fields'
+    return _validate_user_fields(data)
+
+
+def _validate_user_fields(data):
+    """Return the (message, error) pair rejecting one of the user fields present in `data`, or None."""
+    # Check if email is valid
+    if 'email' in data and not _valid_email(data['email']):
+        return 'Invalid email', 'Invalid email'
+    # The company_id is indexed and compared to company IDs: an integer, not "1", 1.0 or true
+    if 'company_id' in data and (not isinstance(data['company_id'], int) or isinstance(data['company_id'], bool)):
+        return 'company_id must be an integer', 'Invalid company_id'
+    if 'password' in data and not _valid_password(data['password']):
+        return 'Password must be a non-empty string', 'Invalid password'
+    return None
+
+
+def _valid_email(email):
+    return isinstance(email, str) and re.match(r"[^@]+@[^@]+\.[^@]+", email) is not None
+
+
+def _valid_password(password):
+    return isinstance(password, str) and password != ''
+
+
+def _too_many_passwords(count):
+    """Return a 413 response if a batch sets more passwords than allowed, else None."""
+    max_passwords = current_app.config['PASSWORD_BATCH_MAX']
+    if count <= max_passwords:
+        return None
+    return jsonify({'message': f'A batch can set at most {max_passwords} passwords',
+                    'error': 'Too many passwords'}), 413
+
+
+def password_queue_full_response():
+    response = jsonify({'message': 'Too many password operations in progress, try again later',
+                        'error': 'PasswordQueueFull'})
+    response.headers['Retry-After'] = '1'
+    return response, 503
 
 
 def create_user():
@@ -9,48 +61,24 @@ def create_user():
     try:
         # Get request data
         data = request.get_json()
-        # Validate required fields are present in the request data
-        required_fields = ['name', 'company_id', 'email', 'password']
-        if not all(field in data for field in required_fields):
-            return jsonify({'message': 'Incomplete data',
-                            'error': 'Missing required fields'}), 400
-        # Check if email is valid
-        if not re.match(r"[^@]+@[^@]+\.[^@]+", data['email']):
-            return jsonify({'message': 'Invalid email',
-                            'error': 'Invalid email'}), 400
-        # Accessing data directory
-        data_dir = os.path.join(os.getcwd(), 'data', 'users')
+        # Validate the request data
+        invalid = _validate_new_user(data)
+        if invalid:
+            return jsonify({'message': invalid[0],
+                            'error': invalid[1]}), 400
+        store = get_store()
         # Check if company exists
-        company_dir = os.path.join(os.getcwd(), 'data', 'companies')
-        company_file = os.path.join(company_dir, f"{data['company_id']}.json")
-        if not os.path.exists(company_file):
+        if not store.exists('companies', data['company_id']):
             return jsonify({'message': 'Please register your company first',
                             'error': 'Company not found'}), 400
-        # Check if directory is empty, if so initialize next_id as 1
-        if not os.listdir(data_dir):
-            next_id = 1
-        else:
-            # List containing all existing ids
-            existing_ids = []
-            # Loop through all files in directory with their names ['1.json', '2.json', etc...]
-            for filename in os.listdir(data_dir):
-                # Check if file ends with .json
-                if not filename.endswith('.json'):
-                    continue
-                # Convert filename to integer
-                file_id = int(filename.replace('.json', ''))
-                # Add found id to list of existing ids
-                existing_ids.append(file_id)
-            # If list of existing ids is not empty, find highest id and increment by 1 and if list of existing ids is empty, first id will be 1
-            next_id = max(existing_ids) + 1 if existing_ids else 1
-        # Add the generated ID to the request data
-        data['id_user'] = next_id
-        # Save user data to JSON file
-        filename = os.path.join(os.getcwd(), 'data', 'users', f'{next_id}.json')
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
+        # Only the hash of the password is stored, computed by the password pool
+        data['password'] = current_app.extensions['passwords'].hash(data['password'])
+        # Save user data, the store generates the ID and adds it to the data
+        store.create('users', data)
         return jsonify({'message': 'User created successfully!',
                         'id_user': data['id_user']}), 200
+    except PasswordQueueFull:
+        return password_queue_full_response()
     except FileNotFoundError:
         return jsonify({'message': 'File not found',
                         'error': 'FileNotFoundError'}), 500
@@ -69,18 +97,15 @@ def create_user():
 
 
 def get_users():
-    """Return a list of all users from the data directory."""
+    """Return the users, filtered, sorted and one page at a time if asked (see list_response),
+    or with `?since=<seq>` the writes made to users since then (see change_response)."""
     try:
-        users = []
-        data_dir = os.path.join(os.getcwd(), 'data', 'users')
-        # Read all JSON files in the data directory
-        for filename in os.listdir(data_dir):
-            if filename.endswith('.json'):
-                file_path = os.path.join(data_dir, filename)
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    user_data = json.load(f)
-                    users.append(user_data)
-        return jsonify(users), 200
+        if 'since' in request.args:
+            return change_response('users')
+        return list_response('users')
+    except QueryError as e:
+        return jsonify({'message': str(e),
+                        'error': 'Invalid query parameters'}), 400
     except FileNotFoundError:
         return jsonify({'message': 'Users not found',
                         'error': 'FileNotFoundError'}), 500
@@ -101,12 +126,9 @@ def get_users():
 def get_user(user_id):
     """Return the user data for a given ID."""
     try:
-        data_dir = os.path.join(os.getcwd(), 'data', 'users')
-        filename = os.path.join(data_dir, f'{user_id}.json')
-        if os.path.exists(filename):
-            with open(filename, 'r', encoding='utf-8') as f:
-                user_data = json.load(f)
-            return jsonify(user_data), 200
+        user_data = get_store().get('users', user_id)
+        if user_data is not None:
+            return record_response(user_data, record_view('users'))
         return jsonify({'message': f'User with ID {user_id} not found',
                         'error': 'User not found'}), 400
     except FileNotFoundError:
@@ -128,13 +150,17 @@ def get_user(user_id):
 
 def delete_user(user_id):
     try:
-        data_dir = os.path.join(os.getcwd(), 'data', 'users')
-        filename = os.path.join(data_dir, f'{user_id}.json')
-        if not os.path.exists(filename):
-            return jsonify({'message': f'User with ID {user_id} not found',
-                            'error': 'User not found'}), 400
-        os.remove(filename)
-        return jsonify({'message': f'User with ID {user_id} deleted successfully'}), 200
+        store = get_store()
+        with store.lock('users', user_id):
+            user_data = store.get('users', user_id)
+            if user_data is None:
+                return jsonify({'message': f'User with ID {user_id} not found',
+                                'error': 'User not found'}), 400
+            # Reject the write if the client's copy of the record is out of date
+            if precondition_failed(user_data):
+                return precondition_failed_response()
+            store.delete('users', user_id)
+            return jsonify({'message': f'User with ID {user_id} deleted successfully'}), 200
     except FileNotFoundError:
         return jsonify({'message': 'File not found',
                         'error': 'FileNotFoundError'}), 500
@@ -152,29 +178,38 @@ def delete_user(user_id):
 def update_full_user(user_id):
     """Update all user data for a given ID."""
     try:
-        data_dir = os.path.join(os.getcwd(), 'data', 'users')
-        filename = os.path.join(data_dir, f'{user_id}.json')
-        # Check if user exists
-        if not os.path.exists(filename):
-            return jsonify({'message': f'User with ID {user_id} not found',
-                            'error': 'User not found'}), 400
+        store = get_store()
         # Get request data
         data = request.get_json()
-        # Validate required fields are present in the request data
-        required_fields = ['name', 'company_id', 'email', 'password']
-        if not all(field in data for field in required_fields):
-            return jsonify({'message': 'Incomplete data',
-                            'error': 'Missing required fields'}), 400
-        # Check if email is valid
-        if not re.match(r"[^@]+@[^@]+\.[^@]+", data['email']):
-            return jsonify({'message': 'Invalid email',
-                            'error': 'Invalid email'}), 400
-        # Preserve the user_id
-        data['id_user'] = user_id
-        # Write updated data
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(data, f, indent=4, ensure_ascii=False)
-        return jsonify({'message': f'User with ID {user_id} updated successfully'}), 200
+        # Validate the request data, the same rules as for a new user
+        invalid = _validate_new_user(data)
+        if invalid:
+            return jsonify({'message': invalid[0],
+                            'error': invalid[1]}), 400
+        # Check if user exists before paying for the hash
+        if not store.exists('users', user_id):
+            return jsonify({'message': f'User with ID {user_id} not found',
+                            'error': 'User not found'}), 400
+        # Hash before taking the lock, other users on the same lock stripe would wait for it
+        data['password'] = current_app.extensions['passwords'].hash(data['password'])
+        # Hold the record lock so concurrent writes to this user can't interleave
+        with store.lock('users', user_id):
+            # Read current user data
+            user_data = store.get('users', user_id)
+            # Check if user still exists
+            if user_data is None:
+                return jsonify({'message': f'User with ID {user_id} not found',
+                                'error': 'User not found'}), 400
+            # Reject the write if the client's copy of the record is out of date
+            if precondition_failed(user_data):
+                return precondition_failed_response()
+            # Preserve the user_id
+            data['id_user'] = user_id
+            # Write updated data
+            store.put('users', user_id, data)
+            return with_etag(jsonify({'message': f'User with ID {user_id} updated successfully'}), data), 200
+    except PasswordQueueFull:
+        return password_queue_full_response()
     except FileNotFoundError:
         return jsonify({'message': 'File not found',
                         'error': 'FileNotFoundError'}), 500
@@ -195,34 +230,45 @@ def update_full_user(user_id):
 def update_any_field_user(user_id):
     """Update any user data field for a given user ID."""
     try:
-        data_dir = os.path.join(os.getcwd(), 'data', 'users')
-        filename = os.path.join(data_dir, f'{user_id}.json')
-        # Check if user exists
-        if not os.path.exists(filename):
-            return jsonify({'message': f'User with ID {user_id} not found',
-                            'error': 'User not found'}), 400
+        store = get_store()
         # Get request data
         data = request.get_json()
         # Validate that at least one field is present to update
-        if not data:
+        if not data or not isinstance(data, dict):
             return jsonify({'message': 'No data provided for update',
                             'error': 'Missing update data'}), 400
-        if "email" in data:
-            # Check if email is valid
-            if not re.match(r"[^@]+@[^@]+\.[^@]+", data['email']):
-                return jsonify({'message': 'Invalid email',
-                                'error': 'Invalid email'}), 400
-        # Read current user data
-        with open(filename, 'r', encoding='utf-8') as f:
-            user_data = json.load(f)
-        # Update the provided fields
-        for field in data:
-            if field in user_data:
-                user_data[field] = data[field]
-        # Write updated data back
-        with open(filename, 'w', encoding='utf-8') as f:
-            json.dump(user_data, f, indent=4, ensure_ascii=False)
-        return jsonify({'message': f'User with ID {user_id} updated successfully'}), 200
+        # Validate the fields provided
+        invalid = _validate_user_fields(data)
+        if invalid:
+            return jsonify({'message': invalid[0],
+                            'error': invalid[1]}), 400
+        # Check if user exists
+        if not store.exists('users', user_id):
+            return jsonify({'message': f'User with ID {user_id} not found',
+                            'error': 'User not found'}), 400
+        if "password" in data:
+            # Hash before taking the lock, other users on the same lock stripe would wait for it
+            data['password'] = current_app.extensions['passwords'].hash(data['password'])
+        # Hold the record lock so concurrent writes to this user can't interleave
+        with store.lock('users', user_id):
+            # Read current user data
+            user_data = store.get('users', user_id)
+            # Check if user still exists
+            if user_data is None:
+                return jsonify({'message': f'User with ID {user_id} not found',
+                                'error': 'User not found'}), 400
+            # Reject the write if the client's copy of the record is out of date
+            if precondition_failed(user_data):
+                return precondition_failed_response()
+            # Update the provided fields
+            for field in data:
+                if field in user_data:
+                    user_data[field] = data[field]
+            # Write updated data back
+            store.put('users', user_id, user_data)
+            return with_etag(jsonify({'message': f'User with ID {user_id} updated successfully'}), user_data), 200
+    except PasswordQueueFull:
+        return password_queue_full_response()
     except FileNotFoundError:
         return jsonify({'message': 'File not found',
                         'error': 'FileNotFoundError'}), 500
@@ -238,3 +284,216 @@ def update_any_field_user(user_id):
     except Exception as e:
         return jsonify({'message': 'Internal server error',
                         'error': str(e)}), 500
+
+
+def create_users_batch():
+    """Create many users in one request and return one result per user."""
+    try:
+        items = read_batch()
+        store = get_store()
+        results = [None] * len(items)
+        valid = []
+        companies_found = {}
+        # Validate the whole batch first
+        for position, item in enumerate(items):
+            invalid = _validate_new_user(item)
+            if invalid:
+                results[position] = item_error(position, *invalid)
+                continue
+            # Each company is checked only once per batch
+            company_id = item['company_id']
+            if company_id not in companies_found:
+                companies_found[company_id] = store.exists('companies', company_id)
+            if not companies_found[company_id]:
+                results[position] = item_error(position, 'Please register your company first', 'Company not found')
+                continue
+            valid.append((position, item))
+        # Refused before any ID is taken or any hash computed
+        too_many = _too_many_passwords(len(valid))
+        if too_many:
+            return too_many
+        # Hash the passwords of the whole batch at once, spread over the password pool
+        hashed = current_app.extensions['passwords'].hash_many([item['password'] for _, item in valid])
+        for (_, item), password in zip(valid, hashed):
+            item['password'] = password
+        # Save the valid users at once, the store reserves a block of IDs for them
+        created = store.create_many('users', [item for _, item in valid])
+        for (position, _), user_id in zip(valid, created):
+            results[position] = item_success(position, id_user=user_id)
+        return batch_response(results)
+    except BatchError as e:
+        return batch_error_response(e)
+    except PasswordQueueFull:
+        return password_queue_full_response()
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found',
+                        'error': 'FileNotFoundError'}), 500
+    except json.JSONDecodeError:
+        return jsonify({'message': 'Error processing JSON file',
+                        'error': 'json.JSONDecodeError'}), 500
+    except PermissionError:
+        return jsonify({'message': 'Permission denied to access files',
+                        'error': 'PermissionError'}), 500
+    except OSError:
+        return jsonify({'message': 'Error manipulating system files',
+                        'error': 'OSError'}), 500
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+def update_users_batch():
+    """Update fields of many users in one request. Each item carries the id_user and the fields to change."""
+    try:
+        items = read_batch()
+        store = get_store()
+        results = [None] * len(items)
+        valid = []
+        # Validate the whole batch first
+        for position, item in enumerate(items):
+            if not isinstance(item, dict) or not valid_id(item.get('id_user')):
+                results[position] = item_error(position, 'Each item needs an integer id_user', 'Missing id_user')
+                continue
+            data = {field: value for field, value in item.items() if field != 'id_user'}
+            # Validate that at least one field is present to update
+            if not data:
+                results[position] = item_error(position, 'No data provided for update', 'Missing update data')
+                continue
+            # Validate the fields provided
+            invalid = _validate_user_fields(data)
+            if invalid:
+                results[position] = item_error(position, *invalid)
+                continue
+            valid.append((position, item['id_user'], data))
+        # Hash the new passwords of the whole batch at once, spread over the password pool
+        changing = [data for _, _, data in valid if 'password' in data]
+        too_many = _too_many_passwords(len(changing))
+        if too_many:
+            return too_many
+        hashed = current_app.extensions['passwords'].hash_many([data['password'] for data in changing])
+        for data, password in zip(changing, hashed):
+            data['password'] = password
+        for position, user_id, data in valid:
+            with store.lock('users', user_id):
+                user_data = store.get('users', user_id)
+                if user_data is None:
+                    results[position] = item_error(position, f'User with ID {user_id} not found', 'User not found')
+                    continue
+                # Update the provided fields
+                for field in data:
+                    if field in user_data:
+                        user_data[field] = data[field]
+                store.put('users', user_id, user_data)
+            results[position] = item_success(position, id_user=user_id)
+        return batch_response(results)
+    except BatchError as e:
+        return batch_error_response(e)
+    except PasswordQueueFull:
+        return password_queue_full_response()
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found',
+                        'error': 'FileNotFoundError'}), 500
+    except json.JSONDecodeError:
+        return jsonify({'message': 'Error processing JSON file',
+                        'error': 'json.JSONDecodeError'}), 500
+    except PermissionError:
+        return jsonify({'message': 'Permission denied to access files',
+                        'error': 'PermissionError'}), 500
+    except OSError:
+        return jsonify({'message': 'Error manipulating system files',
+                        'error': 'OSError'}), 500
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+def verify_user_password(user_id):
+    """Check a password against the one stored for a user, without ever sending the stored one."""
+    try:
+        data = request.get_json()
+        if not isinstance(data, dict) or not _valid_password(data.get('password')):
+            return jsonify({'message': 'Incomplete data',
+                            'error': 'Missing password'}), 400
+        store = get_store()
+        user_data = store.get('users', user_id)
+        if user_data is None:
+            return jsonify({'message': f'User with ID {user_id} not found',
+                            'error': 'User not found'}), 400
+        hasher = current_app.extensions['passwords']
+        stored = user_data.get('password')
+        valid = hasher.verify(data['password'], stored)
+        # Passwords saved in plaintext or with an older work factor are hashed again once known
+        if valid and hasher.needs_rehash(stored):
+            rehashed = hasher.hash(data['password'])
+            with store.lock('users', user_id):
+                user_data = store.get('users', user_id)
+                # Unless the password changed in the meantime
+                if user_data is not None and user_data.get('password') == stored:
+                    user_data['password'] = rehashed
+                    store.put('users', user_id, user_data)
+        return jsonify({'valid': valid}), 200
+    except PasswordQueueFull:
+        return password_queue_full_response()
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found',
+                        'error': 'FileNotFoundError'}), 500
+    except json.JSONDecodeError:
+        return jsonify({'message': 'Error processing JSON file',
+                        'error': 'json.JSONDecodeError'}), 500
+    except PermissionError:
+        return jsonify({'message': 'Permission denied to access files',
+                        'error': 'PermissionError'}), 500
+    except OSError:
+        return jsonify({'message': 'Error manipulating system files',
+                        'error': 'OSError'}), 500
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+def delete_users_batch():
+    """Delete many users in one request. The body is the list of user IDs."""
+    try:
+        items = read_batch()
+        user_ids = [item for item in items if valid_id(item)]
+        deleted = set(get_store().delete_many('users', user_ids))
+        results = []
+        for position, user_id in enumerate(items):
+            if not valid_id(user_id):
+                results.append(item_error(position, 'User IDs must be integers', 'Invalid user ID'))
+            elif user_id in deleted:
+                results.append(item_success(position, id_user=user_id))
+            else:
+                results.append(item_error(position, f'User with ID {user_id} not found', 'User not found'))
+        return batch_response(results)
+    except BatchError as e:
+        return batch_error_response(e)
+    except FileNotFoundError:
+        return jsonify({'message': 'File not found',
+                        'error': 'FileNotFoundError'}), 500
+    except json.JSONDecodeError:
+        return jsonify({'message': 'Error processing JSON file',
+                        'error': 'json.JSONDecodeError'}), 500
+    except PermissionError:
+        return jsonify({'message': 'Permission denied to access files',
+                        'error': 'PermissionError'}), 500
+    except OSError:
+        return jsonify({'message': 'Error manipulating system files',
+                        'error': 'OSError'}), 500
+    except Exception as e:
+        return jsonify({'message': 'Internal server error',
+                        'error': str(e)}), 500
+
+
+# Routes of the users endpoints, registered by create_app()
+users_bp = Blueprint('users', __name__)
+users_bp.add_url_rule('/users', view_func=create_user, methods=['POST'])
+users_bp.add_url_rule('/users', view_func=get_users, methods=['GET'])
+users_bp.add_url_rule('/users/<int:user_id>', view_func=get_user, methods=['GET'])
+users_bp.add_url_rule('/users/<int:user_id>', view_func=delete_user, methods=['DELETE'])
+users_bp.add_url_rule('/users/<int:user_id>', view_func=update_full_user, methods=['PUT'])
+users_bp.add_url_rule('/users/<int:user_id>', view_func=update_any_field_user, methods=['PATCH'])
+users_bp.add_url_rule('/users/<int:user_id>/verify-password', view_func=verify_user_password, methods=['POST'])
+users_bp.add_url_rule('/users:batch', view_func=create_users_batch, methods=['POST'])
+users_bp.add_url_rule('/users:batch', view_func=update_users_batch, methods=['PATCH'])
+users_bp.add_url_rule('/users:batch', view_func=delete_users_batch, methods=['DELETE'])
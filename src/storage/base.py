@@ -0,0 +1,205 @@
+import os
+import threading
+from storage.locks import RecordLocks
+
+# Primary key field of each entity
+ID_FIELDS = {
+    'companies': 'company_id',
+    'users': 'id_user',
+}
+
+# Fields that can be queried without a full scan
+INDEXED_FIELDS = {
+    'companies': ('cnpj',),
+    'users': ('company_id', 'email'),
+}
+
+# Indexed fields that no two records may share
+UNIQUE_FIELDS = {
+    'companies': ('cnpj',),
+}
+
+
+class DuplicateValueError(Exception):
+    """Raised when a write would give a unique field a value another record already has."""
+
+    def __init__(self, entity, field, value):
+        super().__init__(f'{entity}.{field} {value!r} already exists')
+        self.entity = entity
+        self.field = field
+        self.value = value
+
+
+class InvalidValueError(ValueError):
+    """Raised when a write would give an indexed field a value that can't be indexed (a list or an object)."""
+
+    def __init__(self, entity, field, value):
+        super().__init__(f'{entity}.{field} can\'t be indexed: {value!r}')
+        self.entity = entity
+        self.field = field
+        self.value = value
+
+
+def indexable(value):
+    """Tell whether a value can be a key of an index: any JSON scalar, not a list or an object."""
+    try:
+        hash(value)
+    except TypeError:
+        return False
+    return True
+
+
+def check_indexed_values(entity, records):
+    """Raise InvalidValueError if an indexed field of one of the records can't be indexed.
+
+    Backends call it before writing anything, so a bad value never reaches the disk.
+    """
+    for record in records:
+        for field in INDEXED_FIELDS.get(entity, ()):
+            if field in record and not indexable(record[field]):
+                raise InvalidValueError(entity, field, record[field])
+
+
+class Storage:
+    """Interface every storage backend implements. Records are dicts, entities are 'users' and 'companies'."""
+
+    def __init__(self, lock_dir=None):
+        # With a lock_dir the record locks are also held across processes (fcntl)
+        self._locks = RecordLocks(ID_FIELDS, lock_dir=lock_dir)
+        self._revision = 0
+        self._revision_lock = threading.Lock()
+        # Tells apart the counters of different processes and restarts
+        self._revision_token = os.urandom(4).hex()
+
+    def lock(self, entity, record_id):
+        """Context manager holding the lock of one record, for read-modify-write sequences."""
+        return self._locks.hold(entity, record_id)
+
+    def lock_many(self, entity, record_ids):
+        """Context manager holding the locks of many records, for batches of read-modify-write sequences."""
+        return self._locks.hold_many(entity, record_ids)
+
+    def revision(self):
+        """Return a token that changes on every write to the store, used for the ETag and cache of list responses."""
+        return f'{self._revision_token}-{self._revision}'
+
+    def _changed(self):
+        """Called by backends after every successful write."""
+        with self._revision_lock:
+            self._revision += 1
+
+    def load(self):
+        """Warm up sequences, indexes and connections before serving requests."""
+
+    def warm_cache(self, records):
+        """Read up to `records` of the most recent records of each entity into the cache, if the backend has one."""
+
+    def after_fork(self):
+        """Called in each worker process after the server forked it from the process that loaded the store."""
+        self._locks.after_fork()
+        self._revision_lock = threading.Lock()
+        # Every worker counts its own writes, the token keeps their ETags apart
+        self._revision_token = os.urandom(4).hex()
+
+    def close(self):
+        """Release files and connections."""
+        self._locks.close()
+
+    def stats(self):
+        """Return backend counters (cache hits, ...) as a dict."""
+        return {}
+
+    def get(self, entity, record_id):
+        """Return the record with the given ID, or None."""
+        raise NotImplementedError
+
+    def get_many(self, entity, record_ids):
+        """Return the records with the given IDs that exist, in the order of `record_ids`."""
+        records = []
+        for record_id in record_ids:
+            record = self.get(entity, record_id)
+            if record is not None:
+                records.append(record)
+        return records
+
+    def exists(self, entity, record_id):
+        """Return True if a record with the given ID exists."""
+        return self.get(entity, record_id) is not None
+
+    def create(self, entity, record):
+        """Assign a new ID to the record (stored in its ID field), save it and return the ID."""
+        raise NotImplementedError
+
+    def create_many(self, entity, records):
+        """Create many records at once. Return, for each record, its new ID or the DuplicateValueError that rejected it."""
+        results = []
+        for record in records:
+            try:
+                results.append(self.create(entity, record))
+            except DuplicateValueError as e:
+                results.append(e)
+        return results
+
+    def put(self, entity, record_id, record):
+        """Save the record under the given ID, replacing any previous version."""
+        raise NotImplementedError
+
+    def bulk_put(self, entity, records):
+        """Save many records that already carry their ID. Return, for each record, None or the
+        DuplicateValueError that rejected it."""
+        id_field = ID_FIELDS[entity]
+        results = []
+        for record in records:
+            try:
+                self.put(entity, record[id_field], record)
+                results.append(None)
+            except DuplicateValueError as e:
+                results.append(e)
+        return results
+
+    def delete(self, entity, record_id):
+        """Delete the record with the given ID. Return False if it didn't exist."""
+        raise NotImplementedError
+
+    def delete_many(self, entity, record_ids):
+        """Delete many records at once and return the IDs that existed."""
+        return [record_id for record_id in record_ids if self.delete(entity, record_id)]
+
+    def delete_where(self, entity, field, value):
+        """Delete every record whose indexed `field` equals `value` and return their IDs."""
+        id_field = ID_FIELDS[entity]
+        deleted = []
+        for record in self.query(entity, field, value):
+            if self.delete(entity, record[id_field]):
+                deleted.append(record[id_field])
+        return deleted
+
+    def changes(self, after_seq, limit, entity=None):
+        """Return up to `limit` writes made after the sequence number `after_seq`, oldest first,
+        as (seq, entity, op, record_id) tuples. `op` is 'create', 'update' or 'delete'."""
+        raise NotImplementedError
+
+    def change_bounds(self):
+        """Return (first, last): the oldest sequence number still in the change log and the newest one (0 if none)."""
+        raise NotImplementedError
+
+    def scan(self, entity, after_id=None, limit=None):
+        """Yield the records of an entity ordered by ID, starting after `after_id` and stopping after `limit`."""
+        raise NotImplementedError
+
+    def query(self, entity, field, value):
+        """Return the records whose indexed `field` equals `value`, ordered by ID."""
+        raise NotImplementedError
+
+    def query_prefix(self, entity, field, prefix):
+        """Return the records whose indexed `field` is a str starting with `prefix`, ordered by ID."""
+        return [record for record in self.scan(entity)
+                if isinstance(record.get(field), str) and record[field].startswith(prefix)]
+
+    def query_ids(self, entity, field, value):
+        """Return the sorted IDs of the records whose indexed `field` equals `value`, without reading them."""
+        return [record[ID_FIELDS[entity]] for record in self.query(entity, field, value)]
+
+    def query_prefix_ids(self, entity, field, prefix):
+        """Return the sorted IDs of the records whose indexed `field` is a str starting with `prefix`."""
+        return [record[ID_FIELDS[entity]] for record in self.query_prefix(entity, field, prefix)]
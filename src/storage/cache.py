@@ -0,0 +1,83 @@
+import threading
+from collections import OrderedDict
+
+
+class RecordCache:
+    """Bounded LRU cache of parsed records, limited both by entry count and by total size in bytes.
+
+    Every entry carries a stamp (mtime, inode, size of the file it was read
+    from). A lookup with a different stamp is a miss, so files edited outside
+    the API are never served stale. A lookup without a stamp trusts the entry:
+    the caller drops the records written since it was cached.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key, stamp=None):
+        """Return a copy of the cached record if its stamp still matches (or none is given), else None."""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            if stamp is not None and entry[0] != stamp:
+                self._remove(key)
+                self.invalidations += 1
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        # Handlers modify the records they get, never hand out the cached dict itself
+        return dict(entry[1])
+
+    def put(self, key, stamp, record, size):
+        """Cache a record read from a file of `size` bytes, evicting the least recently used entries."""
+        if size > self.max_bytes or self.max_entries < 1:
+            return
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (stamp, dict(record), size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """Drop a record, called on every write and delete."""
+        with self._lock:
+            if self._remove(key):
+                self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return False
+        self._bytes -= entry[2]
+        return True
+
+    def stats(self):
+        """Return the cache counters."""
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions,
+                    'invalidations': self.invalidations,
+                    'entries': len(self._entries),
+                    'bytes': self._bytes,
+                    'max_entries': self.max_entries,
+                    'max_bytes': self.max_bytes}
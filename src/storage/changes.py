@@ -0,0 +1,132 @@
+import os
+import json
+import threading
+from bisect import bisect_right
+from contextlib import contextmanager
+
+# fcntl is only available on POSIX systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ChangeLog:
+    """Bounded, persistent log of the writes made to a store, shared by every process using the data directory.
+
+    Each write appends a line [seq, entity, op, record_id] under a file lock,
+    so sequence numbers grow across processes. Each process keeps the last
+    entries in memory and reads the lines appended by the others when asked.
+    Once the file holds twice `max_entries` lines it is rewritten with the
+    last `max_entries`.
+    """
+
+    def __init__(self, log_file, max_entries=100000):
+        self.log_file = log_file
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # (seq, entity, op, record_id) tuples in seq order
+        self._entries = []
+        self._offset = 0
+        self._inode = None
+        self._lines = 0
+
+    def load(self):
+        os.makedirs(os.path.dirname(self.log_file), exist_ok=True)
+        with self._lock:
+            self._refresh()
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        """Hold the file lock giving out sequence numbers."""
+        with open(f'{self.log_file}.lock', 'a', encoding='utf-8') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _refresh(self):
+        """Read the lines appended since the last call, by this process or another one."""
+        try:
+            f = open(self.log_file, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            # fstat() of the open file, a compaction may replace the path meanwhile
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                # Rewritten by a compaction, read it again from the start
+                self._entries = []
+                self._offset = 0
+                self._lines = 0
+                self._inode = stat.st_ino
+            if stat.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            data = f.read()
+        # A line being written by another process is read next time
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                self._entries.append(tuple(json.loads(line)))
+            except json.JSONDecodeError:
+                # A torn line from a crash, the writes after it follow
+                continue
+            self._lines += 1
+        self._offset += end
+        if len(self._entries) > 2 * self.max_entries:
+            del self._entries[:-self.max_entries]
+
+    def bounds(self):
+        """Return (first, last): the oldest sequence number still in the log and the newest one (0 if none)."""
+        with self._lock:
+            self._refresh()
+            if not self._entries:
+                return 1, 0
+            return self._entries[-min(len(self._entries), self.max_entries)][0], self._entries[-1][0]
+
+    def append(self, entity, op, record_ids):
+        """Record one write (op 'create', 'update' or 'delete') per record ID."""
+        if not record_ids:
+            return
+        with self._lock, self._locked():
+            self._refresh()
+            seq = self._entries[-1][0] if self._entries else 0
+            lines = []
+            for record_id in record_ids:
+                seq += 1
+                lines.append(json.dumps([seq, entity, op, record_id]) + '\n')
+            # One write, so the lines of a batch are never interleaved with another process's
+            with open(self.log_file, 'a', encoding='utf-8') as f:
+                f.write(''.join(lines))
+            self._refresh()
+            if self._lines > 2 * self.max_entries:
+                self._compact()
+
+    def read(self, after_seq, limit, entity=None):
+        """Return up to `limit` (seq, entity, op, record_id) entries after `after_seq`, of one entity or all."""
+        changes = []
+        with self._lock:
+            self._refresh()
+            start = max(len(self._entries) - self.max_entries,
+                        bisect_right(self._entries, after_seq, key=lambda entry: entry[0]))
+            for position in range(start, len(self._entries)):
+                entry = self._entries[position]
+                if entity is None or entry[1] == entity:
+                    changes.append(entry)
+                    if len(changes) >= limit:
+                        break
+        return changes
+
+    def _compact(self):
+        """Rewrite the log with its last `max_entries` lines (file lock held)."""
+        tmp_file = f'{self.log_file}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for entry in self._entries[-self.max_entries:]:
+                f.write(json.dumps(list(entry)) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.log_file)
+        self._refresh()
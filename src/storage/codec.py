@@ -0,0 +1,80 @@
+import json
+import warnings
+
+# Optional faster codecs, the stdlib json codec is always available
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class JsonCodec:
+    """Compact JSON with the standard library."""
+
+    name = 'json'
+
+    def dumps(self, record):
+        return json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class OrjsonCodec:
+    """Compact JSON with orjson, falling back to the stdlib for values orjson refuses (huge ints, non-str keys)."""
+
+    name = 'orjson'
+
+    def dumps(self, record):
+        try:
+            return orjson.dumps(record)
+        except TypeError:
+            return JsonCodec().dumps(record)
+
+
+class MsgpackCodec:
+    """Binary MessagePack."""
+
+    name = 'msgpack'
+
+    def dumps(self, record):
+        return msgpack.packb(record, use_bin_type=True)
+
+
+def _available():
+    codecs = {'json': JsonCodec}
+    if orjson is not None:
+        codecs['orjson'] = OrjsonCodec
+    if msgpack is not None:
+        codecs['msgpack'] = MsgpackCodec
+    return codecs
+
+
+def get_codec(name):
+    """Return the codec used to write records. Unavailable codecs fall back to stdlib JSON."""
+    codecs = _available()
+    if name in codecs:
+        return codecs[name]()
+    if name not in ('orjson', 'msgpack'):
+        raise ValueError(f'Unknown record codec: {name}')
+    warnings.warn(f'Record codec {name!r} is not installed, using compact JSON instead')
+    return JsonCodec()
+
+
+def loads(data):
+    """Decode a record written by any codec, pretty-printed JSON included. The format is detected from the first byte."""
+    if isinstance(data, str):
+        data = data.encode('utf-8')
+    first = data.lstrip()[:1]
+    if first in (b'{', b'['):
+        if orjson is not None:
+            return orjson.loads(data)
+        return json.loads(data)
+    # MessagePack maps start with 0x80-0x8f (fixmap), 0xde (map16) or 0xdf (map32)
+    if first and (0x80 <= first[0] <= 0x8f or first[0] in (0xde, 0xdf)):
+        if msgpack is None:
+            raise ValueError('Record is stored as MessagePack but msgpack is not installed')
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+    # Empty or unknown content, let the JSON decoder report it like any corrupt file
+    return json.loads(data)
@@ -0,0 +1,100 @@
+import os
+import sys
+import ctypes
+import ctypes.util
+
+# inotify(7) flags: a file of the watched directory written, created or renamed into it
+IN_MODIFY = 0x2
+IN_MOVED_TO = 0x80
+IN_CREATE = 0x100
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+MODES = ('auto', 'inotify', 'poll')
+
+
+def _load_libc():
+    """Return the C library if it has inotify (Linux), else None."""
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+
+_libc = _load_libc()
+
+
+class ChangeWatcher:
+    """Tells whether a change log was written since the last call, by this process or any other.
+
+    With inotify (Linux) the kernel queues an event on every write to the
+    log's directory and the check is a non-blocking read. Otherwise, or when
+    inotify can't be used, it compares the log's stat(). Both are exact: a
+    write that returned before the check is always seen.
+    """
+
+    def __init__(self, log_file, mode='auto'):
+        if mode not in MODES:
+            raise ValueError(f'Unknown change watcher mode: {mode}')
+        if mode == 'inotify' and _libc is None:
+            raise RuntimeError('inotify is not available on this system')
+        self.log_file = log_file
+        self.mode = 'poll' if mode == 'poll' or _libc is None else 'inotify'
+        self._fd = None
+        self._pid = None
+        self._stamp = None
+
+    def changed(self):
+        """Return True if the log may have been written since the last call (always True on the first one)."""
+        if self.mode == 'inotify':
+            if self._pid != os.getpid():
+                # A descriptor inherited from the parent would share its events with it: watch on our own
+                return self._open()
+            return self._drain()
+        try:
+            stat = os.stat(self.log_file)
+            stamp = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+        except FileNotFoundError:
+            stamp = None
+        if stamp == self._stamp:
+            return False
+        self._stamp = stamp
+        return True
+
+    def _open(self):
+        if self._fd is not None:
+            # Our copy of the parent's descriptor, closing it doesn't affect the parent
+            os.close(self._fd)
+            self._fd = None
+        fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if fd < 0 or _libc.inotify_add_watch(fd, os.path.dirname(self.log_file).encode(),
+                                             IN_MODIFY | IN_MOVED_TO | IN_CREATE) < 0:
+            # Out of inotify instances or watches (fs.inotify.max_user_*): poll instead
+            if fd >= 0:
+                os.close(fd)
+            self.mode = 'poll'
+            return True
+        self._fd = fd
+        self._pid = os.getpid()
+        return True
+
+    def _drain(self):
+        changed = False
+        while True:
+            try:
+                if not os.read(self._fd, 65536):
+                    return changed
+            except BlockingIOError:
+                return changed
+            changed = True
+
+    def close(self):
+        if self._fd is not None and self._pid == os.getpid():
+            os.close(self._fd)
+        self._fd = None
+        self._pid = None
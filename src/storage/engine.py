@@ -0,0 +1,58 @@
+import os
+import threading
+import config
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def load_settings(overrides=None):
+    """Return the settings of config.py as a dict, with `overrides` applied."""
+    settings = {name: getattr(config, name) for name in dir(config) if name.isupper()}
+    settings.update(overrides or {})
+    return settings
+
+
+def create_store(settings=None):
+    """Build the storage backend selected by STORAGE_BACKEND ('files', 'sqlite' or 'log').
+
+    `settings` is any mapping with the names of config.py (app.config for
+    instance), by default the values of config.py itself.
+    """
+    settings = settings if settings is not None else load_settings()
+    backend = settings['STORAGE_BACKEND']
+    data_dir = settings['DATA_DIR']
+    lock_dir = os.path.join(data_dir, 'locks') if settings['FILE_LOCKS'] else None
+    if backend == 'files':
+        from storage.files import FileStorage
+        return FileStorage(data_dir, settings['CACHE_MAX_ENTRIES'], settings['CACHE_MAX_BYTES'],
+                           settings['RECORD_CODEC'], settings['FSYNC_WRITES'], lock_dir, settings['IO_THREADS'],
+                           settings['CHANGELOG_MAX_ENTRIES'], settings['FILE_LAYOUT'],
+                           settings['CACHE_COHERENCE'])
+    if backend == 'sqlite':
+        from storage.sqlite import SQLiteStorage
+        sqlite_path = settings['SQLITE_PATH'] or os.path.join(data_dir, 'api.sqlite3')
+        return SQLiteStorage(sqlite_path, settings['RECORD_CODEC'], lock_dir, settings['CHANGELOG_MAX_ENTRIES'])
+    if backend == 'log':
+        from storage.log import LogStorage
+        return LogStorage(os.path.join(data_dir, 'log'), settings['RECORD_CODEC'], settings['FSYNC_WRITES'], lock_dir,
+                          settings['LOG_SEGMENT_BYTES'], settings['LOG_COMPACT_RATIO'], settings['LOG_COMPACT_INTERVAL'],
+                          settings['CHANGELOG_MAX_ENTRIES'])
+    raise ValueError(f'Unknown storage backend: {backend}')
+
+
+def get_store():
+    """Return the storage backend shared by all route handlers."""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                _store = create_store()
+    return _store
+
+
+def set_store(store):
+    """Replace the shared storage backend."""
+    global _store
+    with _store_lock:
+        _store = store
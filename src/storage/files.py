@@ -0,0 +1,512 @@
+import os
+import threading
+from array import array
+from bisect import bisect_left, bisect_right
+from storage.base import Storage, DuplicateValueError, ID_FIELDS, INDEXED_FIELDS, UNIQUE_FIELDS, check_indexed_values
+from storage.sequences import IdSequence
+from storage.indexes import FieldIndex
+from storage.cache import RecordCache
+from storage.pool import IoPool
+from storage.changes import ChangeLog
+from storage.coherence import ChangeWatcher
+from storage.layout import LAYOUTS, record_path, iter_records, stored_layout, set_stored_layout
+from storage import codec
+from metrics import count_io
+
+# Up to this many records changed since the last listing, its ID array is patched in place of being rebuilt
+ID_PATCH_LIMIT = 1000
+
+
+def _patched(ids, changes):
+    """Return a new sorted ID array: `ids` plus the records created and minus the ones deleted by `changes`."""
+    # Last operation of each record: there unless it was deleted
+    present = {}
+    for _, _, op, record_id in changes:
+        present[record_id] = op != 'delete'
+    if len(present) > ID_PATCH_LIMIT:
+        remaining = set(ids).difference(record_id for record_id, there in present.items() if not there)
+        return array('q', sorted(remaining.union(record_id for record_id, there in present.items() if there)))
+    # A copy: other threads may still be iterating the old array
+    ids = array('q', ids)
+    for record_id, there in present.items():
+        position = bisect_left(ids, record_id)
+        found = position < len(ids) and ids[position] == record_id
+        if there and not found:
+            ids.insert(position, record_id)
+        elif not there and found:
+            del ids[position]
+    return ids
+
+
+class FileStorage(Storage):
+    """One file per record, encoded with the configured codec: <data_dir>/<entity>/<id>.json, or
+    <data_dir>/<entity>/ab/cd/<id>.json with the sharded layout (see storage/layout.py)."""
+
+    def __init__(self, data_dir, cache_entries=10000, cache_bytes=64 * 1024 * 1024, codec_name='json',
+                 fsync=True, lock_dir=None, io_threads=16, changelog_entries=100000, layout='flat',
+                 coherence='stat'):
+        super().__init__(lock_dir)
+        if layout not in LAYOUTS:
+            raise ValueError(f'Unknown file layout: {layout}')
+        self.data_dir = data_dir
+        self.layout = layout
+        self.fsync = fsync
+        self.codec = codec.get_codec(codec_name)
+        self._cache = RecordCache(cache_entries, cache_bytes)
+        self._io = IoPool(io_threads)
+        self._sequences = {}
+        self._indexes = {}
+        self._changes = ChangeLog(os.path.join(data_dir, 'changes', 'changes.log'), changelog_entries)
+        # The cache and the indexes follow the writes of every process through the change log, so cached
+        # records are served without a stat(). 'stat' checks each record file instead, which also notices
+        # files edited outside the API
+        self._watcher = ChangeWatcher(self._changes.log_file, coherence) if coherence != 'stat' else None
+        self._sync_lock = threading.Lock()
+        # Last change log seq applied to the cache, and a count of the catch-ups done
+        self._synced = 0
+        self._generation = 0
+        # Entities whose files may still be in the other layout: a migration not run yet, or running
+        self._mixed = {}
+        # entity -> (change log seq, sorted array of the record IDs at that seq)
+        self._id_lists = {}
+        self._ids_lock = threading.Lock()
+        for entity in ID_FIELDS:
+            entity_dir = os.path.join(data_dir, entity)
+            os.makedirs(entity_dir, exist_ok=True)
+            stored = stored_layout(entity_dir)
+            if stored is None:
+                # A new directory starts in the configured layout
+                set_stored_layout(entity_dir, layout)
+                stored = layout
+            self._mixed[entity] = stored != layout
+            self._sequences[entity] = IdSequence(entity_dir, os.path.join(data_dir, 'sequences', f'{entity}.seq'))
+            for field in INDEXED_FIELDS.get(entity, ()):
+                self._indexes[(entity, field)] = FieldIndex(
+                    entity_dir, field, os.path.join(data_dir, 'indexes', f'{entity}.{field}.log'))
+
+    def load(self):
+        for sequence in self._sequences.values():
+            sequence.load()
+        for index in self._indexes.values():
+            index.load()
+        self._changes.load()
+        if self._watcher is not None:
+            # Watch from now on, the cache starts empty
+            self._watcher.changed()
+            self._synced = self._changes.bounds()[1]
+
+    def warm_cache(self, records):
+        for entity in ID_FIELDS:
+            # Read in parallel, consuming the results is enough to fill the cache
+            for _ in self._io.map(lambda record_id: self._load(entity, record_id, True), self._ids(entity)[-records:]):
+                pass
+
+    def after_fork(self):
+        super().after_fork()
+        self._io.after_fork()
+        for sequence in self._sequences.values():
+            sequence.after_fork()
+        for index in self._indexes.values():
+            index.after_fork()
+        self._changes.after_fork()
+        self._ids_lock = threading.Lock()
+        self._sync_lock = threading.Lock()
+
+    def _path(self, entity, record_id):
+        return record_path(os.path.join(self.data_dir, entity), record_id, self.layout)
+
+    def _other_path(self, entity, record_id):
+        """Path of the record in the layout it is being migrated from."""
+        other = 'flat' if self.layout == 'sharded' else 'sharded'
+        return record_path(os.path.join(self.data_dir, entity), record_id, other)
+
+    def _is_mixed(self, entity):
+        """Tell whether the files of an entity may be in both layouts, noticing a migration started after load()."""
+        if not self._mixed[entity]:
+            self._mixed[entity] = stored_layout(os.path.join(self.data_dir, entity)) != self.layout
+        return self._mixed[entity]
+
+    def _stat(self, entity, record_id):
+        """Return the path and stat() of a record file, or (None, None) when there is none."""
+        path = self._path(entity, record_id)
+        try:
+            return path, os.stat(path)
+        except FileNotFoundError:
+            if not self._is_mixed(entity):
+                return None, None
+        # Not moved to this layout yet
+        path = self._other_path(entity, record_id)
+        try:
+            return path, os.stat(path)
+        except FileNotFoundError:
+            return None, None
+
+    def _sync(self):
+        """Catch up with the writes of every process: drop the records they changed from the cache
+        and read their index updates. One syscall when nothing was written."""
+        if self._watcher is None:
+            return
+        with self._sync_lock:
+            if not self._watcher.changed():
+                return
+            first, last = self._changes.bounds()
+            if self._synced < first - 1 or self._synced > last:
+                # More writes than the change log keeps: no telling which records changed
+                self._cache.clear()
+            elif last > self._synced:
+                for _, entity, _, record_id in self._changes.read(self._synced, last - self._synced):
+                    self._cache.invalidate((entity, record_id))
+            self._synced = last
+            self._generation += 1
+            for index in self._indexes.values():
+                index.refresh()
+
+    def _index(self, entity, field):
+        index = self._indexes[(entity, field)]
+        if self._watcher is None:
+            # Nothing tells when other processes wrote, read their journal lines now
+            index.refresh()
+        return index
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _read(self, path):
+        # Any format is accepted, so files written before a codec change stay readable
+        with open(path, 'rb') as f:
+            data = f.read()
+        count_io(files_opened=1, bytes_read=len(data))
+        return codec.loads(data)
+
+    def _write(self, path, record):
+        # Write a temp file and rename it over the record: readers see the old or the new
+        # version, never a truncated one, and a crash never leaves a half-written record
+        tmp_path = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        try:
+            data = self.codec.dumps(record)
+            count_io(files_opened=1, bytes_written=len(data))
+            try:
+                f = open(tmp_path, 'wb')
+            except FileNotFoundError:
+                # First record of a shard directory
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                f = open(tmp_path, 'wb')
+            with f:
+                f.write(data)
+                if self.fsync:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except BaseException:
+            try:
+                os.remove(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
+
+    def get(self, entity, record_id):
+        self._sync()
+        return self._load(entity, record_id, fill_cache=True)
+
+    def _load(self, entity, record_id, fill_cache):
+        """Read a record through the cache. Without a change watcher, a stat() tells whether the cached copy is
+        still current."""
+        key = (entity, record_id)
+        generation = self._generation
+        if self._watcher is not None:
+            # _sync() dropped the records written since they were cached
+            record = self._cache.get(key)
+            if record is not None:
+                return record
+        path, stat = self._stat(entity, record_id)
+        if path is None:
+            self._cache.invalidate(key)
+            return None
+        stamp = (stat.st_mtime_ns, stat.st_ino, stat.st_size)
+        if self._watcher is None:
+            record = self._cache.get(key, stamp)
+            if record is not None:
+                return record
+        try:
+            record = self._read(path)
+        except FileNotFoundError:
+            return None
+        # Unless the cache caught up with other writes meanwhile: this version may be older than theirs
+        if fill_cache and (self._watcher is None or generation == self._generation):
+            self._cache.put(key, stamp, record, stat.st_size)
+        return record
+
+    def revision(self):
+        # Every write, from any worker process, is appended to the change log: its last sequence number is the
+        # same in every worker and keeps growing across restarts. The directory mtimes would miss the writes
+        # made in the shard directories
+        return str(self._changes.bounds()[1])
+
+    def get_many(self, entity, record_ids):
+        self._sync()
+        # The files are read in parallel by the I/O pool
+        records = self._io.map(lambda record_id: self._load(entity, record_id, True), record_ids)
+        return [record for record in records if record is not None]
+
+    def stats(self):
+        return {'cache': self._cache.stats()}
+
+    def close(self):
+        super().close()
+        self._io.close()
+        if self._watcher is not None:
+            self._watcher.close()
+
+    def exists(self, entity, record_id):
+        self._sync()
+        return self._stat(entity, record_id)[0] is not None
+
+    def create(self, entity, record):
+        check_indexed_values(entity, [record])
+        # Fail before taking an ID when the value is already known to be taken
+        for field in UNIQUE_FIELDS.get(entity, ()):
+            if field in record and self._indexes[(entity, field)].lookup(record[field]):
+                raise DuplicateValueError(entity, field, record[field])
+        record_id = self._sequences[entity].next_id()
+        record[ID_FIELDS[entity]] = record_id
+        with self.lock(entity, record_id):
+            self._save(entity, record_id, record)
+            self._changes.append(entity, 'create', [record_id])
+        return record_id
+
+    def create_many(self, entity, records):
+        # The whole batch is checked before the first record is written
+        check_indexed_values(entity, records)
+        # One block of IDs for the whole batch
+        record_ids = self._sequences[entity].next_block(len(records))
+        results = []
+        for record_id, record in zip(record_ids, records):
+            record[ID_FIELDS[entity]] = record_id
+            try:
+                with self.lock(entity, record_id):
+                    self._save(entity, record_id, record)
+            except DuplicateValueError as e:
+                record.pop(ID_FIELDS[entity])
+                results.append(e)
+                continue
+            results.append(record_id)
+        self._changes.append(entity, 'create', [result for result in results if isinstance(result, int)])
+        return results
+
+    def put(self, entity, record_id, record):
+        check_indexed_values(entity, [record])
+        self._sequences[entity].observe(record_id)
+        with self.lock(entity, record_id):
+            self._save(entity, record_id, record)
+            self._changes.append(entity, 'update', [record_id])
+
+    def bulk_put(self, entity, records):
+        id_field = ID_FIELDS[entity]
+        check_indexed_values(entity, records)
+        results = []
+        for record in records:
+            self._sequences[entity].observe(record[id_field])
+            try:
+                with self.lock(entity, record[id_field]):
+                    self._save(entity, record[id_field], record)
+            except DuplicateValueError as e:
+                results.append(e)
+                continue
+            results.append(None)
+        # One change log write for the whole batch
+        self._changes.append(entity, 'update', [record[id_field] for record, error in zip(records, results)
+                                                if error is None])
+        return results
+
+    def _save(self, entity, record_id, record):
+        # Claim unique values first, another request may be writing the same value
+        claimed = []
+        for field in UNIQUE_FIELDS.get(entity, ()):
+            if field not in record:
+                continue
+            index = self._indexes[(entity, field)]
+            previous = index.value_of(record_id)
+            if not index.set_value(record_id, record[field], unique=True):
+                self._release(entity, record_id, claimed)
+                raise DuplicateValueError(entity, field, record[field])
+            claimed.append((field, previous))
+        try:
+            self._write(self._path(entity, record_id), record)
+            if self._is_mixed(entity):
+                # The copy in the old layout is outdated now
+                self._remove(self._other_path(entity, record_id))
+        except OSError:
+            self._release(entity, record_id, claimed)
+            raise
+        finally:
+            self._cache.invalidate((entity, record_id))
+        self._changed()
+        # Unique values are already in place, updating them again only touches the journal
+        for field in INDEXED_FIELDS.get(entity, ()):
+            index = self._indexes[(entity, field)]
+            if field in record:
+                index.set_value(record_id, record[field])
+            else:
+                index.discard(record_id)
+
+    def _release(self, entity, record_id, claimed):
+        """Give back unique values claimed by a write that didn't happen."""
+        for field, previous in claimed:
+            index = self._indexes[(entity, field)]
+            if previous is None:
+                index.discard(record_id)
+            else:
+                index.set_value(record_id, previous)
+
+    def delete(self, entity, record_id):
+        with self.lock(entity, record_id):
+            try:
+                removed = self._remove(self._path(entity, record_id))
+                if self._is_mixed(entity):
+                    removed = self._remove(self._other_path(entity, record_id)) or removed
+            finally:
+                self._cache.invalidate((entity, record_id))
+            if not removed:
+                return False
+            for field in INDEXED_FIELDS.get(entity, ()):
+                self._indexes[(entity, field)].discard(record_id)
+            self._changed()
+            self._changes.append(entity, 'delete', [record_id])
+            return True
+
+    def delete_where(self, entity, field, value):
+        # The index says which files to remove, nothing else is read
+        self._sync()
+        deleted = []
+        for record_id in sorted(self._index(entity, field).lookup(value)):
+            if self.delete(entity, record_id):
+                deleted.append(record_id)
+        return deleted
+
+    def _ids(self, entity):
+        """Return every record ID of an entity, as a sorted array.
+
+        The directory is listed once (only file names are read), then the array
+        follows the change log, which every process writes to: listings and
+        pages don't scan millions of directory entries.
+        """
+        first, last = self._changes.bounds()
+        with self._ids_lock:
+            cached = self._id_lists.get(entity)
+            if cached is not None and cached[0] == last:
+                return cached[1]
+            if cached is None or not first - 1 <= cached[0] <= last:
+                # First listing, or the changes since the last one were discarded. A set, since
+                # a record being migrated may be listed in both layouts
+                entity_dir = os.path.join(self.data_dir, entity)
+                ids = array('q', sorted({record_id for record_id, _ in iter_records(entity_dir)}))
+            else:
+                changes = self._changes.read(cached[0], last - cached[0], entity)
+                ids = _patched(cached[1], [change for change in changes if change[0] <= last])
+            self._id_lists[entity] = (last, ids)
+            return ids
+
+    def reshard(self, entity):
+        """Move the record files of an entity still in the other layout to the configured one.
+
+        The API keeps serving meanwhile: each file is moved under its record
+        lock, and every store looks in both layouts until the move is over.
+        Returns the number of files moved.
+        """
+        entity_dir = os.path.join(self.data_dir, entity)
+        set_stored_layout(entity_dir, 'migrating')
+        self._mixed[entity] = True
+        moved = 0
+        while True:
+            # Entries removed while a directory is listed may hide others, list again until none is left
+            found = 0
+            for record_id, path in iter_records(entity_dir):
+                target = self._path(entity, record_id)
+                if path == target:
+                    continue
+                found += 1
+                with self.lock(entity, record_id):
+                    if not os.path.exists(path):
+                        # Deleted, or moved by a write, since the listing
+                        continue
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    try:
+                        # A hard link never replaces a newer version written in this layout meanwhile
+                        os.link(path, target)
+                        moved += 1
+                    except FileExistsError:
+                        pass
+                    self._remove(path)
+            if not found:
+                break
+        if self.layout == 'flat':
+            # Drop the shard directories left empty
+            with os.scandir(entity_dir) as entries:
+                shards = [entry.path for entry in entries if entry.is_dir()]
+            for shard in shards:
+                for name in os.listdir(shard):
+                    try:
+                        os.rmdir(os.path.join(shard, name))
+                    except OSError:
+                        pass
+                try:
+                    os.rmdir(shard)
+                except OSError:
+                    pass
+        set_stored_layout(entity_dir, self.layout)
+        self._mixed[entity] = False
+        # The files moved but didn't change: keep the index journals newer than the directory,
+        # or the next start would rebuild them
+        for field in INDEXED_FIELDS.get(entity, ()):
+            index = self._indexes[(entity, field)]
+            index.load()
+            os.utime(index.journal_file)
+        return moved
+
+    def changes(self, after_seq, limit, entity=None):
+        return self._changes.read(after_seq, limit, entity)
+
+    def change_bounds(self):
+        return self._changes.bounds()
+
+    def scan(self, entity, after_id=None, limit=None):
+        self._sync()
+        ids = self._ids(entity)
+        position = bisect_right(ids, after_id) if after_id is not None else 0
+        count = 0
+        # Files are read in parallel by the I/O pool, a few records ahead of the caller. A page
+        # reads exactly `limit` files, plus more only when some were deleted since the listing.
+        # Full scans use the cache but don't fill it, they would evict every hot record
+        while position < len(ids):
+            wanted = len(ids) - position if limit is None else limit - count
+            if wanted <= 0:
+                return
+            chunk = ids[position:position + wanted]
+            position += len(chunk)
+            records = self._io.map(lambda record_id: self._load(entity, record_id, False), chunk)
+            try:
+                for record in records:
+                    # Deleted since the directory was listed
+                    if record is not None:
+                        count += 1
+                        yield record
+            finally:
+                records.close()
+
+    def query(self, entity, field, value):
+        return self.get_many(entity, self.query_ids(entity, field, value))
+
+    def query_prefix(self, entity, field, prefix):
+        return self.get_many(entity, self.query_prefix_ids(entity, field, prefix))
+
+    def query_ids(self, entity, field, value):
+        self._sync()
+        return sorted(self._index(entity, field).lookup(value))
+
+    def query_prefix_ids(self, entity, field, prefix):
+        self._sync()
+        return sorted(self._index(entity, field).lookup_prefix(prefix))
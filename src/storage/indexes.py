@@ -0,0 +1,260 @@
+import os
+import json
+import logging
+import threading
+from bisect import bisect_left, insort
+from contextlib import contextmanager
+from storage import codec
+from storage.base import indexable
+from storage.layout import iter_records, tree_mtime
+
+# fcntl is only available on POSIX systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Rewrite the journal once it holds this many more lines than live entries
+COMPACT_SLACK = 1000
+
+
+class FieldIndex:
+    """Persistent value -> record IDs index over one field of an entity.
+
+    The index lives in memory and every change is appended to a journal file,
+    so updates are O(1). The journal is replayed at startup and rebuilt from
+    the data directory when it is missing or older than the directory.
+    Processes sharing the data directory append to the same journal and read
+    each other's lines before changing the index, unique values are claimed
+    under a lock of the journal.
+    """
+
+    def __init__(self, data_dir, field, journal_file):
+        self.data_dir = data_dir
+        self.field = field
+        self.journal_file = journal_file
+        self._lock = threading.Lock()
+        self._ids_by_value = {}
+        self._value_by_id = {}
+        # The distinct str values in order, for prefix lookups. Built on the first one, then kept up to date
+        self._sorted_values = None
+        self._journal = None
+        self._journal_lines = 0
+        # Position and inode of the journal lines applied so far
+        self._offset = 0
+        self._inode = None
+
+    def load(self):
+        """Replay the journal, or rebuild the index if the journal is missing or stale."""
+        with self._lock:
+            if self._journal is not None:
+                return
+            if self._is_stale():
+                self._rebuild()
+            else:
+                self._replay()
+                if self._journal_lines > len(self._value_by_id) + COMPACT_SLACK:
+                    self._compact()
+            self._journal = open(self.journal_file, 'a', encoding='utf-8')
+
+    def after_fork(self):
+        """Reopen the journal in a forked worker."""
+        self._lock = threading.Lock()
+        if self._journal is not None:
+            self._journal = open(self.journal_file, 'a', encoding='utf-8')
+
+    def rebuild(self):
+        """Drop the in-memory state and rebuild the index from the data directory."""
+        with self._lock:
+            if self._journal is not None:
+                self._journal.close()
+            self._rebuild()
+            self._journal = open(self.journal_file, 'a', encoding='utf-8')
+
+    def refresh(self):
+        """Apply the journal lines written by other processes since the last call."""
+        with self._lock:
+            if self._journal is not None:
+                self._catch_up()
+
+    def lookup(self, value):
+        """Return the set of record IDs whose field equals `value`."""
+        self._ensure_loaded()
+        with self._lock:
+            return set(self._ids_by_value.get(value, ()))
+
+    def lookup_prefix(self, prefix):
+        """Return the set of record IDs whose field is a str starting with `prefix`."""
+        self._ensure_loaded()
+        with self._lock:
+            if self._sorted_values is None:
+                self._sorted_values = sorted(value for value in self._ids_by_value if isinstance(value, str))
+            ids = set()
+            position = bisect_left(self._sorted_values, prefix)
+            while position < len(self._sorted_values) and self._sorted_values[position].startswith(prefix):
+                ids.update(self._ids_by_value[self._sorted_values[position]])
+                position += 1
+            return ids
+
+    def value_of(self, record_id):
+        """Return the indexed value of a record, or None."""
+        self._ensure_loaded()
+        with self._lock:
+            return self._value_by_id.get(record_id)
+
+    def set_value(self, record_id, value, unique=False):
+        """Point `record_id` at `value`. With `unique`, refuse (return False) if another record holds the value."""
+        self._ensure_loaded()
+        with self._lock, self._claiming(unique):
+            # Another process may have changed the record or taken the value meanwhile
+            self._catch_up()
+            owners = self._ids_by_value.get(value, ())
+            if unique and any(owner != record_id for owner in owners):
+                return False
+            if record_id in self._value_by_id and self._value_by_id[record_id] == value:
+                # Nothing changed, but keep the journal newer than the data directory
+                os.utime(self.journal_file)
+                return True
+            self._unlink(record_id)
+            self._link(record_id, value)
+            self._append([record_id, value])
+            return True
+
+    def discard(self, record_id):
+        """Remove a record from the index."""
+        self._ensure_loaded()
+        with self._lock:
+            self._catch_up()
+            if record_id not in self._value_by_id:
+                os.utime(self.journal_file)
+                return
+            self._unlink(record_id)
+            self._append([record_id])
+
+    def _ensure_loaded(self):
+        if self._journal is None:
+            self.load()
+
+    def _link(self, record_id, value):
+        self._value_by_id[record_id] = value
+        if value not in self._ids_by_value:
+            self._ids_by_value[value] = set()
+            if self._sorted_values is not None and isinstance(value, str):
+                insort(self._sorted_values, value)
+        self._ids_by_value[value].add(record_id)
+
+    def _unlink(self, record_id):
+        if record_id not in self._value_by_id:
+            return
+        value = self._value_by_id.pop(record_id)
+        owners = self._ids_by_value.get(value)
+        if owners is not None:
+            owners.discard(record_id)
+            if not owners:
+                del self._ids_by_value[value]
+                if self._sorted_values is not None and isinstance(value, str):
+                    del self._sorted_values[bisect_left(self._sorted_values, value)]
+
+    @contextmanager
+    def _claiming(self, unique):
+        """Hold the journal's file lock while a unique value is checked and claimed."""
+        if not unique:
+            yield
+            return
+        with open(f'{self.journal_file}.lock', 'a', encoding='utf-8') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            yield
+
+    def _append(self, entry):
+        # One write per line, so lines of several processes never interleave. It is applied
+        # again (with no effect) and counted when the journal is next read
+        self._journal.write(json.dumps(entry, ensure_ascii=False) + '\n')
+        self._journal.flush()
+
+    def _is_stale(self):
+        """The journal is stale when files were added or removed behind its back, in any shard."""
+        try:
+            journal_mtime = os.stat(self.journal_file).st_mtime_ns
+        except FileNotFoundError:
+            return True
+        return tree_mtime(self.data_dir) > journal_mtime
+
+    def _replay(self):
+        self._inode = None
+        self._catch_up()
+
+    def _catch_up(self):
+        """Apply the journal lines appended since the last call, by this process or another one (lock held)."""
+        try:
+            f = open(self.journal_file, 'rb')
+        except FileNotFoundError:
+            return
+        with f:
+            stat = os.fstat(f.fileno())
+            if stat.st_ino != self._inode or stat.st_size < self._offset:
+                # First read, or rewritten by another process: replay it from the start
+                if self._journal is not None:
+                    self._journal.close()
+                    self._journal = open(self.journal_file, 'a', encoding='utf-8')
+                self._ids_by_value = {}
+                self._value_by_id = {}
+                self._sorted_values = None
+                self._journal_lines = 0
+                self._offset = 0
+                self._inode = stat.st_ino
+            if stat.st_size == self._offset:
+                return
+            f.seek(self._offset)
+            data = f.read()
+        # A line being written by another process is read next time
+        end = data.rfind(b'\n') + 1
+        for line in data[:end].splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                # A torn line from a crash, the lines after it are valid
+                continue
+            self._unlink(entry[0])
+            if len(entry) == 2 and indexable(entry[1]):
+                self._link(entry[0], entry[1])
+            self._journal_lines += 1
+        self._offset += end
+
+    def _rebuild(self):
+        self._ids_by_value = {}
+        self._value_by_id = {}
+        self._sorted_values = None
+        for record_id, path in iter_records(self.data_dir):
+            try:
+                with open(path, 'rb') as f:
+                    record = codec.loads(f.read())
+            except FileNotFoundError:
+                # Deleted, or moved to the other layout, since the directory was listed
+                continue
+            if self.field not in record:
+                continue
+            if not indexable(record[self.field]):
+                # Written outside the API: left out of the index rather than keeping the store from loading
+                logger.warning('%s: %s %r can\'t be indexed, record skipped', path, self.field, record[self.field])
+                continue
+            self._link(record_id, record[self.field])
+        self._compact()
+
+    def _compact(self):
+        """Rewrite the journal with one line per live entry."""
+        os.makedirs(os.path.dirname(self.journal_file), exist_ok=True)
+        tmp_file = f'{self.journal_file}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for record_id, value in self._value_by_id.items():
+                f.write(json.dumps([record_id, value], ensure_ascii=False) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.journal_file)
+        self._journal_lines = len(self._value_by_id)
+        stat = os.stat(self.journal_file)
+        self._offset = stat.st_size
+        self._inode = stat.st_ino
+
@@ -0,0 +1,103 @@
+import os
+import hashlib
+from metrics import count_io
+
+# 'flat': <entity>/<id>.json. 'sharded': <entity>/ab/cd/<id>.json, ab and cd taken from a hash of the ID
+LAYOUTS = ('flat', 'sharded')
+
+# File of each entity directory naming the layout of its records ('migrating' while they are moved)
+LAYOUT_FILE = 'LAYOUT'
+
+_HEX_DIGITS = frozenset('0123456789abcdef')
+
+
+def shard(record_id):
+    """Return the two shard directory names of a record, so consecutive IDs land in different directories."""
+    digest = hashlib.md5(str(record_id).encode('ascii'), usedforsecurity=False).hexdigest()
+    return digest[:2], digest[2:4]
+
+
+def record_path(entity_dir, record_id, layout):
+    if layout == 'sharded':
+        first, second = shard(record_id)
+        return os.path.join(entity_dir, first, second, f'{record_id}.json')
+    return os.path.join(entity_dir, f'{record_id}.json')
+
+
+def _is_shard(entry):
+    return len(entry.name) == 2 and _HEX_DIGITS.issuperset(entry.name) and entry.is_dir()
+
+
+def _record_files(path):
+    """Yield (record_id, path) of the record files directly in `path`."""
+    count_io(listdirs=1)
+    with os.scandir(path) as entries:
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext == '.json' and name.isdigit():
+                yield int(name), entry.path
+
+
+def iter_records(entity_dir):
+    """Yield (record_id, path) of every record file of an entity directory, in either layout.
+
+    Only directory entries are read (os.scandir gives their type without a
+    stat()). While a migration is running a record may show up twice.
+    """
+    shards = []
+    count_io(listdirs=1)
+    with os.scandir(entity_dir) as entries:
+        for entry in entries:
+            name, ext = os.path.splitext(entry.name)
+            if ext == '.json' and name.isdigit():
+                yield int(name), entry.path
+            elif _is_shard(entry):
+                shards.append(entry.path)
+    for first in shards:
+        count_io(listdirs=1)
+        with os.scandir(first) as entries:
+            seconds = [entry.path for entry in entries if _is_shard(entry)]
+        for second in seconds:
+            yield from _record_files(second)
+
+
+def tree_mtime(entity_dir):
+    """Return the newest modification time (ns) of an entity directory and of its shard directories.
+
+    Adding or removing a record file changes the mtime of the directory
+    holding it, which in the sharded layout is a shard. A flat tree is not
+    listed: one stat() of the entity directory.
+    """
+    newest = os.stat(entity_dir).st_mtime_ns
+    if stored_layout(entity_dir) in (None, 'flat'):
+        return newest
+    count_io(listdirs=1)
+    with os.scandir(entity_dir) as entries:
+        firsts = [entry for entry in entries if _is_shard(entry)]
+    for first in firsts:
+        newest = max(newest, first.stat().st_mtime_ns)
+        count_io(listdirs=1)
+        with os.scandir(first.path) as entries:
+            for second in entries:
+                if _is_shard(second):
+                    newest = max(newest, second.stat().st_mtime_ns)
+    return newest
+
+
+def stored_layout(entity_dir):
+    """Return the layout recorded in an entity directory, 'flat' for trees older than the layout file,
+    or None for an empty directory."""
+    try:
+        with open(os.path.join(entity_dir, LAYOUT_FILE), 'r', encoding='utf-8') as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    with os.scandir(entity_dir) as entries:
+        return 'flat' if next(entries, None) is not None else None
+
+
+def set_stored_layout(entity_dir, layout):
+    tmp_file = os.path.join(entity_dir, f'{LAYOUT_FILE}.{os.getpid()}.tmp')
+    with open(tmp_file, 'w', encoding='utf-8') as f:
+        f.write(layout + '\n')
+    os.replace(tmp_file, os.path.join(entity_dir, LAYOUT_FILE))
@@ -0,0 +1,781 @@
+import os
+import json
+import mmap
+import zlib
+import struct
+import logging
+import threading
+from bisect import bisect_left, bisect_right, insort
+from contextlib import contextmanager
+from storage.base import Storage, DuplicateValueError, ID_FIELDS, INDEXED_FIELDS, UNIQUE_FIELDS, check_indexed_values, \
+    indexable
+from storage.sequences import IdSequence
+from storage.changes import ChangeLog
+from storage import codec
+from metrics import count_io
+
+# fcntl is only available on POSIX systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = logging.getLogger(__name__)
+
+# Entity of each record in the segments, by position. Only ever append to this tuple
+ENTITIES = ('companies', 'users')
+
+# Each record is written as crc32 | entity | op | record_id | value length | value (the encoded record).
+# The crc covers everything after it, a torn write at the end of a segment fails the check
+CRC = struct.Struct('>I')
+BODY = struct.Struct('>BBQI')
+HEADER_SIZE = CRC.size + BODY.size
+OP_PUT = 1
+OP_DELETE = 0
+
+# IDs read together by scan(), one lock round per chunk
+SCAN_CHUNK = 1000
+
+
+def _segment_name(number):
+    return f'{number:08d}.log'
+
+
+def _entries(data, start=0):
+    """Yield the (offset, entity, op, record_id, value_offset, length) of the complete records of `data` from `start`.
+
+    Stops at the first incomplete or corrupt record: the end of what was written so far.
+    """
+    offset = start
+    while offset + HEADER_SIZE <= len(data):
+        (crc,) = CRC.unpack_from(data, offset)
+        entity_code, op, record_id, length = BODY.unpack_from(data, offset + CRC.size)
+        end = offset + HEADER_SIZE + length
+        if end > len(data) or entity_code >= len(ENTITIES) or zlib.crc32(data[offset + CRC.size:end]) != crc:
+            return
+        yield offset, ENTITIES[entity_code], op, record_id, offset + HEADER_SIZE, length
+        offset = end
+
+
+def _encode_entry(entity, op, record_id, value):
+    body = BODY.pack(ENTITIES.index(entity), op, record_id, len(value)) + value
+    return CRC.pack(zlib.crc32(body)) + body
+
+
+def _indexed_values(entity, record):
+    return {field: record[field] for field in INDEXED_FIELDS.get(entity, ()) if field in record}
+
+
+class Segment:
+    """One segment file, read through a memory map that grows with the file."""
+
+    def __init__(self, path, number):
+        self.path = path
+        self.number = number
+        self._file = open(path, 'rb')
+        self.inode = os.fstat(self._file.fileno()).st_ino
+        self._lock = threading.Lock()
+        self._map = None
+
+    def size(self):
+        return os.fstat(self._file.fileno()).st_size
+
+    def read(self, offset, length):
+        mapped = self._map
+        if mapped is None or offset + length > len(mapped):
+            with self._lock:
+                if self._map is None or offset + length > len(self._map):
+                    # Readers of the previous map keep it alive until they are done
+                    self._map = mmap.mmap(self._file.fileno(), self.size(), access=mmap.ACCESS_READ)
+                mapped = self._map
+        return mapped[offset:offset + length]
+
+    def read_from(self, offset):
+        """Return the bytes of the file from `offset` to its current end."""
+        return os.pread(self._file.fileno(), max(self.size() - offset, 0), offset)
+
+    def replaced(self):
+        """Tell whether the file was replaced or removed by a compaction."""
+        try:
+            return os.stat(self.path).st_ino != self.inode
+        except FileNotFoundError:
+            return True
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+    def retire(self):
+        """Close the file of a segment no longer in use, mapping all of it first.
+
+        Requests that looked up a location in it meanwhile still read it: the
+        map is released with the last of them.
+        """
+        size = self.size()
+        if size:
+            self.read(0, size)
+        self._file.close()
+
+    def close(self):
+        self._map = None
+        self._file.close()
+
+
+class _ValueIndex:
+    """In-memory value -> record IDs index over one field. Used with the storage lock held."""
+
+    def __init__(self):
+        self._ids_by_value = {}
+        self._value_by_id = {}
+        self._sorted_values = None
+
+    def set(self, record_id, value):
+        self.discard(record_id)
+        self._value_by_id[record_id] = value
+        if value not in self._ids_by_value:
+            self._ids_by_value[value] = set()
+            if self._sorted_values is not None and isinstance(value, str):
+                insort(self._sorted_values, value)
+        self._ids_by_value[value].add(record_id)
+
+    def discard(self, record_id):
+        if record_id not in self._value_by_id:
+            return
+        value = self._value_by_id.pop(record_id)
+        owners = self._ids_by_value[value]
+        owners.discard(record_id)
+        if not owners:
+            del self._ids_by_value[value]
+            if self._sorted_values is not None and isinstance(value, str):
+                del self._sorted_values[bisect_left(self._sorted_values, value)]
+
+    def value_of(self, record_id):
+        return self._value_by_id.get(record_id)
+
+    def lookup(self, value):
+        return set(self._ids_by_value.get(value, ()))
+
+    def lookup_prefix(self, prefix):
+        if self._sorted_values is None:
+            self._sorted_values = sorted(value for value in self._ids_by_value if isinstance(value, str))
+        ids = set()
+        position = bisect_left(self._sorted_values, prefix)
+        while position < len(self._sorted_values) and self._sorted_values[position].startswith(prefix):
+            ids.update(self._ids_by_value[self._sorted_values[position]])
+            position += 1
+        return ids
+
+
+class LogStorage(Storage):
+    """Log-structured storage: records are appended to segment files under <log_dir>/segments.
+
+    Every write, from any process, is appended to the last (active) segment
+    under a file lock; a new segment starts once it reaches `segment_bytes`.
+    An in-memory index points each record ID at its latest version. It is
+    rebuilt at startup from the hint file of each closed segment (the IDs,
+    offsets and indexed fields of its records), so segments are not read,
+    and kept current by reading what other processes appended. Reads go
+    through a memory map of the segment, a list reads the segments almost
+    sequentially. A background thread writes the missing hint files and,
+    once `compact_ratio` of the closed segments is overwritten or deleted
+    records, rewrites them with only the live records.
+    """
+
+    def __init__(self, log_dir, codec_name='json', fsync=True, lock_dir=None, segment_bytes=64 * 1024 * 1024,
+                 compact_ratio=0.5, compact_interval=60, changelog_entries=100000):
+        super().__init__(lock_dir)
+        self.log_dir = log_dir
+        self.segment_dir = os.path.join(log_dir, 'segments')
+        self.codec = codec.get_codec(codec_name)
+        self.fsync = fsync
+        self.segment_bytes = segment_bytes
+        self.compact_ratio = compact_ratio
+        self.compact_interval = compact_interval
+        os.makedirs(self.segment_dir, exist_ok=True)
+        self._lock = threading.RLock()
+        self._sequences = {entity: IdSequence(self.segment_dir, os.path.join(log_dir, 'sequences', f'{entity}.seq'))
+                           for entity in ID_FIELDS}
+        self._changes = ChangeLog(os.path.join(log_dir, 'changes', 'changes.log'), changelog_entries)
+        self._loaded = False
+        self._segments = {}
+        self._active = None
+        self._end = 0
+        self._writer = None
+        self._write_depth = 0
+        self._dir_mtime = None
+        self._compactions = 0
+        self._stop = threading.Event()
+        self._compactor = None
+        self._reset_index()
+
+    def _reset_index(self):
+        # entity -> record_id -> (segment, value offset, value length)
+        self._index = {entity: {} for entity in ID_FIELDS}
+        self._sorted_ids = {entity: [] for entity in ID_FIELDS}
+        self._fields = {(entity, field): _ValueIndex()
+                        for entity in ID_FIELDS for field in INDEXED_FIELDS.get(entity, ())}
+        # segment -> bytes of its records that are the current version, the rest is garbage
+        self._live_bytes = {}
+
+    # Startup, forks and shutdown
+
+    def load(self):
+        with self._lock:
+            if not self._loaded:
+                self._reload()
+                self._loaded = True
+        for entity, sequence in self._sequences.items():
+            sequence.load()
+            # IDs in the segments are never handed out again, even if the sequence file was lost
+            if self._sorted_ids[entity]:
+                sequence.observe(self._sorted_ids[entity][-1])
+        self._changes.load()
+        self._start_compactor()
+
+    def after_fork(self):
+        super().after_fork()
+        self._lock = threading.RLock()
+        self._write_depth = 0
+        for segment in self._segments.values():
+            segment.after_fork()
+        if self._writer is not None:
+            self._writer = open(self._active.path, 'ab')
+        for sequence in self._sequences.values():
+            sequence.after_fork()
+        self._changes.after_fork()
+        # The parent's compactor thread doesn't exist in the worker
+        self._stop = threading.Event()
+        self._compactor = None
+        if self._loaded:
+            self._start_compactor()
+
+    def close(self):
+        super().close()
+        self._stop.set()
+        if self._compactor is not None:
+            self._compactor.join()
+            self._compactor = None
+        with self._lock:
+            if self._writer is not None:
+                self._writer.close()
+                self._writer = None
+            for segment in self._segments.values():
+                segment.close()
+            self._segments = {}
+            self._loaded = False
+
+    def _start_compactor(self):
+        if self.compact_interval > 0 and self._compactor is None:
+            self._compactor = threading.Thread(target=self._compact_loop, name='log-compactor', daemon=True)
+            self._compactor.start()
+
+    def _compact_loop(self):
+        while not self._stop.wait(self.compact_interval):
+            try:
+                self.write_hints()
+                if self.garbage_ratio() >= self.compact_ratio:
+                    self.compact()
+            except Exception:
+                logger.exception('Log compaction failed')
+
+    # Segments and index
+
+    def _segment_numbers(self):
+        numbers = []
+        for filename in os.listdir(self.segment_dir):
+            name, ext = os.path.splitext(filename)
+            if ext == '.log' and name.isdigit():
+                numbers.append(int(name))
+        return sorted(numbers)
+
+    def _segment_path(self, number):
+        return os.path.join(self.segment_dir, _segment_name(number))
+
+    def _hint_path(self, number):
+        return os.path.join(self.segment_dir, f'{number:08d}.hint')
+
+    def _open_active(self, number):
+        """Make `number` the segment receiving the writes, creating it if needed."""
+        path = self._segment_path(number)
+        if self._writer is not None:
+            self._writer.close()
+        self._writer = open(path, 'ab')
+        if number not in self._segments:
+            self._segments[number] = Segment(path, number)
+        self._active = self._segments[number]
+        self._end = 0
+
+    def _reload(self):
+        """Rebuild the index: hint files for the closed segments, a full read of the others (lock held).
+
+        The previous segments are retired rather than closed, requests may still be reading them.
+        """
+        for segment in self._segments.values():
+            segment.retire()
+        self._segments = {}
+        self._reset_index()
+        self._dir_mtime = os.stat(self.segment_dir).st_mtime_ns
+        numbers = self._segment_numbers()
+        for number in numbers:
+            self._segments[number] = Segment(self._segment_path(number), number)
+        for number in numbers[:-1]:
+            if not self._apply_hint(self._segments[number]):
+                self._apply_segment(self._segments[number], 0)
+        self._open_active(numbers[-1] if numbers else 1)
+        self._end = self._apply_segment(self._active, 0)
+
+    def _apply_hint(self, segment):
+        """Apply the hint file of a segment. Return False if it has none."""
+        try:
+            with open(self._hint_path(segment.number), 'r', encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    if len(entry) == 2:
+                        self._apply(entry[0], entry[1], None, None)
+                    else:
+                        self._apply(entry[0], entry[1], (segment, entry[2], entry[3]), entry[4])
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _apply_segment(self, segment, start):
+        """Apply the records of a segment from `start` and return the offset where they end."""
+        data = segment.read_from(start)
+        end = start
+        for offset, entity, op, record_id, value_offset, length in _entries(data):
+            if op == OP_PUT:
+                record = codec.loads(data[value_offset:value_offset + length])
+                self._apply(entity, record_id, (segment, start + value_offset, length), _indexed_values(entity, record))
+            else:
+                self._apply(entity, record_id, None, None)
+            end = start + value_offset + length
+        return end
+
+    def _apply(self, entity, record_id, location, values):
+        """Point a record ID at its new version (a location and its indexed values), or drop it (None)."""
+        index = self._index[entity]
+        ids = self._sorted_ids[entity]
+        previous = index.get(record_id)
+        if previous is not None:
+            self._live_bytes[previous[0]] -= HEADER_SIZE + previous[2]
+        if location is None:
+            if index.pop(record_id, None) is not None:
+                del ids[bisect_left(ids, record_id)]
+            for field in INDEXED_FIELDS.get(entity, ()):
+                self._fields[(entity, field)].discard(record_id)
+            return
+        if record_id not in index:
+            # IDs are mostly created in order, this is then an append
+            if not ids or record_id > ids[-1]:
+                ids.append(record_id)
+            else:
+                insort(ids, record_id)
+        index[record_id] = location
+        self._live_bytes[location[0]] = self._live_bytes.get(location[0], 0) + HEADER_SIZE + location[2]
+        for field in INDEXED_FIELDS.get(entity, ()):
+            if field in values and not indexable(values[field]):
+                # Appended before values were checked: left out of the index rather than keeping the store from loading
+                logger.warning('%s %s: %s %r can\'t be indexed', entity, record_id, field, values[field])
+                self._fields[(entity, field)].discard(record_id)
+            elif field in values:
+                self._fields[(entity, field)].set(record_id, values[field])
+            else:
+                self._fields[(entity, field)].discard(record_id)
+
+    def _catch_up(self):
+        """Apply the records appended by other processes since the last call (lock held)."""
+        if not self._loaded:
+            self._reload()
+            self._loaded = True
+        mtime = os.stat(self.segment_dir).st_mtime_ns
+        newer = []
+        if mtime != self._dir_mtime:
+            self._dir_mtime = mtime
+            numbers = self._segment_numbers()
+            # Segments replaced or removed by a compaction in another process: start over from the hints
+            if any(number not in numbers or segment.replaced() for number, segment in self._segments.items()):
+                self._reload()
+                return
+            newer = [number for number in numbers if number > self._active.number]
+        self._end = self._apply_segment(self._active, self._end)
+        for number in newer:
+            # Another process started a new segment, the previous one was complete when it was listed
+            self._segments[number] = Segment(self._segment_path(number), number)
+            self._open_active(number)
+            self._end = self._apply_segment(self._active, 0)
+
+    @contextmanager
+    def _write_locked(self):
+        """Hold the file lock serializing the appends of every process. Reentrant within a thread."""
+        with self._lock:
+            if self._write_depth:
+                self._write_depth += 1
+                try:
+                    yield
+                finally:
+                    self._write_depth -= 1
+                return
+            with open(os.path.join(self.log_dir, 'write.lock'), 'a', encoding='utf-8') as lock_file:
+                if fcntl is not None:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX)
+                self._write_depth = 1
+                try:
+                    self._catch_up()
+                    yield
+                finally:
+                    self._write_depth = 0
+
+    def _duplicate(self, entity, record_id, record, claimed):
+        """Return the DuplicateValueError a write would cause, or None. `claimed` holds the values of the batch."""
+        for field in UNIQUE_FIELDS.get(entity, ()):
+            if field not in record:
+                continue
+            owners = self._fields[(entity, field)].lookup(record[field]) - {record_id}
+            owner = claimed.get((field, record[field]), record_id)
+            if owners or owner != record_id:
+                return DuplicateValueError(entity, field, record[field])
+        return None
+
+    def _write(self, entity, items):
+        """Append (record_id, record or None to delete) items in one write.
+
+        Return, for each item, None or the DuplicateValueError that rejected it.
+        """
+        # Checked before anything is appended, a replayed value that can't be indexed is skipped
+        check_indexed_values(entity, [record for _, record in items if record is not None])
+        with self._write_locked():
+            # A torn record left by a crash is cut off, or the next ones would be unreadable
+            if self._active.size() > self._end:
+                os.truncate(self._active.path, self._end)
+            results = []
+            chunks = []
+            applied = []
+            claimed = {}
+            offset = self._end
+            for record_id, record in items:
+                if record is None:
+                    entry = _encode_entry(entity, OP_DELETE, record_id, b'')
+                    applied.append((record_id, None, None))
+                else:
+                    duplicate = self._duplicate(entity, record_id, record, claimed)
+                    if duplicate is not None:
+                        results.append(duplicate)
+                        continue
+                    for field in UNIQUE_FIELDS.get(entity, ()):
+                        if field in record:
+                            claimed[(field, record[field])] = record_id
+                    value = self.codec.dumps(record)
+                    entry = _encode_entry(entity, OP_PUT, record_id, value)
+                    applied.append((record_id, (self._active, offset + HEADER_SIZE, len(value)),
+                                    _indexed_values(entity, record)))
+                chunks.append(entry)
+                offset += len(entry)
+                results.append(None)
+            if not chunks:
+                return results
+            data = b''.join(chunks)
+            count_io(bytes_written=len(data))
+            self._writer.write(data)
+            self._writer.flush()
+            if self.fsync:
+                os.fsync(self._writer.fileno())
+            self._end = offset
+            for record_id, location, values in applied:
+                self._apply(entity, record_id, location, values)
+            self._changed()
+            if self._end >= self.segment_bytes:
+                # Later writes go to a new segment, this one is now read-only
+                self._open_active(self._active.number + 1)
+                self._dir_mtime = None
+            return results
+
+    # Reads
+
+    def _locations(self, entity, record_ids):
+        with self._lock:
+            self._catch_up()
+            index = self._index[entity]
+            return [(record_id, index.get(record_id)) for record_id in record_ids]
+
+    def _read(self, location):
+        segment, offset, length = location
+        data = segment.read(offset, length)
+        count_io(bytes_read=length)
+        return codec.loads(data)
+
+    def get(self, entity, record_id):
+        location = self._locations(entity, [record_id])[0][1]
+        return self._read(location) if location is not None else None
+
+    def get_many(self, entity, record_ids):
+        return [self._read(location) for _, location in self._locations(entity, record_ids) if location is not None]
+
+    def exists(self, entity, record_id):
+        return self._locations(entity, [record_id])[0][1] is not None
+
+    def revision(self):
+        # Every write, from any process, moves the end of the log: the same token in every worker
+        with self._lock:
+            self._catch_up()
+            return f'{self._active.number}-{self._end}'
+
+    def stats(self):
+        with self._lock:
+            segments = list(self._segments.values())
+        return {'log': {'segments': len(segments),
+                        'bytes': sum(segment.size() for segment in segments),
+                        'garbage_ratio': round(self.garbage_ratio(), 3),
+                        'compactions': self._compactions}}
+
+    def scan(self, entity, after_id=None, limit=None):
+        count = 0
+        while limit is None or count < limit:
+            # A chunk of IDs at a time, so writes are not held up by a long scan
+            with self._lock:
+                self._catch_up()
+                ids = self._sorted_ids[entity]
+                start = bisect_right(ids, after_id) if after_id is not None else 0
+                chunk = ids[start:start + SCAN_CHUNK]
+                index = self._index[entity]
+                locations = [index[record_id] for record_id in chunk]
+            if not chunk:
+                return
+            # IDs are mostly written in order, so this reads the segments sequentially
+            for location in locations:
+                yield self._read(location)
+                count += 1
+                if limit is not None and count >= limit:
+                    return
+            after_id = chunk[-1]
+
+    def query(self, entity, field, value):
+        return self.get_many(entity, self.query_ids(entity, field, value))
+
+    def query_prefix(self, entity, field, prefix):
+        return self.get_many(entity, self.query_prefix_ids(entity, field, prefix))
+
+    def query_ids(self, entity, field, value):
+        with self._lock:
+            self._catch_up()
+            return sorted(self._fields[(entity, field)].lookup(value))
+
+    def query_prefix_ids(self, entity, field, prefix):
+        with self._lock:
+            self._catch_up()
+            return sorted(self._fields[(entity, field)].lookup_prefix(prefix))
+
+    def changes(self, after_seq, limit, entity=None):
+        return self._changes.read(after_seq, limit, entity)
+
+    def change_bounds(self):
+        return self._changes.bounds()
+
+    # Writes
+
+    def create(self, entity, record):
+        check_indexed_values(entity, [record])
+        # Fail before taking an ID when the value is already known to be taken
+        with self._lock:
+            self._catch_up()
+            duplicate = self._duplicate(entity, None, record, {})
+        if duplicate is not None:
+            raise duplicate
+        record_id = self._sequences[entity].next_id()
+        record[ID_FIELDS[entity]] = record_id
+        with self.lock(entity, record_id):
+            error = self._write(entity, [(record_id, record)])[0]
+            if error is not None:
+                record.pop(ID_FIELDS[entity])
+                raise error
+            self._changes.append(entity, 'create', [record_id])
+        return record_id
+
+    def create_many(self, entity, records):
+        # One block of IDs and one write for the whole batch
+        record_ids = self._sequences[entity].next_block(len(records))
+        for record_id, record in zip(record_ids, records):
+            record[ID_FIELDS[entity]] = record_id
+        errors = self._write(entity, list(zip(record_ids, records)))
+        results = []
+        for record_id, record, error in zip(record_ids, records, errors):
+            if error is not None:
+                record.pop(ID_FIELDS[entity])
+                results.append(error)
+            else:
+                results.append(record_id)
+        self._changes.append(entity, 'create', [result for result in results if isinstance(result, int)])
+        return results
+
+    def put(self, entity, record_id, record):
+        self._sequences[entity].observe(record_id)
+        with self.lock(entity, record_id):
+            error = self._write(entity, [(record_id, record)])[0]
+            if error is not None:
+                raise error
+            self._changes.append(entity, 'update', [record_id])
+
+    def bulk_put(self, entity, records):
+        id_field = ID_FIELDS[entity]
+        if not records:
+            return []
+        self._sequences[entity].observe(max(record[id_field] for record in records))
+        # One write for the whole batch
+        errors = self._write(entity, [(record[id_field], record) for record in records])
+        self._changes.append(entity, 'update', [record[id_field] for record, error in zip(records, errors) if error is None])
+        return errors
+
+    def delete(self, entity, record_id):
+        with self.lock(entity, record_id):
+            return bool(self.delete_many(entity, [record_id]))
+
+    def delete_many(self, entity, record_ids):
+        # One tombstone per record that exists, in one write
+        with self._write_locked():
+            index = self._index[entity]
+            deleted = [record_id for record_id in dict.fromkeys(record_ids) if record_id in index]
+            self._write(entity, [(record_id, None) for record_id in deleted])
+        self._changes.append(entity, 'delete', deleted)
+        return deleted
+
+    def delete_where(self, entity, field, value):
+        with self._lock:
+            self._catch_up()
+            ids = sorted(self._fields[(entity, field)].lookup(value))
+        return self.delete_many(entity, ids)
+
+    # Hint files and compaction
+
+    def garbage_ratio(self):
+        """Return the fraction of the closed segments taken by overwritten and deleted records."""
+        with self._lock:
+            self._catch_up()
+            closed = [segment for segment in self._segments.values() if segment is not self._active]
+            total = sum(segment.size() for segment in closed)
+            live = sum(self._live_bytes.get(segment, 0) for segment in closed)
+        return (total - live) / total if total else 0.0
+
+    def write_hints(self):
+        """Write the hint file of each closed segment that has none."""
+        # Under the compaction lock, a compaction in another process could otherwise replace the segment meanwhile
+        with self._compaction_locked() as acquired:
+            if not acquired:
+                return
+            with self._lock:
+                self._catch_up()
+                missing = [segment for segment in self._segments.values()
+                           if segment is not self._active and not os.path.exists(self._hint_path(segment.number))]
+            for segment in missing:
+                if not segment.replaced():
+                    self._write_hint_file(segment.number, self._hint_lines(segment))
+
+    def _hint_lines(self, segment):
+        lines = []
+        data = segment.read_from(0)
+        for _, entity, op, record_id, value_offset, length in _entries(data):
+            if op == OP_PUT:
+                values = _indexed_values(entity, codec.loads(data[value_offset:value_offset + length]))
+                lines.append(json.dumps([entity, record_id, value_offset, length, values], ensure_ascii=False))
+            else:
+                lines.append(json.dumps([entity, record_id]))
+        return lines
+
+    def _write_hint_file(self, number, lines):
+        # Written to a temp file and renamed: a hint file that exists is complete
+        tmp_file = f'{self._hint_path(number)}.{os.getpid()}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            for line in lines:
+                f.write(line + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self._hint_path(number))
+
+    @contextmanager
+    def _compaction_locked(self):
+        """Hold the file lock letting one process at a time compact. Yield False if another one is."""
+        with open(os.path.join(self.log_dir, 'compact.lock'), 'a', encoding='utf-8') as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    yield False
+                    return
+            yield True
+
+    def compact(self):
+        """Rewrite the closed segments as one, holding only their live records in ID order.
+
+        The new segment takes the number of the last closed one, so the
+        records of the active segment still override it. It also keeps a
+        delete for each dead record of the older segments: until they are
+        removed, a crash would otherwise bring those records back. Writes go
+        on while the live records are copied, only the final swap holds them up.
+        Return False if there was nothing to compact.
+        """
+        with self._compaction_locked() as acquired:
+            if not acquired:
+                return False
+            with self._lock:
+                self._catch_up()
+                closed = sorted((segment for segment in self._segments.values() if segment is not self._active),
+                                key=lambda segment: segment.number)
+                if not closed:
+                    return False
+                closed_set = set(closed)
+                live = sorted((entity, record_id, location) for entity in ID_FIELDS
+                              for record_id, location in self._index[entity].items() if location[0] in closed_set)
+            target = closed[-1].number
+            tmp_file = f'{self._segment_path(target)}.{os.getpid()}.compact'
+            # Records the older segments hold: those dead by the swap get a delete in the new segment
+            older = set()
+            for segment in closed[:-1]:
+                older.update((entity, record_id) for _, entity, op, record_id, _, _ in _entries(segment.read_from(0))
+                             if op == OP_PUT)
+            moved = []
+            hints = []
+            offset = 0
+            with open(tmp_file, 'wb') as f:
+                for entity, record_id, location in live:
+                    value = location[0].read(location[1], location[2])
+                    entry = _encode_entry(entity, OP_PUT, record_id, value)
+                    f.write(entry)
+                    moved.append((entity, record_id, location, offset + HEADER_SIZE))
+                    values = _indexed_values(entity, codec.loads(value))
+                    hints.append(json.dumps([entity, record_id, offset + HEADER_SIZE, len(value), values],
+                                            ensure_ascii=False))
+                    offset += len(entry)
+                f.flush()
+                os.fsync(f.fileno())
+            with self._write_locked():
+                dead = sorted((entity, record_id) for entity, record_id in older if record_id not in self._index[entity])
+                with open(tmp_file, 'ab') as f:
+                    for entity, record_id in dead:
+                        f.write(_encode_entry(entity, OP_DELETE, record_id, b''))
+                        hints.append(json.dumps([entity, record_id]))
+                    f.flush()
+                    os.fsync(f.fileno())
+                # No hint for a moment: a crash in between leaves a segment read in full at startup
+                for segment in closed:
+                    try:
+                        os.remove(self._hint_path(segment.number))
+                    except FileNotFoundError:
+                        pass
+                os.replace(tmp_file, self._segment_path(target))
+                self._write_hint_file(target, hints)
+                # The older segments only hold records the new one has, or deletes
+                for segment in closed[:-1]:
+                    os.remove(segment.path)
+                compacted = Segment(self._segment_path(target), target)
+                for segment in closed:
+                    del self._segments[segment.number]
+                    self._live_bytes.pop(segment, None)
+                    segment.retire()
+                self._segments[target] = compacted
+                self._live_bytes[compacted] = 0
+                for entity, record_id, location, value_offset in moved:
+                    # Unless it was written again meanwhile
+                    if self._index[entity].get(record_id) == location:
+                        self._index[entity][record_id] = (compacted, value_offset, location[2])
+                        self._live_bytes[compacted] += HEADER_SIZE + location[2]
+                self._dir_mtime = os.stat(self.segment_dir).st_mtime_ns
+                self._compactions += 1
+                self._changed()
+            return True
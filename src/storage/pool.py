@@ -0,0 +1,62 @@
+import threading
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+class IoPool:
+    """Bounded pool of threads running blocking file reads, so a request can wait on many disk reads at once.
+
+    The threads are started on first use, and started again in a worker
+    forked from a process that already used the pool (threads don't
+    survive a fork).
+    """
+
+    def __init__(self, threads):
+        self.threads = threads
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='storage-io')
+            return self._executor
+
+    def map(self, fn, items):
+        """Yield fn(item) for each item, in order, with at most 2 * threads calls in flight.
+
+        Items are only taken from `items` as results are consumed, so a
+        caller that stops early leaves most of them unread.
+        """
+        if self.threads < 2:
+            # Nothing to overlap, run on the calling thread
+            for item in items:
+                yield fn(item)
+            return
+        executor = self._get_executor()
+        window = 2 * self.threads
+        pending = deque()
+        try:
+            for item in items:
+                # Each read runs in a copy of the caller's context, so it's counted for the caller's request
+                pending.append(executor.submit(contextvars.copy_context().run, fn, item))
+                if len(pending) >= window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            # The caller stopped early (limit reached, client gone), drop the reads not started yet
+            for future in pending:
+                future.cancel()
+
+    def after_fork(self):
+        """Forget the parent's threads in a forked worker."""
+        self._lock = threading.Lock()
+        self._executor = None
+
+    def close(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
@@ -0,0 +1,111 @@
+import os
+import threading
+from storage.layout import iter_records
+
+# fcntl is only available on POSIX systems
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# How many IDs are reserved on disk at once. After a crash at most this many IDs are skipped.
+BLOCK_SIZE = 100
+
+
+def _max_id_on_disk(data_dir):
+    """Return the highest record ID found in a data directory (only used to bootstrap a sequence)."""
+    return max((record_id for record_id, _ in iter_records(data_dir)), default=0)
+
+
+class IdSequence:
+    """Thread-safe, persistent ID sequence for one entity.
+
+    Blocks are reserved under a file lock, so worker processes sharing the
+    data directory each get their own blocks and never hand out the same ID.
+    """
+
+    def __init__(self, data_dir, seq_file, block_size=BLOCK_SIZE):
+        self.data_dir = data_dir
+        self.seq_file = seq_file
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._next = None
+        self._reserved = 0
+
+    def load(self):
+        """Read the high-water mark from the sequence file, bootstrapping it from the data directory if missing."""
+        with self._lock:
+            if self._next is not None:
+                return
+            try:
+                with open(self.seq_file, 'r', encoding='utf-8') as f:
+                    reserved = int(f.read().strip() or 0)
+            except FileNotFoundError:
+                reserved = _max_id_on_disk(self.data_dir)
+            # IDs up to the persisted mark may have been handed out before a restart, never reuse them
+            self._next = reserved + 1
+            self._reserved = reserved
+
+    def after_fork(self):
+        """Forget the block reserved by the parent in a forked worker, the next call reserves a block of its own."""
+        self._lock = threading.Lock()
+        self._next = None
+
+    def next_id(self):
+        """Return the next free ID."""
+        return self.next_block(1)[0]
+
+    def next_block(self, count):
+        """Return a list of `count` consecutive free IDs."""
+        if self._next is None:
+            self.load()
+        with self._lock:
+            first = self._next
+            last = first + count - 1
+            if last > self._reserved:
+                # Reserve a whole block on disk so most calls never touch the file
+                first = self._reserve(first, count)
+                last = first + count - 1
+            self._next = last + 1
+            return list(range(first, last + 1))
+
+    def observe(self, record_id):
+        """Make sure IDs written from outside the sequence (imports, migrations) are never handed out again."""
+        if self._next is None:
+            self.load()
+        with self._lock:
+            if record_id >= self._next:
+                self._next = record_id + 1
+                if record_id > self._reserved:
+                    self._next = self._reserve(record_id + 1, 0)
+
+    def _reserve(self, first, count):
+        """Reserve the IDs from `first` to `first + count - 1` plus a block, and return the actual first ID.
+
+        If another process reserved IDs since our last block, ours start after its mark.
+        """
+        os.makedirs(os.path.dirname(self.seq_file), exist_ok=True)
+        with open(f'{self.seq_file}.lock', 'a', encoding='utf-8') as lock_file:
+            if fcntl is not None:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                with open(self.seq_file, 'r', encoding='utf-8') as f:
+                    mark = int(f.read().strip() or 0)
+            except FileNotFoundError:
+                mark = 0
+            if mark > self._reserved:
+                first = max(first, mark + 1)
+            self._persist(first + count - 1 + self.block_size)
+        return first
+
+    def _persist(self, reserved):
+        """Durably write the new high-water mark (write to temp file, fsync, rename)."""
+        os.makedirs(os.path.dirname(self.seq_file), exist_ok=True)
+        tmp_file = f'{self.seq_file}.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            f.write(str(reserved))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, self.seq_file)
+        self._reserved = reserved
+
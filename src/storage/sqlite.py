@@ -0,0 +1,311 @@
+import os
+import sqlite3
+import threading
+from storage.base import Storage, DuplicateValueError, ID_FIELDS, INDEXED_FIELDS, UNIQUE_FIELDS, check_indexed_values
+from storage import codec
+from metrics import count_io
+
+
+class SQLiteStorage(Storage):
+    """One table per entity holding the encoded record plus a column for each indexed field.
+
+    Each thread gets its own connection, the database runs in WAL mode so
+    readers never wait for writers.
+    """
+
+    def __init__(self, path, codec_name='json', lock_dir=None, changelog_entries=100000):
+        super().__init__(lock_dir)
+        self.path = path
+        self.changelog_entries = changelog_entries
+        self.codec = codec.get_codec(codec_name)
+        self._local = threading.local()
+        self._connections = []
+        self._connections_lock = threading.Lock()
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._create_schema()
+
+    def _connect(self):
+        """Return this thread's connection, opening it on first use."""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            with self._connections_lock:
+                self._connections.append(connection)
+        return connection
+
+    def _create_schema(self):
+        connection = self._connect()
+        with connection:
+            for entity, id_field in ID_FIELDS.items():
+                columns = ''.join(f', {field}' for field in INDEXED_FIELDS.get(entity, ()))
+                connection.execute(f'CREATE TABLE IF NOT EXISTS {entity} '
+                                   f'({id_field} INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL{columns})')
+                self._add_missing_columns(connection, entity)
+                for field in INDEXED_FIELDS.get(entity, ()):
+                    unique = 'UNIQUE ' if field in UNIQUE_FIELDS.get(entity, ()) else ''
+                    connection.execute(f'CREATE {unique}INDEX IF NOT EXISTS {entity}_{field} ON {entity} ({field})')
+            # Write counter shared by every process using the database, see revision()
+            connection.execute('CREATE TABLE IF NOT EXISTS revision '
+                               '(id INTEGER PRIMARY KEY CHECK (id = 0), token TEXT NOT NULL, value INTEGER NOT NULL)')
+            connection.execute('INSERT OR IGNORE INTO revision VALUES (0, ?, 0)', (os.urandom(4).hex(),))
+            # Change log, see changes(). AUTOINCREMENT never reuses the sequence numbers of trimmed entries
+            connection.execute('CREATE TABLE IF NOT EXISTS changes (seq INTEGER PRIMARY KEY AUTOINCREMENT, '
+                               'entity TEXT NOT NULL, op TEXT NOT NULL, record_id INTEGER NOT NULL)')
+
+    def _add_missing_columns(self, connection, entity):
+        """Add the columns of fields indexed since the table was created, filled from the stored records."""
+        existing = {row[1] for row in connection.execute(f'PRAGMA table_info({entity})')}
+        missing = [field for field in INDEXED_FIELDS.get(entity, ()) if field not in existing]
+        if not missing:
+            return
+        for field in missing:
+            connection.execute(f'ALTER TABLE {entity} ADD COLUMN {field}')
+        id_field = ID_FIELDS[entity]
+        for record_id, data in connection.execute(f'SELECT {id_field}, data FROM {entity}').fetchall():
+            record = codec.loads(data)
+            connection.execute(f'UPDATE {entity} SET {", ".join(f"{field} = ?" for field in missing)} '
+                               f'WHERE {id_field} = ?', [record.get(field) for field in missing] + [record_id])
+
+    def load(self):
+        self._connect()
+
+    def after_fork(self):
+        super().after_fork()
+        # A connection must never be used in two processes, each worker opens its own.
+        # The parent's connections are left alone, closing them here could release its locks
+        self._connections_lock = threading.Lock()
+        self._connections = []
+        self._local = threading.local()
+
+    def close(self):
+        super().close()
+        with self._connections_lock:
+            for connection in self._connections:
+                connection.close()
+            self._connections = []
+        self._local = threading.local()
+
+    def revision(self):
+        # Read from the database, so writes made by other worker processes change it too
+        token, value = self._connect().execute('SELECT token, value FROM revision').fetchone()
+        return f'{token}-{value}'
+
+    def _bump(self, connection):
+        """Count a write, inside the transaction making it."""
+        connection.execute('UPDATE revision SET value = value + 1')
+
+    def _log(self, connection, entity, op, record_ids):
+        """Add writes to the change log, inside the transaction making them, and drop the oldest entries."""
+        if not record_ids:
+            return
+        connection.executemany('INSERT INTO changes (entity, op, record_id) VALUES (?, ?, ?)',
+                               [(entity, op, record_id) for record_id in record_ids])
+        connection.execute('DELETE FROM changes WHERE seq <= (SELECT MAX(seq) FROM changes) - ?',
+                           (self.changelog_entries,))
+
+    def _encode(self, record):
+        data = self.codec.dumps(record)
+        count_io(bytes_written=len(data))
+        return data
+
+    def _decode(self, data):
+        count_io(bytes_read=len(data))
+        return codec.loads(data)
+
+    def _indexed_values(self, entity, record):
+        # Raised inside the transaction, which is rolled back
+        check_indexed_values(entity, [record])
+        return [record.get(field) for field in INDEXED_FIELDS.get(entity, ())]
+
+    def _duplicate(self, entity, record):
+        """Turn a UNIQUE constraint failure into the field that caused it."""
+        for field in UNIQUE_FIELDS.get(entity, ()):
+            if field in record:
+                return DuplicateValueError(entity, field, record[field])
+        return DuplicateValueError(entity, ID_FIELDS[entity], None)
+
+    def get(self, entity, record_id):
+        row = self._connect().execute(
+            f'SELECT data FROM {entity} WHERE {ID_FIELDS[entity]} = ?', (record_id,)).fetchone()
+        return self._decode(row[0]) if row else None
+
+    def get_many(self, entity, record_ids):
+        record_ids = list(record_ids)
+        records = {}
+        id_field = ID_FIELDS[entity]
+        # One query per chunk, SQLite limits the number of parameters
+        for start in range(0, len(record_ids), 500):
+            chunk = record_ids[start:start + 500]
+            rows = self._connect().execute(f'SELECT {id_field}, data FROM {entity} WHERE {id_field} IN '
+                                           f'({", ".join("?" * len(chunk))})', chunk)
+            for row in rows:
+                records[row[0]] = self._decode(row[1])
+        return [records[record_id] for record_id in record_ids if record_id in records]
+
+    def exists(self, entity, record_id):
+        row = self._connect().execute(
+            f'SELECT 1 FROM {entity} WHERE {ID_FIELDS[entity]} = ?', (record_id,)).fetchone()
+        return row is not None
+
+    def _insert(self, connection, entity, record):
+        fields = INDEXED_FIELDS.get(entity, ())
+        columns = ''.join(f', {field}' for field in fields)
+        placeholders = ', ?' * len(fields)
+        # Insert first to get the ID from AUTOINCREMENT, then store the record with its ID
+        cursor = connection.execute(f'INSERT INTO {entity} (data{columns}) VALUES (?{placeholders})',
+                                    ['{}'] + self._indexed_values(entity, record))
+        record_id = cursor.lastrowid
+        record[ID_FIELDS[entity]] = record_id
+        connection.execute(f'UPDATE {entity} SET data = ? WHERE {ID_FIELDS[entity]} = ?',
+                           (self._encode(record), record_id))
+        return record_id
+
+    def create(self, entity, record):
+        try:
+            with self._connect() as connection:
+                record_id = self._insert(connection, entity, record)
+                self._log(connection, entity, 'create', [record_id])
+                self._bump(connection)
+        except sqlite3.IntegrityError as e:
+            raise self._duplicate(entity, record) from e
+        self._changed()
+        return record_id
+
+    def create_many(self, entity, records):
+        results = []
+        # A single transaction for the whole batch. A failed INSERT only undoes itself, not the transaction
+        with self._connect() as connection:
+            for record in records:
+                try:
+                    results.append(self._insert(connection, entity, record))
+                except sqlite3.IntegrityError:
+                    record.pop(ID_FIELDS[entity], None)
+                    results.append(self._duplicate(entity, record))
+            self._log(connection, entity, 'create', [result for result in results if isinstance(result, int)])
+            self._bump(connection)
+        self._changed()
+        return results
+
+    def _upsert(self, connection, entity, record_id, record):
+        fields = INDEXED_FIELDS.get(entity, ())
+        columns = ''.join(f', {field}' for field in fields)
+        placeholders = ', ?' * len(fields)
+        updates = ''.join(f', {field} = excluded.{field}' for field in fields)
+        id_field = ID_FIELDS[entity]
+        # An upsert, unlike INSERT OR REPLACE, never deletes another row holding a unique value
+        connection.execute(f'INSERT INTO {entity} ({id_field}, data{columns}) VALUES (?, ?{placeholders}) '
+                           f'ON CONFLICT ({id_field}) DO UPDATE SET data = excluded.data{updates}',
+                           [record_id, self._encode(record)] + self._indexed_values(entity, record))
+
+    def put(self, entity, record_id, record):
+        try:
+            with self._connect() as connection:
+                self._upsert(connection, entity, record_id, record)
+                self._log(connection, entity, 'update', [record_id])
+                self._bump(connection)
+        except sqlite3.IntegrityError as e:
+            raise self._duplicate(entity, record) from e
+        self._changed()
+
+    def bulk_put(self, entity, records):
+        id_field = ID_FIELDS[entity]
+        results = []
+        # A single transaction for the whole batch. A failed upsert only undoes itself, not the transaction
+        with self._connect() as connection:
+            for record in records:
+                try:
+                    self._upsert(connection, entity, record[id_field], record)
+                    results.append(None)
+                except sqlite3.IntegrityError:
+                    results.append(self._duplicate(entity, record))
+            self._log(connection, entity, 'update', [record[id_field] for record, error in zip(records, results)
+                                                     if error is None])
+            self._bump(connection)
+        self._changed()
+        return results
+
+    def delete(self, entity, record_id):
+        with self._connect() as connection:
+            cursor = connection.execute(f'DELETE FROM {entity} WHERE {ID_FIELDS[entity]} = ?', (record_id,))
+            self._log(connection, entity, 'delete', [record_id] if cursor.rowcount > 0 else [])
+            self._bump(connection)
+        self._changed()
+        return cursor.rowcount > 0
+
+    def delete_many(self, entity, record_ids):
+        id_field = ID_FIELDS[entity]
+        deleted = []
+        with self._connect() as connection:
+            for record_id in record_ids:
+                cursor = connection.execute(f'DELETE FROM {entity} WHERE {id_field} = ?', (record_id,))
+                if cursor.rowcount > 0:
+                    deleted.append(record_id)
+            self._log(connection, entity, 'delete', deleted)
+            self._bump(connection)
+        self._changed()
+        return deleted
+
+    def delete_where(self, entity, field, value):
+        id_field = ID_FIELDS[entity]
+        with self._connect() as connection:
+            # sqlite3 would only begin the transaction at the DELETE: a record inserted after the SELECT
+            # would be deleted without being logged. Take the write lock before reading
+            connection.execute('BEGIN IMMEDIATE')
+            rows = connection.execute(f'SELECT {id_field} FROM {entity} WHERE {field} = ?', (value,)).fetchall()
+            connection.execute(f'DELETE FROM {entity} WHERE {field} = ?', (value,))
+            self._log(connection, entity, 'delete', [row[0] for row in rows])
+            self._bump(connection)
+        self._changed()
+        return [row[0] for row in rows]
+
+    def changes(self, after_seq, limit, entity=None):
+        where = ' AND entity = ?' if entity is not None else ''
+        parameters = (after_seq,) + ((entity,) if entity is not None else ()) + (limit,)
+        return [tuple(row) for row in self._connect().execute(
+            f'SELECT seq, entity, op, record_id FROM changes WHERE seq > ?{where} ORDER BY seq LIMIT ?', parameters)]
+
+    def change_bounds(self):
+        first, last = self._connect().execute('SELECT MIN(seq), MAX(seq) FROM changes').fetchone()
+        if last is None:
+            # Every entry trimmed, or no write yet: the last number given out is kept by AUTOINCREMENT
+            row = self._connect().execute("SELECT seq FROM sqlite_sequence WHERE name = 'changes'").fetchone()
+            last = row[0] if row else 0
+            return last + 1, last
+        return first, last
+
+    def scan(self, entity, after_id=None, limit=None):
+        id_field = ID_FIELDS[entity]
+        # The cursor streams rows, the table is never loaded at once
+        cursor = self._connect().execute(f'SELECT data FROM {entity} WHERE {id_field} > ? ORDER BY {id_field} LIMIT ?',
+                                         (after_id if after_id is not None else -1, limit if limit is not None else -1))
+        for row in cursor:
+            yield self._decode(row[0])
+
+    def _prefix_rows(self, entity, field, prefix, column):
+        if not prefix:
+            return self._connect().execute(f'SELECT {column} FROM {entity} ORDER BY {ID_FIELDS[entity]}')
+        # A range on the column uses its index, unlike LIKE (case-insensitive by default)
+        upper = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        return self._connect().execute(
+            f'SELECT {column} FROM {entity} WHERE {field} >= ? AND {field} < ? ORDER BY {ID_FIELDS[entity]}',
+            (prefix, upper))
+
+    def query_prefix(self, entity, field, prefix):
+        return [self._decode(row[0]) for row in self._prefix_rows(entity, field, prefix, 'data').fetchall()]
+
+    def query(self, entity, field, value):
+        rows = self._connect().execute(
+            f'SELECT data FROM {entity} WHERE {field} = ? ORDER BY {ID_FIELDS[entity]}', (value,)).fetchall()
+        return [self._decode(row[0]) for row in rows]
+
+    def query_ids(self, entity, field, value):
+        id_field = ID_FIELDS[entity]
+        rows = self._connect().execute(f'SELECT {id_field} FROM {entity} WHERE {field} = ? ORDER BY {id_field}',
+                                       (value,))
+        return [row[0] for row in rows]
+
+    def query_prefix_ids(self, entity, field, prefix):
+        return [row[0] for row in self._prefix_rows(entity, field, prefix, ID_FIELDS[entity])]
@@ -0,0 +1,63 @@
+import os
+import sys
+import pytest
+
+# The application modules import each other from src/ (e.g. `import config`), as when run from there
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+from main import create_app  # noqa: E402
+from storage.engine import create_store, get_store, load_settings  # noqa: E402
+
+BACKENDS = ('files', 'sqlite', 'log')
+
+
+def app_settings(data_dir, backend='files', **overrides):
+    """Settings of a test app: its own data directory, passwords hashed inline and cheaply, no compaction thread."""
+    settings = {
+        'DATA_DIR': str(data_dir),
+        'STORAGE_BACKEND': backend,
+        'PASSWORD_HASH_WORKERS': 0,
+        'PASSWORD_SCRYPT_N': 2 ** 4,
+        'LOG_COMPACT_INTERVAL': 0,
+        'FSYNC_WRITES': False,
+    }
+    settings.update(overrides)
+    return settings
+
+
+@pytest.fixture
+def make_app(tmp_path):
+    """Build an app over tmp_path. Building another one closes the previous store first, like a restart."""
+    stores = []
+
+    def make(backend='files', **overrides):
+        if stores:
+            stores.pop().close()
+        app = create_app(app_settings(tmp_path / 'data', backend, **overrides))
+        stores.append(get_store())
+        return app
+
+    yield make
+    for store in stores:
+        store.close()
+
+
+@pytest.fixture(params=BACKENDS)
+def client(request, make_app):
+    return make_app(request.param).test_client()
+
+
+@pytest.fixture
+def open_store(tmp_path):
+    """Open stores over tmp_path without an app, closed at the end of the test."""
+    stores = []
+
+    def open_(backend='files', **overrides):
+        store = create_store(load_settings(app_settings(tmp_path / 'data', backend, **overrides)))
+        store.load()
+        stores.append(store)
+        return store
+
+    yield open_
+    for store in stores:
+        store.close()
@@ -0,0 +1,67 @@
+import time
+import threading
+from storage.engine import get_store
+
+
+def test_full_route_class_gets_a_503_with_retry_after(make_app):
+    app = make_app(ADMISSION_LIST_LIMIT=1, ADMISSION_QUEUE_MAX=0)
+    client = app.test_client()
+    limit = app.extensions['admission']['limits']['list']
+    # A listing in progress takes the only place
+    assert limit.acquire() is None
+    response = client.get('/users')
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == '1'
+    assert response.get_json()['error'] == 'Overloaded'
+    # The other classes are not affected
+    assert client.get('/stats').status_code == 200
+    limit.release()
+    assert client.get('/users').status_code == 200
+
+
+def test_queued_request_gets_a_503_after_the_timeout(make_app):
+    app = make_app(ADMISSION_LIST_LIMIT=1, ADMISSION_QUEUE_MAX=1, ADMISSION_QUEUE_TIMEOUT=0.05)
+    limit = app.extensions['admission']['limits']['list']
+    assert limit.acquire() is None
+    response = app.test_client().get('/users')
+    assert response.status_code == 503
+    assert 'Retry-After' in response.headers
+    limit.release()
+
+
+def test_client_over_its_rate_gets_a_429_with_retry_after(make_app):
+    client = make_app(RATE_LIMIT_PER_SECOND=0.1, RATE_LIMIT_BURST=2).test_client()
+    assert client.get('/users').status_code == 200
+    assert client.get('/users').status_code == 200
+    response = client.get('/users')
+    assert response.status_code == 429
+    assert response.get_json()['error'] == 'RateLimited'
+    # An empty bucket gets a token back in 1 / 0.1 seconds
+    assert 9 <= int(response.headers['Retry-After']) <= 10
+    # Another client has its own bucket
+    assert client.get('/users', environ_base={'REMOTE_ADDR': '10.0.0.2'}).status_code == 200
+
+
+def test_default_limits_never_refuse_an_eight_thread_client(make_app, monkeypatch):
+    app = make_app()
+    store = get_store()
+    create_many = store.create_many
+    # Batches that take a while, so the threads' requests overlap
+    monkeypatch.setattr(store, 'create_many', lambda entity, records: time.sleep(0.05) or create_many(entity, records))
+    statuses = []
+
+    def send():
+        client = app.test_client()
+        items = [{'name': f'User {i}', 'company_id': 1, 'email': f'user{i}@example.com', 'password': 'secret'}
+                 for i in range(20)]
+        for _ in range(3):
+            statuses.append(client.post('/users:batch', json=items).status_code)
+            statuses.append(client.get('/users').status_code)
+
+    threads = [threading.Thread(target=send) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(statuses) == 48
+    assert set(statuses) <= {200, 201, 207}
@@ -0,0 +1,131 @@
+import json
+import pytest
+from conftest import BACKENDS
+
+
+def create_company(client, cnpj='11222333000181'):
+    response = client.post('/companies', json={'cnpj': cnpj, 'name': 'Acme', 'area_of_activity': 'Retail'})
+    return response.get_json()['company_id']
+
+
+def create_user(client, company_id, number=0):
+    body = {'name': f'User {number}', 'company_id': company_id, 'email': f'user{number}@example.com',
+            'password': 'secret'}
+    return client.post('/users', json=body).get_json()['id_user']
+
+
+def all_changes(client, path, since, limit=2):
+    """Follow last_seq until has_more is false, return the changes and the last last_seq."""
+    changes = []
+    while True:
+        body = client.get(f'{path}?since={since}&limit={limit}').get_json()
+        assert len(body['changes']) <= limit
+        changes += body['changes']
+        since = body['last_seq']
+        if not body['has_more']:
+            return changes, since
+
+
+def events(response, count):
+    """Read the first `count` events of a server-sent event stream, then close it."""
+    received = []
+    buffer = ''
+    for chunk in response.response:
+        buffer += chunk.decode('utf-8') if isinstance(chunk, bytes) else chunk
+        while '\n\n' in buffer:
+            block, buffer = buffer.split('\n\n', 1)
+            fields = dict(line.split(': ', 1) for line in block.split('\n') if ': ' in line)
+            if 'event' in fields:
+                received.append((fields['event'], fields.get('id'), json.loads(fields['data'])))
+        if len(received) >= count:
+            break
+    response.close()
+    return received
+
+
+def test_since_pages_through_every_write_in_order(client):
+    company_id = create_company(client)
+    seq = int(client.get('/users').headers['X-Change-Seq'])
+    user_ids = [create_user(client, company_id, number) for number in range(5)]
+    client.patch(f'/users/{user_ids[0]}', json={'name': 'Renamed'})
+    client.delete(f'/users/{user_ids[1]}')
+    changes, last_seq = all_changes(client, '/changes', seq)
+    assert [(change['op'], change['id_user']) for change in changes] == \
+        [('create', user_id) for user_id in user_ids] + [('update', user_ids[0]), ('delete', user_ids[1])]
+    assert [change['seq'] for change in changes] == sorted(change['seq'] for change in changes)
+    # The current version of each record, without its password. None once deleted
+    assert changes[0]['record']['name'] == 'Renamed'
+    assert 'password' not in changes[0]['record']
+    assert changes[1]['record'] is None
+    assert 'record' not in changes[-1]
+    # Nothing new since the last one
+    assert client.get(f'/changes?since={last_seq}').get_json() == {'changes': [], 'last_seq': last_seq,
+                                                                   'has_more': False}
+
+
+def test_since_on_a_collection_keeps_its_entity(client):
+    seq = int(client.get('/companies').headers['X-Change-Seq'])
+    company_id = create_company(client)
+    user_id = create_user(client, company_id)
+    changes, last_seq = all_changes(client, '/users', seq)
+    assert [(change['entity'], change['id_user']) for change in changes] == [('users', user_id)]
+    changes, _ = all_changes(client, '/companies', seq)
+    assert [(change['entity'], change['company_id']) for change in changes] == [('companies', company_id)]
+    # The writes to the other entity are skipped: resuming from last_seq misses nothing
+    assert client.get(f'/users?since={last_seq}').get_json()['changes'] == []
+
+
+def test_company_delete_logs_the_cascade(client):
+    company_id = create_company(client)
+    other = create_company(client, '99888777000166')
+    user_ids = [create_user(client, company_id, number) for number in range(3)]
+    kept = create_user(client, other, 3)
+    seq = int(client.get('/changes?since=0').get_json()['last_seq'])
+    assert client.delete(f'/companies/{company_id}').status_code == 200
+    changes, _ = all_changes(client, '/changes', seq, limit=100)
+    deleted = {(change['entity'], change.get('company_id', change.get('id_user'))) for change in changes
+               if change['op'] == 'delete'}
+    assert deleted == {('companies', company_id)} | {('users', user_id) for user_id in user_ids}
+    assert kept not in [change.get('id_user') for change in changes]
+
+
+@pytest.mark.parametrize('since', ['-1', 'abc', ''])
+def test_invalid_since_is_rejected(client, since):
+    assert client.get(f'/changes?since={since}').status_code == 400
+    assert client.get(f'/changes?since=0&limit=0').status_code == 400
+    assert client.get(f'/changes?since=0&entity=orders').status_code == 400
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_since_older_than_the_log_gets_a_410(make_app, backend):
+    client = make_app(backend, CHANGELOG_MAX_ENTRIES=3).test_client()
+    company_id = create_company(client)
+    for number in range(10):
+        create_user(client, company_id, number)
+    response = client.get('/changes?since=0')
+    assert response.status_code == 410
+    assert response.get_json()['error'] == 'Change log truncated'
+    assert client.get('/users?since=0').status_code == 410
+    # The retained writes are still served
+    seq = int(client.get('/users').headers['X-Change-Seq'])
+    body = client.get(f'/changes?since={seq - 3}').get_json()
+    assert [change['op'] for change in body['changes']] == ['create'] * 3
+    assert body['last_seq'] == seq
+    # A stream resuming from too far back is told to list the collection again
+    received = events(client.get('/changes/stream?since=0'), 1)
+    assert received[0][0] == 'reset'
+
+
+def test_stream_sends_each_write_as_an_event(make_app):
+    client = make_app(CHANGES_POLL_SECONDS=0.01).test_client()
+    company_id = create_company(client)
+    user_id = create_user(client, company_id)
+    client.patch(f'/users/{user_id}', json={'name': 'Renamed'})
+    received = events(client.get('/changes/stream?since=0'), 3)
+    assert [(name, data['op']) for name, _, data in received] == \
+        [('companies', 'create'), ('users', 'create'), ('users', 'update')]
+    # The event IDs are the sequence numbers, a reconnecting client resumes after Last-Event-ID
+    assert [int(event_id) for _, event_id, _ in received] == [data['seq'] for _, _, data in received]
+    response = client.get('/changes/stream?entity=users', headers={'Last-Event-ID': received[1][1]})
+    assert response.headers['Content-Type'].startswith('text/event-stream')
+    assert [(name, data['op']) for name, _, data in events(response, 1)] == [('users', 'update')]
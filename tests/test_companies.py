@@ -0,0 +1,81 @@
+import pytest
+
+CNPJ = '11222333000181'
+
+
+def create_company(client, cnpj=CNPJ):
+    response = client.post('/companies', json={'cnpj': cnpj, 'name': 'Acme', 'area_of_activity': 'Retail'})
+    assert response.status_code == 200
+    return response.get_json()['company_id']
+
+
+@pytest.mark.parametrize('cnpj', [list(range(14)), {str(i): i for i in range(14)}, 11222333000181, None, '123'])
+def test_invalid_cnpj_is_rejected_everywhere(client, cnpj):
+    company_id = create_company(client)
+    body = {'cnpj': cnpj, 'name': 'Acme', 'area_of_activity': 'Retail'}
+    assert client.post('/companies', json=body).status_code == 400
+    assert client.put(f'/companies/{company_id}', json=body).status_code == 400
+    assert client.patch(f'/companies/{company_id}', json={'cnpj': cnpj}).status_code == 400
+    response = client.patch('/companies:batch', json=[{'company_id': company_id, 'cnpj': cnpj}])
+    assert response.get_json()['results'][0]['status'] == 400
+    response = client.post('/companies:batch', json=[body])
+    assert response.get_json()['results'][0]['status'] == 400
+    # Nothing was written
+    assert client.get(f'/companies/{company_id}').get_json()['cnpj'] == CNPJ
+
+
+def test_duplicate_cnpj_is_rejected_on_update(client):
+    first = create_company(client)
+    second = create_company(client, '99888777000166')
+    response = client.patch(f'/companies/{second}', json={'cnpj': CNPJ})
+    assert response.status_code == 400
+    assert response.get_json()['error'] == 'CNPJ already exists'
+    assert client.get(f'/companies?cnpj={CNPJ}').get_json()[0]['company_id'] == first
+
+
+def test_batch_update_validates_every_item_before_writing(client):
+    first = create_company(client)
+    second = create_company(client, '99888777000166')
+    response = client.patch('/companies:batch', json=[{'company_id': first, 'name': 'Renamed'},
+                                                      {'company_id': second, 'cnpj': 123},
+                                                      {'company_id': second, 'name': 'Also renamed'}])
+    assert [result['status'] for result in response.get_json()['results']] == [200, 400, 200]
+    assert client.get(f'/companies/{first}').get_json()['name'] == 'Renamed'
+    assert client.get(f'/companies/{second}').get_json()['name'] == 'Also renamed'
+    assert client.get(f'/companies/{second}').get_json()['cnpj'] == '99888777000166'
+
+
+def test_batch_update_rejects_duplicate_cnpjs_per_item(client):
+    first = create_company(client)
+    second = create_company(client, '99888777000166')
+    third = create_company(client, '55444333000122')
+    response = client.patch('/companies:batch', json=[{'company_id': second, 'cnpj': CNPJ},
+                                                      {'company_id': third, 'cnpj': '00111222000133'},
+                                                      {'company_id': 99, 'name': 'Missing'}])
+    results = response.get_json()['results']
+    assert [result['status'] for result in results] == [400, 200, 400]
+    assert results[0]['error'] == 'CNPJ already exists'
+    assert [company['company_id'] for company in client.get(f'/companies?cnpj={CNPJ}').get_json()] == [first]
+    assert client.get(f'/companies/{third}').get_json()['cnpj'] == '00111222000133'
+
+
+def test_batch_delete_removes_the_users_of_the_companies(client):
+    first = create_company(client)
+    second = create_company(client, '99888777000166')
+    for company_id in (first, second, second):
+        client.post('/users', json={'name': 'Ana', 'company_id': company_id, 'email': 'ana@example.com',
+                                    'password': 'secret'})
+    response = client.delete('/companies:batch', json=[second, 42])
+    assert [result['status'] for result in response.get_json()['results']] == [200, 400]
+    assert [user['company_id'] for user in client.get('/users').get_json()] == [first]
+
+
+@pytest.mark.parametrize('company_id', [True, False, '1', 1.0, None])
+def test_batch_company_ids_must_be_integers(client, company_id):
+    create_company(client)
+    response = client.patch('/companies:batch', json=[{'company_id': company_id, 'name': 'Renamed'}])
+    assert response.get_json()['results'][0]['status'] == 400
+    response = client.delete('/companies:batch', json=[company_id])
+    assert response.get_json()['results'][0]['error'] == 'Invalid company ID'
+    # true is not company 1
+    assert client.get('/companies/1').get_json()['name'] == 'Acme'
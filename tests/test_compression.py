@@ -0,0 +1,82 @@
+import gzip
+import json
+import pytest
+from routes.compression import brotli
+
+
+def create_user(client, cnpj='11222333000181', **fields):
+    company_id = client.post('/companies', json={'cnpj': cnpj, 'name': 'Acme',
+                                                 'area_of_activity': 'Retail'}).get_json()['company_id']
+    body = {'name': 'Ana', 'company_id': company_id, 'email': 'ana@example.com', 'password': 'secret'}
+    body.update(fields)
+    return client.post('/users', json=body).get_json()['id_user']
+
+
+@pytest.fixture
+def client(make_app):
+    return make_app(COMPRESS_MIN_BYTES=0).test_client()
+
+
+def test_records_are_compressed_with_their_own_etag(client):
+    user_id = create_user(client)
+    plain = client.get(f'/users/{user_id}')
+    assert 'Content-Encoding' not in plain.headers
+    assert 'Accept-Encoding' in plain.headers['Vary']
+    etag = plain.get_etag()[0]
+    response = client.get(f'/users/{user_id}', headers={'Accept-Encoding': 'gzip'})
+    assert response.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in response.headers['Vary']
+    assert gzip.decompress(response.get_data()) == plain.get_data()
+    assert response.get_etag() == (f'{etag}-gzip', False)
+
+
+def test_compressed_etag_is_accepted_by_if_none_match_and_if_match(client):
+    user_id = create_user(client)
+    etag = client.get(f'/users/{user_id}', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+    response = client.get(f'/users/{user_id}', headers={'Accept-Encoding': 'gzip', 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert client.patch(f'/users/{user_id}', json={'name': 'Eva'}, headers={'If-Match': etag}).status_code == 200
+    assert client.patch(f'/users/{user_id}', json={'name': 'Bia'}, headers={'If-Match': etag}).status_code == 412
+
+
+@pytest.mark.skipif(brotli is None, reason='brotli is not installed')
+def test_brotli_is_preferred_when_accepted(client):
+    user_id = create_user(client)
+    response = client.get(f'/users/{user_id}', headers={'Accept-Encoding': 'gzip, br'})
+    assert response.headers['Content-Encoding'] == 'br'
+    assert response.get_etag()[0].endswith('-br')
+    assert brotli.decompress(response.get_data()) == client.get(f'/users/{user_id}').get_data()
+
+
+def test_small_responses_are_not_compressed(make_app):
+    client = make_app().test_client()
+    user_id = create_user(client)
+    response = client.get(f'/users/{user_id}', headers={'Accept-Encoding': 'gzip'})
+    assert 'Content-Encoding' not in response.headers
+    assert 'Accept-Encoding' in response.headers['Vary']
+
+
+def test_list_snapshots_are_reused_until_the_next_write(client):
+    create_user(client)
+    snapshots = client.application.extensions['snapshots']
+    first = client.get('/users', headers={'Accept-Encoding': 'gzip'})
+    assert first.headers['Content-Encoding'] == 'gzip'
+    assert 'Accept-Encoding' in first.headers['Vary']
+    hits = snapshots.hits
+    second = client.get('/users', headers={'Accept-Encoding': 'gzip'})
+    assert snapshots.hits == hits + 1
+    assert second.get_data() == first.get_data()
+    assert second.get_etag() == first.get_etag()
+    # The same snapshot, uncompressed for a client that doesn't accept gzip
+    plain = client.get('/users')
+    assert snapshots.hits == hits + 2
+    assert 'Content-Encoding' not in plain.headers
+    assert gzip.decompress(first.get_data()) == plain.get_data()
+    # A write changes the ETag, the list is built again
+    create_user(client, '99888777000166', email='bia@example.com', name='Bia')
+    misses = snapshots.misses
+    third = client.get('/users', headers={'Accept-Encoding': 'gzip'})
+    assert snapshots.misses == misses + 1
+    assert third.get_etag() != first.get_etag()
+    assert len(json.loads(gzip.decompress(third.get_data()))) == 2
@@ -0,0 +1,75 @@
+import pytest
+
+COMPANY = {'cnpj': '11222333000181', 'name': 'Acme', 'area_of_activity': 'Retail'}
+
+
+def create_company(client, **fields):
+    return client.post('/companies', json=dict(COMPANY, **fields)).get_json()['company_id']
+
+
+def create_user(client, company_id):
+    body = {'name': 'Ana', 'company_id': company_id, 'email': 'ana@example.com', 'password': 'secret'}
+    return client.post('/users', json=body).get_json()['id_user']
+
+
+def test_get_returns_304_while_the_record_is_unchanged(client):
+    company_id = create_company(client)
+    response = client.get(f'/companies/{company_id}')
+    etag = response.headers['ETag']
+    assert response.get_etag()[1] is False
+    response = client.get(f'/companies/{company_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.headers['ETag'] == etag
+    assert response.get_data() == b''
+    client.patch(f'/companies/{company_id}', json={'name': 'Beta'})
+    response = client.get(f'/companies/{company_id}', headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
+
+
+def test_writes_return_the_new_etag(client):
+    company_id = create_company(client)
+    response = client.patch(f'/companies/{company_id}', json={'name': 'Beta'})
+    assert response.headers['ETag'] == client.get(f'/companies/{company_id}').headers['ETag']
+
+
+@pytest.mark.parametrize('entity', ['companies', 'users'])
+def test_stale_if_match_is_rejected_with_412(client, entity):
+    company_id = create_company(client)
+    record_id = company_id if entity == 'companies' else create_user(client, company_id)
+    url = f'/{entity}/{record_id}'
+    full = COMPANY if entity == 'companies' else {'name': 'Ana', 'company_id': company_id,
+                                                  'email': 'ana@example.com', 'password': 'secret'}
+    stale = client.get(url).headers['ETag']
+    assert client.patch(url, json={'name': 'Beta'}, headers={'If-Match': stale}).status_code == 200
+    # Another client's copy is now out of date: every write with it is refused and changes nothing
+    assert client.patch(url, json={'name': 'Gama'}, headers={'If-Match': stale}).status_code == 412
+    assert client.put(url, json=dict(full, name='Gama'), headers={'If-Match': stale}).status_code == 412
+    assert client.delete(url, headers={'If-Match': stale}).status_code == 412
+    assert client.get(url).get_json()['name'] == 'Beta'
+    current = client.get(url).headers['ETag']
+    assert client.put(url, json=dict(full, name='Gama'), headers={'If-Match': current}).status_code == 200
+    assert client.delete(url, headers={'If-Match': client.get(url).headers['ETag']}).status_code == 200
+
+
+def test_if_match_star_matches_any_version(client):
+    company_id = create_company(client)
+    url = f'/companies/{company_id}'
+    assert client.patch(url, json={'name': 'Beta'}, headers={'If-Match': '*'}).status_code == 200
+    assert client.put(url, json=dict(COMPANY, name='Gama'), headers={'If-Match': '*'}).status_code == 200
+    assert client.delete(url, headers={'If-Match': '*'}).status_code == 200
+
+
+@pytest.mark.parametrize('path', ['/companies', '/users'])
+def test_collection_etag_is_weak_and_changes_after_a_write(client, path):
+    company_id = create_company(client)
+    response = client.get(path)
+    etag = response.headers['ETag']
+    assert response.get_etag()[1] is True
+    assert client.get(path, headers={'If-None-Match': etag}).status_code == 304
+    # Other query parameters are another list
+    assert client.get(f'{path}?limit=1', headers={'If-None-Match': etag}).status_code == 200
+    create_user(client, company_id)
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status_code == 200
+    assert response.headers['ETag'] != etag
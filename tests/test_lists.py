@@ -0,0 +1,45 @@
+from storage.engine import get_store
+
+
+def create_users(client, count, company_id):
+    items = [{'name': f'User {i}', 'company_id': company_id, 'email': f'user{i}@example.com', 'password': 'secret'}
+             for i in range(count)]
+    return [result['id_user'] for result in client.post('/users:batch', json=items).get_json()['results']]
+
+
+def count_reads(monkeypatch):
+    """Count the records the store is asked to read by ID."""
+    store = get_store()
+    read = []
+    get_many = store.get_many
+    monkeypatch.setattr(store, 'get_many', lambda entity, ids: read.extend(ids) or get_many(entity, ids))
+    return read
+
+
+def test_indexed_filter_pages_read_only_the_page(client, monkeypatch):
+    company_id = client.post('/companies', json={'cnpj': '11222333000181', 'name': 'Acme',
+                                                 'area_of_activity': 'Retail'}).get_json()['company_id']
+    user_ids = create_users(client, 30, company_id)
+    read = count_reads(monkeypatch)
+    response = client.get(f'/users?company_id={company_id}&limit=5&cursor={user_ids[9]}')
+    assert [user['id_user'] for user in response.get_json()] == user_ids[10:15]
+    # The page plus the record telling whether there is a next one
+    assert len(read) == 6
+    # Following the cursor returns every user once
+    seen = []
+    url = f'/companies/{company_id}/users?limit=7'
+    while url:
+        response = client.get(url)
+        seen += [user['id_user'] for user in response.get_json()]
+        url = response.headers.get('Link', '').partition('<')[2].partition('>')[0]
+    assert seen == user_ids
+
+
+def test_indexed_filter_with_other_filters(client):
+    company_id = client.post('/companies', json={'cnpj': '11222333000181', 'name': 'Acme',
+                                                 'area_of_activity': 'Retail'}).get_json()['company_id']
+    user_ids = create_users(client, 30, company_id)
+    response = client.get(f'/users?company_id={company_id}&name=User 2*&limit=5')
+    assert [user['id_user'] for user in response.get_json()] == [user_ids[2]] + user_ids[20:24]
+    response = client.get(f'/users?company_id={company_id}&name=User 2*&stream=ndjson')
+    assert len(response.get_data(as_text=True).splitlines()) == 11
@@ -0,0 +1,28 @@
+import pytest
+from passwords import PasswordHasher, PasswordQueueFull, verify_password
+
+
+def test_each_password_of_a_batch_takes_a_place_in_the_queue():
+    hasher = PasswordHasher(0, 5, n=2 ** 4)
+    hashed = hasher.hash_many(['secret'] * 5)
+    assert all(verify_password('secret', stored) for stored in hashed)
+    with pytest.raises(PasswordQueueFull):
+        hasher.hash_many(['secret'] * 6)
+
+
+def test_batches_setting_too_many_passwords_get_a_413(make_app):
+    client = make_app(PASSWORD_BATCH_MAX=3).test_client()
+    company_id = client.post('/companies', json={'cnpj': '11222333000181', 'name': 'Acme',
+                                                 'area_of_activity': 'Retail'}).get_json()['company_id']
+    items = [{'name': f'User {i}', 'company_id': company_id, 'email': f'user{i}@example.com', 'password': 'secret'}
+             for i in range(4)]
+    response = client.post('/users:batch', json=items)
+    assert response.status_code == 413
+    assert client.get('/users').get_json() == []
+    user_ids = [result['id_user'] for result in client.post('/users:batch', json=items[:3]).get_json()['results']]
+    user_ids.append(client.post('/users', json=items[3]).get_json()['id_user'])
+    response = client.patch('/users:batch', json=[{'id_user': user_id, 'password': 'other'} for user_id in user_ids])
+    assert response.status_code == 413
+    # Batches changing no password are not limited
+    response = client.patch('/users:batch', json=[{'id_user': user_id, 'name': 'Renamed'} for user_id in user_ids])
+    assert response.get_json()['succeeded'] == 4
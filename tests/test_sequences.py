@@ -0,0 +1,89 @@
+import threading
+from storage.sequences import IdSequence
+
+
+def new_sequence(tmp_path, block_size=10):
+    """Open the users sequence of a data directory, as FileStore does."""
+    (tmp_path / 'users').mkdir(exist_ok=True)
+    return IdSequence(str(tmp_path / 'users'), str(tmp_path / 'users.seq'), block_size=block_size)
+
+
+def hand_out(sequences, calls):
+    """Call next_id and next_block from a few threads per sequence at once, return every ID handed out."""
+    handed_out = []
+    lock = threading.Lock()
+
+    def worker(sequence, thread_number):
+        ids = []
+        for call in range(calls):
+            ids += sequence.next_block(3) if (call + thread_number) % 2 else [sequence.next_id()]
+        with lock:
+            handed_out.extend(ids)
+
+    threads = [threading.Thread(target=worker, args=(sequence, number))
+               for sequence in sequences for number in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return handed_out
+
+
+def test_sequences_sharing_a_file_never_hand_out_the_same_id(tmp_path):
+    # Two sequences over one file are two worker processes, the tiny blocks make them reserve all the time
+    sequences = [new_sequence(tmp_path, block_size=2) for _ in range(2)]
+    ids = hand_out(sequences, 50)
+    assert len(ids) == len(set(ids)) == 2 * 4 * 50 * 2
+    assert min(ids) == 1
+
+
+def test_restarted_sequence_never_reuses_an_id(tmp_path):
+    sequence = new_sequence(tmp_path)
+    ids = [sequence.next_id() for _ in range(3)]
+    # A restart (or a crash) loses the rest of the reserved block, never an ID already handed out
+    restarted = new_sequence(tmp_path)
+    restarted_id = restarted.next_id()
+    assert restarted_id > ids[-1]
+    # Same in a forked worker: the block of the parent is left to the parent, it starts after every reserved one
+    sequence.after_fork()
+    assert sequence.next_id() > restarted_id
+
+
+def test_observed_ids_are_never_handed_out(tmp_path):
+    sequence = new_sequence(tmp_path)
+    sequence.next_id()
+    sequence.observe(500)
+    assert sequence.next_id() == 501
+    # Past the reserved block: persisted, a restart doesn't hand it out either
+    assert new_sequence(tmp_path).next_id() > 501
+
+
+def test_stores_sharing_a_data_dir_create_distinct_records(open_store):
+    stores = [open_store(), open_store()]
+    created = []
+    lock = threading.Lock()
+
+    def worker(store, number):
+        ids = [store.create('users', {'name': f'User {number}', 'company_id': 1}) for _ in range(20)]
+        ids += store.create_many('users', [{'name': f'User {number}', 'company_id': 1}] * 20)
+        with lock:
+            created.extend(ids)
+
+    threads = [threading.Thread(target=worker, args=(store, number)) for store in stores for number in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len(created) == len(set(created)) == 2 * 4 * 40
+    # No write overwrote another one
+    assert sorted(user['id_user'] for user in open_store().scan('users')) == sorted(created)
+
+
+def test_restarted_store_never_reuses_the_id_of_a_deleted_record(open_store):
+    store = open_store()
+    user_ids = [store.create('users', {'name': 'Ana', 'company_id': 1}) for _ in range(3)]
+    store.delete('users', user_ids[-1])
+    store.put('users', 1000, {'id_user': 1000, 'name': 'Imported', 'company_id': 1})
+    store.delete('users', 1000)
+    store.close()
+    assert open_store().create('users', {'name': 'Bia', 'company_id': 1}) > 1000
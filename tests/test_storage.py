@@ -0,0 +1,202 @@
+import os
+import json
+import time
+import threading
+import pytest
+from conftest import BACKENDS
+from storage import log
+from storage.base import InvalidValueError
+from storage.layout import LAYOUTS, record_path, shard
+
+
+@pytest.mark.parametrize('backend', ['files', 'sqlite', 'log'])
+@pytest.mark.parametrize('value', [[1], {'a': 1}])
+def test_unindexable_values_are_never_written(open_store, backend, value):
+    store = open_store(backend)
+    user_id = store.create('users', {'name': 'Ana', 'company_id': 1, 'email': 'ana@example.com'})
+    with pytest.raises(InvalidValueError):
+        store.put('users', user_id, {'id_user': user_id, 'name': 'Ana', 'company_id': value})
+    with pytest.raises(InvalidValueError):
+        store.create('users', {'name': 'Bia', 'company_id': value})
+    with pytest.raises(InvalidValueError):
+        store.create_many('users', [{'name': 'Caio', 'company_id': 1}, {'name': 'Bia', 'company_id': value}])
+    assert store.get('users', user_id)['company_id'] == 1
+    assert [user['id_user'] for user in store.scan('users')] == [user_id]
+    assert [user['id_user'] for user in store.query('users', 'company_id', 1)] == [user_id]
+
+
+@pytest.mark.parametrize('layout', LAYOUTS)
+def test_index_is_rebuilt_after_files_change_behind_its_back(open_store, tmp_path, layout):
+    store = open_store(FILE_LAYOUT=layout)
+    for company_id in (1, 1, 2):
+        store.create('users', {'name': 'Ana', 'company_id': company_id, 'email': 'ana@example.com'})
+    store.close()
+    users_dir = str(tmp_path / 'data' / 'users')
+
+    def write(record):
+        path = record_path(users_dir, record['id_user'], layout)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(record, f)
+
+    # Records stored next to existing ones: sharded, only the mtime of their shard directory changes
+    eva, ivo = (next(record_id for record_id in range(10, 10 ** 6) if shard(record_id) == shard(neighbour))
+                for neighbour in (2, 3))
+    # Edits made while the server is down, one of them with a value that can't be indexed
+    time.sleep(0.01)
+    os.remove(record_path(users_dir, 1, layout))
+    write({'id_user': eva, 'name': 'Eva', 'company_id': 2})
+    write({'id_user': ivo, 'name': 'Ivo', 'company_id': [2]})
+    store = open_store(FILE_LAYOUT=layout)
+    assert [user['id_user'] for user in store.query('users', 'company_id', 1)] == [2]
+    assert [user['id_user'] for user in store.query('users', 'company_id', 2)] == sorted([3, eva])
+    # The record that couldn't be indexed is still readable
+    assert store.get('users', ivo)['company_id'] == [2]
+
+
+def test_index_journal_is_replayed_after_a_restart(open_store):
+    store = open_store()
+    first = store.create('companies', {'cnpj': '11222333000181', 'name': 'Acme'})
+    second = store.create('companies', {'cnpj': '99888777000166', 'name': 'Beta'})
+    store.put('companies', second, {'company_id': second, 'cnpj': '55444333000122', 'name': 'Beta'})
+    store.delete('companies', first)
+    store.close()
+    store = open_store()
+    assert store.query('companies', 'cnpj', '11222333000181') == []
+    assert store.query('companies', 'cnpj', '99888777000166') == []
+    assert [company['company_id'] for company in store.query('companies', 'cnpj', '55444333000122')] == [second]
+
+
+def test_log_replays_values_that_cant_be_indexed(open_store, monkeypatch):
+    store = open_store('log')
+    first = store.create('users', {'name': 'Ana', 'company_id': 1})
+    # Appended by a version that didn't check the values
+    monkeypatch.setattr(log, 'check_indexed_values', lambda entity, records: None)
+    second = store.create('users', {'name': 'Bia', 'company_id': 1})
+    store.put('users', second, {'id_user': second, 'name': 'Bia', 'company_id': [1]})
+    store.close()
+    store = open_store('log')
+    assert [user['id_user'] for user in store.query('users', 'company_id', 1)] == [first]
+    assert store.get('users', second)['company_id'] == [1]
+
+
+def test_log_compaction_survives_a_restart(open_store):
+    store = open_store('log', LOG_SEGMENT_BYTES=512)
+    ids = [store.create('companies', {'cnpj': f'{number:014d}', 'name': f'Company {number}'}) for number in range(30)]
+    for company_id in ids[::2]:
+        store.put('companies', company_id, dict(store.get('companies', company_id), name='Renamed'))
+    store.delete_many('companies', ids[:5])
+    expected = list(store.scan('companies'))
+    garbage = store.garbage_ratio()
+    assert store.compact()
+    # Only the deletes kept for the records of the removed segments are left
+    assert store.garbage_ratio() < garbage / 2
+    assert list(store.scan('companies')) == expected
+    store.write_hints()
+    store.close()
+    store = open_store('log', LOG_SEGMENT_BYTES=512)
+    assert list(store.scan('companies')) == expected
+    assert [company['name'] for company in store.query('companies', 'cnpj', f'{6:014d}')] == ['Renamed']
+    assert store.query('companies', 'cnpj', f'{0:014d}') == []
+    assert store.create('companies', {'cnpj': '11222333000181', 'name': 'Acme'}) > ids[-1]
+
+
+@pytest.mark.parametrize('backend', BACKENDS)
+def test_revision_is_the_same_in_every_worker(open_store, backend):
+    # Two workers forked from the same master, over the same data directory
+    first, second = open_store(backend), open_store(backend)
+    first.after_fork()
+    second.after_fork()
+    assert first.revision() == second.revision()
+    before = first.revision()
+    company_id = first.create('companies', {'cnpj': '11222333000181', 'name': 'Acme'})
+    assert first.revision() == second.revision() != before
+    second.put('companies', company_id, {'company_id': company_id, 'cnpj': '11222333000181', 'name': 'Beta'})
+    assert first.revision() == second.revision()
+
+
+def test_default_coherence_serves_files_edited_outside_the_api(open_store, tmp_path):
+    store = open_store()
+    user_id = store.create('users', {'name': 'Ana', 'company_id': 1})
+    assert store.get('users', user_id)['name'] == 'Ana'
+    time.sleep(0.01)
+    (tmp_path / 'data' / 'users' / f'{user_id}.json').write_text(
+        json.dumps({'id_user': user_id, 'name': 'Eva', 'company_id': 1}))
+    assert store.get('users', user_id)['name'] == 'Eva'
+
+
+@pytest.mark.parametrize('coherence', ['auto', 'poll'])
+def test_watched_coherence_follows_other_workers(open_store, coherence):
+    first, second = open_store(CACHE_COHERENCE=coherence), open_store(CACHE_COHERENCE=coherence)
+    user_id = first.create('users', {'name': 'Ana', 'company_id': 1})
+    assert second.get('users', user_id)['name'] == 'Ana'
+    first.put('users', user_id, {'id_user': user_id, 'name': 'Eva', 'company_id': 2})
+    assert second.get('users', user_id)['name'] == 'Eva'
+    assert [user['id_user'] for user in second.query('users', 'company_id', 2)] == [user_id]
+    assert second.query('users', 'company_id', 1) == []
+
+
+def test_log_compaction_interrupted_before_the_older_segments_are_removed(open_store, monkeypatch):
+    store = open_store('log', LOG_SEGMENT_BYTES=512)
+    ids = [store.create('companies', {'cnpj': f'{number:014d}', 'name': f'Company {number}'}) for number in range(20)]
+    # The deletes fill the third segment: the last closed one, which the compaction replaces
+    store.delete_many('companies', ids[:5])
+    expected = list(store.scan('companies'))
+
+    class Crash(Exception):
+        pass
+
+    def remove(path):
+        if path.endswith('.log'):
+            raise Crash(path)
+        os.unlink(path)
+
+    # The process dies once the compacted segment is in place, before the older ones are removed
+    monkeypatch.setattr(log.os, 'remove', remove)
+    with pytest.raises(Crash):
+        store.compact()
+    monkeypatch.undo()
+    store.close()
+    store = open_store('log', LOG_SEGMENT_BYTES=512)
+    assert list(store.scan('companies')) == expected
+    assert store.get('companies', ids[0]) is None
+    # The next compaction finishes the job
+    assert store.compact()
+    assert list(store.scan('companies')) == expected
+
+
+def test_sqlite_delete_where_logs_every_record_it_deletes(open_store):
+    store, other = open_store('sqlite'), open_store('sqlite')
+    store.create('users', {'name': 'Ana', 'company_id': 1})
+    connection = store._connect()
+    inserts = []
+
+    class Connection:
+        """Lets another process insert a user of the company between the SELECT and the DELETE."""
+
+        def __getattr__(self, name):
+            return getattr(connection, name)
+
+        def __enter__(self):
+            connection.__enter__()
+            return self
+
+        def __exit__(self, *exc_info):
+            return connection.__exit__(*exc_info)
+
+        def execute(self, sql, *parameters):
+            if sql.startswith('DELETE FROM users WHERE company_id'):
+                insert = threading.Thread(target=lambda: other.create('users', {'name': 'Bia', 'company_id': 1}))
+                insert.start()
+                insert.join(timeout=0.3)
+                inserts.append(insert)
+            return connection.execute(sql, *parameters)
+
+    store._local.connection = Connection()
+    deleted = store.delete_where('users', 'company_id', 1)
+    store._local.connection = connection
+    inserts[0].join()
+    logged = [record_id for _, entity, op, record_id in store.changes(0, 100) if op == 'delete']
+    assert logged == deleted
+    # The user inserted meanwhile was either deleted and logged, or is still there
+    assert [user['name'] for user in store.scan('users')] == ['Bia']
@@ -0,0 +1,85 @@
+import threading
+import pytest
+from storage.engine import get_store
+
+
+def create_company(client, cnpj='11222333000181'):
+    response = client.post('/companies', json={'cnpj': cnpj, 'name': 'Acme', 'area_of_activity': 'Retail'})
+    return response.get_json()['company_id']
+
+
+def user_body(company_id, **fields):
+    body = {'name': 'Ana', 'company_id': company_id, 'email': 'ana@example.com', 'password': 'secret'}
+    body.update(fields)
+    return body
+
+
+@pytest.mark.parametrize('company_id', [[1], {'a': 1}, '1', 1.0, True, None])
+def test_company_id_must_be_an_integer(client, company_id):
+    company = create_company(client)
+    user_id = client.post('/users', json=user_body(company)).get_json()['id_user']
+    assert client.post('/users', json=user_body(company_id)).status_code == 400
+    assert client.put(f'/users/{user_id}', json=user_body(company_id)).status_code == 400
+    assert client.patch(f'/users/{user_id}', json={'company_id': company_id}).status_code == 400
+    response = client.patch('/users:batch', json=[{'id_user': user_id, 'company_id': company_id}])
+    assert response.get_json()['results'][0]['status'] == 400
+    response = client.post('/users:batch', json=[user_body(company_id)])
+    assert response.get_json()['results'][0]['status'] == 400
+    # The user and the index are untouched
+    assert client.get(f'/users/{user_id}').get_json()['company_id'] == company
+    assert [user['id_user'] for user in client.get(f'/companies/{company}/users').get_json()] == [user_id]
+
+
+@pytest.mark.parametrize('email', [['a@b.co'], 12, 'not-an-email'])
+def test_invalid_email_is_rejected(client, email):
+    company = create_company(client)
+    user_id = client.post('/users', json=user_body(company)).get_json()['id_user']
+    assert client.post('/users', json=user_body(company, email=email)).status_code == 400
+    assert client.patch(f'/users/{user_id}', json={'email': email}).status_code == 400
+
+
+def test_moving_a_user_updates_the_company_listing(client):
+    first = create_company(client)
+    second = create_company(client, '99888777000166')
+    user_id = client.post('/users', json=user_body(first)).get_json()['id_user']
+    assert client.patch(f'/users/{user_id}', json={'company_id': second}).status_code == 200
+    assert client.get(f'/companies/{first}/users').get_json() == []
+    assert [user['id_user'] for user in client.get(f'/companies/{second}/users').get_json()] == [user_id]
+
+
+def test_passwords_are_hashed_outside_the_record_lock(client, monkeypatch):
+    company = create_company(client)
+    user_id = client.post('/users', json=user_body(company)).get_json()['id_user']
+    store = get_store()
+    hasher = client.application.extensions['passwords']
+    hash_password = hasher.hash
+    free = []
+
+    def hash_(password):
+        # Another thread writing a user on the same lock stripe must not wait for the hash
+        def write_other():
+            with store.lock('users', user_id + 64):
+                pass
+
+        other = threading.Thread(target=write_other, daemon=True)
+        other.start()
+        other.join(timeout=1)
+        free.append(not other.is_alive())
+        return hash_password(password)
+
+    monkeypatch.setattr(hasher, 'hash', hash_)
+    assert client.put(f'/users/{user_id}', json=user_body(company, password='other1')).status_code == 200
+    assert client.patch(f'/users/{user_id}', json={'password': 'other2'}).status_code == 200
+    assert free == [True, True]
+
+
+@pytest.mark.parametrize('user_id', [True, False, '1', 1.0, None])
+def test_batch_user_ids_must_be_integers(client, user_id):
+    company = create_company(client)
+    client.post('/users', json=user_body(company))
+    response = client.patch('/users:batch', json=[{'id_user': user_id, 'name': 'Renamed'}])
+    assert response.get_json()['results'][0]['status'] == 400
+    response = client.delete('/users:batch', json=[user_id])
+    assert response.get_json()['results'][0]['error'] == 'Invalid user ID'
+    # true is not user 1
+    assert client.get('/users/1').get_json()['name'] == 'Ana'